@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+_path = os.path.dirname(os.path.realpath(__file__))
+_hooks = os.path.abspath(os.path.join(_path, '../hooks'))
+_root = os.path.abspath(os.path.join(_path, '..'))
+
+
+def _add_path(path):
+    if path not in sys.path:
+        sys.path.insert(1, path)
+
+
+_add_path(_hooks)
+_add_path(_root)
+
+from charmhelpers.contrib.storage.linux.ceph import plan_request_pgs
+from charmhelpers.contrib.storage.linux.ceph_client import client_scope
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+    service_name,
+)
+
+import cinder_hooks
+
+
+def show_pg_plan(args):
+    """Report the placement groups ceph-mon would create the pools with."""
+    # NOTE: actions do not run the atexit handlers closing the clients.
+    with client_scope():
+        report = plan_request_pgs(
+            service_name(), cinder_hooks.get_ceph_request(),
+            pgs_per_osd=action_get('pgs-per-osd'),
+            expected_osd_count=action_get('expected-osd-count'))
+    if report is None:
+        action_fail('Could not read the cluster topology')
+        return
+    action_set({'plan': report})
+
+
+# A dictionary of all the defined actions to callables (which take
+# parsed arguments).
+ACTIONS = {'show-pg-plan': show_pg_plan}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return 'Action {} undefined'.format(action_name)
+    try:
+        action(args)
+    except Exception as e:
+        action_fail(str(e))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -17,6 +17,7 @@ import re
 import subprocess
 import six
 import socket
+import struct
 
 from functools import partial
 
@@ -35,25 +36,39 @@ from charmhelpers.core.host import (
     CompareHostReleases,
 )
 
-try:
-    import netifaces
-except ImportError:
-    apt_update(fatal=True)
-    if six.PY2:
-        apt_install('python-netifaces', fatal=True)
-    else:
-        apt_install('python3-netifaces', fatal=True)
-    import netifaces
-
-try:
-    import netaddr
-except ImportError:
-    apt_update(fatal=True)
-    if six.PY2:
-        apt_install('python-netaddr', fatal=True)
-    else:
-        apt_install('python3-netaddr', fatal=True)
-    import netaddr
+from charmhelpers.core.lazy import LazyObject
+
+
+def _import_netifaces():
+    try:
+        import netifaces
+    except ImportError:
+        apt_update(fatal=True)
+        if six.PY2:
+            apt_install('python-netifaces', fatal=True)
+        else:
+            apt_install('python3-netifaces', fatal=True)
+        import netifaces
+    return netifaces
+
+
+def _import_netaddr():
+    try:
+        import netaddr
+    except ImportError:
+        apt_update(fatal=True)
+        if six.PY2:
+            apt_install('python-netaddr', fatal=True)
+        else:
+            apt_install('python3-netaddr', fatal=True)
+        import netaddr
+    return netaddr
+
+
+# NOTE: this module is imported by most of the OpenStack helpers, only import
+# the network libraries once an address is actually looked at.
+netifaces = LazyObject(_import_netifaces, name='netifaces')
+netaddr = LazyObject(_import_netaddr, name='netaddr')
 
 
 def _validate_cidr(network):
@@ -554,6 +569,71 @@ def port_has_listener(address, port):
     return not(bool(result))
 
 
+PROC_NET_TCP = ['/proc/net/tcp', '/proc/net/tcp6']
+_TCP_LISTEN = '0A'
+
+
+def _decode_proc_net_address(address):
+    """Decode an address of /proc/net/tcp{,6}, e.g. 0100007F:1F90.
+
+    :returns: (address, port)
+    :rtype: Tuple[str, int]
+    """
+    host, port = address.split(':')
+    # the address is stored as 32 bit words in host byte order
+    packed = b''.join(
+        struct.pack('=I', int(host[i:i + 8], 16))
+        for i in range(0, len(host), 8))
+    family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, packed), int(port, 16)
+
+
+def tcp_listeners():
+    """Return the local addresses of the listening TCP sockets.
+
+    Reads /proc/net/tcp and /proc/net/tcp6 once instead of probing ports.
+
+    :returns: set of (address, port) or None if the sockets can not be read.
+    :rtype: Optional[Set[Tuple[str, int]]]
+    """
+    listeners = set()
+    found = False
+    for path in PROC_NET_TCP:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        found = True
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 3 and fields[3] == _TCP_LISTEN:
+                listeners.add(_decode_proc_net_address(fields[1]))
+    return listeners if found else None
+
+
+def ports_have_listeners(address, ports):
+    """
+    Check which of the ports are open and being listened to on address,
+    like port_has_listener() but for all ports at once.
+
+    @param address: an IP address, '0.0.0.0' for the local host
+    @param ports: list of integer ports
+    @returns list of booleans in the order of ports
+    """
+    listeners = tcp_listeners()
+    if listeners is None:
+        return [port_has_listener(address, p) for p in ports]
+    if address == '0.0.0.0':
+        # connecting to 0.0.0.0 reaches listeners on the loopback address
+        accepted = {'127.0.0.1', '::1', '::ffff:127.0.0.1'}
+    else:
+        accepted = {address, '::ffff:{}'.format(address)}
+    accepted.update(('0.0.0.0', '::'))
+    listening = {port for addr, port in listeners if addr in accepted}
+    return [int(p) in listening for p in ports]
+
+
 def assert_charm_supports_ipv6():
     """Check whether we are able to support charms ipv6."""
     release = lsb_release()['DISTRIB_CODENAME'].lower()
@@ -49,6 +49,7 @@ from charmhelpers.core.hookenv import (
     relation_ids,
     related_units,
     relation_set,
+    relation_snapshot,
     unit_get,
     unit_private_ip,
     charm_name,
@@ -116,6 +117,7 @@ from charmhelpers.contrib.openstack.utils import (
     CompareOpenStackReleases,
     os_release,
 )
+from charmhelpers.core.lazy import LazyObject
 from charmhelpers.core.unitdata import kv
 
 try:
@@ -125,14 +127,21 @@ except ImportError:
     # optional.
     pass
 
-try:
-    import psutil
-except ImportError:
-    if six.PY2:
-        apt_install('python-psutil', fatal=True)
-    else:
-        apt_install('python3-psutil', fatal=True)
-    import psutil
+
+def _import_psutil():
+    try:
+        import psutil
+    except ImportError:
+        if six.PY2:
+            apt_install('python-psutil', fatal=True)
+        else:
+            apt_install('python3-psutil', fatal=True)
+        import psutil
+    return psutil
+
+
+# NOTE: psutil is only needed to size worker pools.
+psutil = LazyObject(_import_psutil, name='psutil')
 
 CA_CERT_PATH = '/usr/local/share/ca-certificates/keystone_juju_ca_cert.crt'
 ADDRESS_TYPES = ['admin', 'internal', 'public']
@@ -790,23 +799,24 @@ class CephContext(OSContextGenerator):
         }
         for rid in relation_ids('ceph'):
             for unit in related_units(rid):
+                # NOTE: read all attributes from a single snapshot of the
+                # unit's relation data rather than one relation-get each.
+                rdata = relation_snapshot(rid=rid, unit=unit)
                 if not ctxt.get('auth'):
-                    ctxt['auth'] = relation_get('auth', rid=rid, unit=unit)
+                    ctxt['auth'] = rdata.get('auth')
                 if not ctxt.get('key'):
-                    ctxt['key'] = relation_get('key', rid=rid, unit=unit)
+                    ctxt['key'] = rdata.get('key')
                 if not ctxt.get('rbd_features'):
-                    default_features = relation_get('rbd-features', rid=rid, unit=unit)
+                    default_features = rdata.get('rbd-features')
                     if default_features is not None:
                         ctxt['rbd_features'] = default_features
 
-                ceph_addrs = relation_get('ceph-public-address', rid=rid,
-                                          unit=unit)
+                ceph_addrs = rdata.get('ceph-public-address')
                 if ceph_addrs:
                     for addr in ceph_addrs.split(' '):
                         mon_hosts.append(format_ipv6_addr(addr) or addr)
                 else:
-                    priv_addr = relation_get('private-address', rid=rid,
-                                             unit=unit)
+                    priv_addr = rdata.get('private-address')
                     mon_hosts.append(format_ipv6_addr(priv_addr) or priv_addr)
 
         ctxt['mon_hosts'] = ' '.join(sorted(mon_hosts))
@@ -12,34 +12,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
+import stat
+import tempfile
 
 import six
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    cached,
+    charm_dir,
     log,
+    DEBUG,
     ERROR,
     INFO,
-    TRACE
+    TRACE,
+    WARNING,
 )
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
+from charmhelpers.core.host import note_file_write
+from charmhelpers.core.lazy import LazyObject
+from charmhelpers.core.unitdata import file_stamp, kv
+
+# unitdata key recording, per config file, the digest of the content last
+# rendered and the stamp of the file written.
+RENDERED_KEY = 'templating.rendered'
+
+# directory in the charm directory holding the compiled templates, one
+# sub-directory per OpenStack release.
+TEMPLATE_CACHE_DIR = '.template-cache'
+
+
+def _import_jinja2():
+    try:
+        import jinja2
+    except ImportError:
+        apt_update(fatal=True)
+        if six.PY2:
+            apt_install('python-jinja2', fatal=True)
+        else:
+            apt_install('python3-jinja2', fatal=True)
+        import jinja2
+    # jinja2 only imports its exceptions submodule as an attribute
+    import jinja2.exceptions
+    return jinja2
+
 
-try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
-except ImportError:
-    apt_update(fatal=True)
-    if six.PY2:
-        apt_install('python-jinja2', fatal=True)
-    else:
-        apt_install('python3-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+# NOTE: jinja2 is only imported once a template is loaded, hooks which do not
+# render any configuration do not pay for it.
+jinja2 = LazyObject(_import_jinja2, name='jinja2')
+FileSystemLoader = LazyObject(lambda: jinja2.FileSystemLoader,
+                              name='jinja2.FileSystemLoader')
+ChoiceLoader = LazyObject(lambda: jinja2.ChoiceLoader,
+                          name='jinja2.ChoiceLoader')
+Environment = LazyObject(lambda: jinja2.Environment,
+                         name='jinja2.Environment')
+exceptions = LazyObject(lambda: jinja2.exceptions, name='jinja2.exceptions')
 
 
 class OSConfigException(Exception):
     pass
 
 
+@cached
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -61,6 +97,68 @@ def get_loader(templates_dir, os_release):
         jinja2.FilesystemLoaders, ordered in descending
         order by OpenStack release.
     """
+    loaders = [FileSystemLoader(tmpl_dir)
+               for tmpl_dir in get_template_dirs(templates_dir, os_release)]
+    # demote this log to the lowest level; we don't really need to see these
+    # lots in production even when debugging.
+    log('Creating choice loader with dirs: %s' %
+        [l.searchpath for l in loaders], level=TRACE)
+    return ChoiceLoader(loaders)
+
+
+def get_bytecode_cache(os_release):
+    """
+    Create a jinja2 bytecode cache for the templates of os_release.
+
+    Compiled templates are stored per release in TEMPLATE_CACHE_DIR in the
+    charm directory.  jinja2 keys the cached code by template name and path
+    and discards it when the source of the template changes.
+
+    :param os_release (str): OpenStack release codename.
+    :returns: jinja2.FileSystemBytecodeCache or None if there is no charm
+        directory to store the compiled templates in.
+    """
+    _charm_dir = charm_dir()
+    if not _charm_dir:
+        return None
+    cache_dir = os.path.join(_charm_dir, TEMPLATE_CACHE_DIR,
+                             os_release or 'default')
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+    except OSError as e:
+        log('Not caching compiled templates in %s: %s' % (cache_dir, e),
+            level=WARNING)
+        return None
+    return jinja2.FileSystemBytecodeCache(cache_dir)
+
+
+@cached
+def get_template_env(templates_dir, os_release):
+    """
+    Create the jinja2 environment to render the templates of os_release.
+
+    The environment is shared by all renderers of the hook so templates are
+    loaded once, and it compiles templates through get_bytecode_cache().
+
+    :param templates_dir (str): Base template directory containing release
+        sub-directories.
+    :param os_release (str): OpenStack release codename.
+    :returns: jinja2.Environment
+    """
+    return Environment(loader=get_loader(templates_dir, os_release),
+                       bytecode_cache=get_bytecode_cache(os_release))
+
+
+def get_template_dirs(templates_dir, os_release):
+    """
+    List the template dirs searched for os_release, see get_loader().
+
+    :param templates_dir (str): Base template directory containing release
+        sub-directories.
+    :param os_release (str): OpenStack release codename.
+    :returns: list of directories in descending order of precedence.
+    """
     tmpl_dirs = [(rel, os.path.join(templates_dir, rel))
                  for rel in six.itervalues(OPENSTACK_CODENAMES)]
 
@@ -71,21 +169,47 @@ def get_loader(templates_dir, os_release):
 
     # the bottom contains tempaltes_dir and possibly a common templates dir
     # shipped with the helper.
-    loaders = [FileSystemLoader(templates_dir)]
+    dirs = [templates_dir]
     helper_templates = os.path.join(os.path.dirname(__file__), 'templates')
     if os.path.isdir(helper_templates):
-        loaders.append(FileSystemLoader(helper_templates))
+        dirs.append(helper_templates)
 
     for rel, tmpl_dir in tmpl_dirs:
         if os.path.isdir(tmpl_dir):
-            loaders.insert(0, FileSystemLoader(tmpl_dir))
+            dirs.insert(0, tmpl_dir)
         if rel == os_release:
             break
-    # demote this log to the lowest level; we don't really need to see these
-    # lots in production even when debugging.
-    log('Creating choice loader with dirs: %s' %
-        [l.searchpath for l in loaders], level=TRACE)
-    return ChoiceLoader(loaders)
+    return dirs
+
+
+def _write_atomic(path, data):
+    """
+    Replace the content of path with data in a single rename.
+
+    An existing file keeps its permissions and ownership.
+    """
+    dirname, basename = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=dirname or '.',
+                               prefix='.{}.'.format(basename))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        try:
+            st = os.stat(path)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        else:
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+                os.chown(tmp, st.st_uid, st.st_gid)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
 
 
 class OSConfigTemplate(object):
@@ -250,8 +374,8 @@ class OSConfigRenderer(object):
 
     def _get_tmpl_env(self):
         if not self._tmpl_env:
-            loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = get_template_env(self.templates_dir,
+                                              self.openstack_release)
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -278,8 +402,10 @@ class OSConfigRenderer(object):
             raise OSConfigException
 
         ostmpl = self.templates[config_file]
-        ctxt = ostmpl.context()
+        return self._render(ostmpl, ostmpl.context())
 
+    def _render(self, ostmpl, ctxt):
+        config_file = ostmpl.config_file
         if ostmpl.is_string_template:
             template = self._get_template_from_string(ostmpl)
             log('Rendering from a string template: '
@@ -313,6 +439,12 @@ class OSConfigRenderer(object):
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is only replaced, atomically, if its content changes.  It is
+        not read back when neither the rendered content nor the file changed
+        since it was last written.
+
+        :returns: True if the content of the file changed.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
@@ -321,17 +453,41 @@ class OSConfigRenderer(object):
         _out = self.render(config_file)
         if six.PY3:
             _out = _out.encode('UTF-8')
+        digest = hashlib.sha256(_out).hexdigest()
+        path = os.path.realpath(config_file)
+        db = kv()
+        rendered = db.get(RENDERED_KEY) or {}
+        if rendered.get(config_file) == {'digest': digest,
+                                         'stamp': file_stamp(path)}:
+            changed = False
+        else:
+            try:
+                with open(path, 'rb') as current:
+                    changed = current.read() != _out
+            except (IOError, OSError):
+                changed = True
+        if changed:
+            _write_atomic(path, _out)
+            note_file_write(path, _out)
+            log('Wrote template %s.' % config_file, level=INFO)
+        else:
+            log('Template %s unchanged.' % config_file, level=DEBUG)
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
-
-        log('Wrote template %s.' % config_file, level=INFO)
+        record = {'digest': digest, 'stamp': file_stamp(path)}
+        if rendered.get(config_file) != record:
+            rendered[config_file] = record
+            # NOTE: committed with the rest of the hook, a failed hook only
+            # makes the next one read the file back.
+            db.set(RENDERED_KEY, rendered)
+        return changed
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        :returns: list of the config files whose content changed.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        return [k for k in six.iterkeys(self.templates) if self.write(k)]
 
     def set_release(self, openstack_release):
         """
@@ -75,14 +75,14 @@ from charmhelpers.contrib.storage.linux.lvm import (
 from charmhelpers.contrib.network.ip import (
     get_ipv6_addr,
     is_ipv6,
-    port_has_listener,
+    ports_have_listeners,
 )
 
 from charmhelpers.core.host import (
     lsb_release,
     mounts,
     umount,
-    service_running,
+    services_running,
     service_pause,
     service_resume,
     service_stop,
@@ -496,6 +496,16 @@ def get_os_codename_package(package, fatal=True):
                 # Second item in list is Version
                 return line.split()[1]
 
+    # NOTE: the codename only changes when packages are installed or
+    # upgraded, keep it in the fact cache to avoid querying apt and dpkg on
+    # every hook.
+    return unitdata.kv().fact(
+        'os-codename-package.{}'.format(package),
+        lambda: _get_os_codename_apt_package(package, fatal))
+
+
+def _get_os_codename_apt_package(package, fatal=True):
+    '''Derive OpenStack release codename from an installed deb package.'''
     cache = apt_cache()
 
     try:
@@ -968,6 +978,7 @@ def set_os_workload_status(configs, required_interfaces, charm_func=None,
     state, message = _determine_os_workload_status(
         configs, required_interfaces, charm_func, services, ports)
     status_set(state, message)
+    return state, message
 
 
 def _determine_os_workload_status(
@@ -1260,8 +1271,9 @@ def _check_running_services(services):
     @returns [(service, boolean), ...], : results for checks
              [boolean]                  : just the result of the service checks
     """
-    services_running = [service_running(s) for s in services]
-    return list(zip(services, services_running)), services_running
+    running = services_running(list(services))
+    states = [running[s] for s in services]
+    return list(zip(services, states)), states
 
 
 def _check_listening_on_services_ports(services, test=False):
@@ -1278,7 +1290,7 @@ def _check_listening_on_services_ports(services, test=False):
     """
     test = not(not(test))  # ensure test is True or False
     all_ports = list(itertools.chain(*services.values()))
-    ports_states = [port_has_listener('0.0.0.0', p) for p in all_ports]
+    ports_states = ports_have_listeners('0.0.0.0', all_ports)
     map_ports = OrderedDict()
     matched_ports = [p for p, opened in zip(all_ports, ports_states)
                      if opened == test]  # essentially opened xor test
@@ -1298,7 +1310,7 @@ def _check_listening_on_ports_list(ports):
     @param ports: LIST or port numbers.
     @returns [(port_num, boolean), ...], [boolean]
     """
-    ports_open = [port_has_listener('0.0.0.0', p) for p in ports]
+    ports_open = ports_have_listeners('0.0.0.0', ports)
     return zip(ports, ports_open), ports_open
 
 
@@ -1497,10 +1509,10 @@ def is_unit_paused_set():
     if it excepts, return False
     """
     try:
-        with unitdata.HookData()() as t:
-            kv = t[0]
-            # transform something truth-y into a Boolean.
-            return not(not(kv.get('unit-paused')))
+        # NOTE: read the flag directly, HookData() would record the complete
+        # relation data of the unit just to read a single key.
+        # transform something truth-y into a Boolean.
+        return not(not(unitdata.kv().get('unit-paused')))
     except Exception:
         return False
 
@@ -1991,10 +2003,10 @@ def is_unit_upgrading_set():
     if it excepts, return False
     """
     try:
-        with unitdata.HookData()() as t:
-            kv = t[0]
-            # transform something truth-y into a Boolean.
-            return not(not(kv.get('unit-upgrading')))
+        # NOTE: read the flag directly, HookData() would record the complete
+        # relation data of the unit just to read a single key.
+        # transform something truth-y into a Boolean.
+        return not(not(unitdata.kv().get('unit-upgrading')))
     except Exception:
         return False
 
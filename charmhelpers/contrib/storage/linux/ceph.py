@@ -25,7 +25,6 @@
 import collections
 import errno
 import hashlib
-import math
 import six
 
 import os
@@ -48,6 +47,8 @@ from charmhelpers.core.hookenv import (
     relation_get,
     relation_ids,
     relation_set,
+    relation_snapshot,
+    relation_snapshot_get,
     related_units,
     log,
     DEBUG,
@@ -70,6 +71,13 @@ from charmhelpers.fetch import (
 from charmhelpers.core.unitdata import kv
 
 from charmhelpers.core.kernel import modprobe
+from charmhelpers.contrib.storage.linux.ceph_client import get_client
+from charmhelpers.contrib.storage.linux.ceph_pgs import (
+    get_topology,
+    PGPlanner,
+    PoolSpec,
+    round_pgs,
+)
 from charmhelpers.contrib.openstack.utils import config_flags_parser
 
 KEYRING = '/etc/ceph/ceph.client.{}.keyring'
@@ -268,6 +276,13 @@ class BasePool(object):
         'compression-max-blob-size': (int, None),
         'compression-max-blob-size-hdd': (int, None),
         'compression-max-blob-size-ssd': (int, None),
+        'crush-profile': (str, None),
+        'max-bytes': (int, None),
+        'max-objects': (int, None),
+        'pg-autoscale-mode': (str, ('on', 'warn', 'off')),
+        'rbd-config': (dict, None),
+        'target-size-bytes': (int, None),
+        'target-size-ratio': (float, None),
     }
 
     def __init__(self, service, name=None, percent_data=None, app_name=None,
@@ -313,6 +328,8 @@ class BasePool(object):
         # Set defaults for these if they are not provided
         self.percent_data = self.percent_data or 10.0
         self.app_name = self.app_name or 'unknown'
+        # The pool as sized by get_pgs()
+        self.pg_spec = None
 
     def validate(self):
         """Check that value of supplied operation parameters are valid.
@@ -328,6 +345,11 @@ class BasePool(object):
                     # Normalize on ValueError, also add information about which
                     # variable we had an issue with.
                     raise ValueError("'{}': {}".format(op_key, str(e)))
+        for key, value in (self.op.get('rbd-config') or {}).items():
+            if not key.startswith('rbd_') or not isinstance(
+                    value, (six.string_types, int, float)):
+                raise ValueError("'rbd-config': invalid setting {}: {}"
+                                 .format(key, value))
 
     def _create(self):
         """Perform the pool creation, method MUST be overridden by child class.
@@ -343,15 +365,8 @@ class BasePool(object):
         Do not add calls for a specific pool type here, those should go into
         one of the pool specific classes.
         """
-        if self.nautilus_or_later:
-            # Ensure we set the expected pool ratio
-            update_pool(
-                client=self.service,
-                pool=self.name,
-                settings={
-                    'target_size_ratio': str(
-                        self.percent_data / 100.0),
-                })
+        # Ensure we set the expected pool size
+        self.set_autoscale(defaults=True)
         try:
             set_app_name_for_pool(client=self.service,
                                   pool=self.name,
@@ -360,13 +375,6 @@ class BasePool(object):
             log('Could not set app name for pool {}'
                 .format(self.name),
                 level=WARNING)
-        if 'pg_autoscaler' in enabled_manager_modules():
-            try:
-                enable_pg_autoscale(self.service, self.name)
-            except CalledProcessError as e:
-                log('Could not configure auto scaling for pool {}: {}'
-                    .format(self.name, e),
-                    level=WARNING)
 
     def create(self):
         """Create pool and perform any post pool creation tasks.
@@ -381,19 +389,97 @@ class BasePool(object):
         if not pool_exists(self.service, self.name):
             self.validate()
             self._create()
+            # Account for the new pool when sizing further pools of the hook
+            topology = get_topology(self.service)
+            if self.pg_spec is not None and topology is not None:
+                topology.note_pool(self.pg_spec)
             self._post_create()
             self.update()
 
     def set_quota(self):
-        """Set a quota if requested.
+        """Set the quotas of the pool if requested.
+
+        Only the quotas differing from the current ones are set, a quota of
+        0 removes the limit.
 
         :raises: CalledProcessError
         """
-        max_bytes = self.op.get('max-bytes')
-        max_objects = self.op.get('max-objects')
-        if max_bytes or max_objects:
+        quota = {field: self.op.get(key)
+                 for field, key in (('max_bytes', 'max-bytes'),
+                                    ('max_objects', 'max-objects'))
+                 if self.op.get(key) is not None}
+        if not quota:
+            return
+        current = get_pool_quota(self.service, self.name)
+        quota = {field: value for field, value in quota.items()
+                 if current.get(field) != value}
+        if quota:
             set_pool_quota(service=self.service, pool_name=self.name,
-                           max_bytes=max_bytes, max_objects=max_objects)
+                           **quota)
+
+    def set_rbd_config(self):
+        """Set the librbd options of the images of the pool if requested.
+
+        The options, e.g. the rbd_qos_* limits, are stored as pool level
+        configuration which takes precedence over the client configuration.
+        Only the options differing from their current value are set.
+
+        :raises: CalledProcessError
+        """
+        settings = self.op.get('rbd-config')
+        if not settings:
+            return
+        if not self.nautilus_or_later:
+            log('Pool level rbd configuration requires Nautilus, not '
+                'configuring pool {}'.format(self.name), level=WARNING)
+            return
+        current = get_rbd_pool_config(self.service, self.name)
+        settings = {key: str(value) for key, value in settings.items()
+                    if current.get(key) != str(value)}
+        if settings:
+            set_rbd_pool_config(self.service, self.name, settings)
+
+    def set_autoscale(self, defaults=False):
+        """Set the PG autoscaler properties of the pool if requested.
+
+        The expected size of the pool is given by target-size-bytes, or else
+        by target-size-ratio.  The autoscaler works on target-size-ratio
+        when both are set on a pool, so it is cleared when target-size-bytes
+        is requested.
+
+        :param defaults: Also apply the defaults for new pools: the weight as
+                         target ratio and autoscaling on when the
+                         pg_autoscaler manager module is enabled.
+        :type defaults: bool
+        """
+        if not self.nautilus_or_later:
+            return
+        target_bytes = self.op.get('target-size-bytes')
+        target_ratio = self.op.get('target-size-ratio')
+        if target_bytes:
+            settings = {'target_size_bytes': str(target_bytes),
+                        'target_size_ratio': '0'}
+        elif target_ratio is not None:
+            settings = {'target_size_ratio': str(target_ratio)}
+        elif defaults:
+            settings = {'target_size_ratio': str(self.percent_data / 100.0)}
+        else:
+            settings = {}
+        if settings:
+            update_pool(client=self.service, pool=self.name,
+                        settings=settings)
+
+        mode = self.op.get('pg-autoscale-mode')
+        if (mode is None and defaults and
+                'pg_autoscaler' in enabled_manager_modules()):
+            mode = 'on'
+        if mode:
+            try:
+                enable_pg_autoscale(self.service, self.name, mode=mode)
+            except CalledProcessError as e:
+                log('Could not configure auto scaling for pool {}: {}'
+                    .format(self.name, e),
+                    level=WARNING)
 
     def set_compression(self):
         """Set compression properties if requested.
@@ -424,7 +510,9 @@ class BasePool(object):
         """
         self.validate()
         self.set_quota()
+        self.set_rbd_config()
         self.set_compression()
+        self.set_autoscale()
 
     def add_cache_tier(self, cache_pool, mode):
         """Adds a new cache tier to an existing pool.
@@ -499,7 +587,7 @@ class BasePool(object):
                 'osd', 'tier', 'remove', self.name, cache_pool])
 
     def get_pgs(self, pool_size, percent_data=DEFAULT_POOL_WEIGHT,
-                device_class=None):
+                device_class=None, rule=None, root=None):
         """Return the number of placement groups to use when creating the pool.
 
         Returns the number of placement groups which should be specified when
@@ -513,15 +601,17 @@ class BasePool(object):
             ----------------------------------------
                          (Pool size)
 
-        Per the upstream guidelines, the OSD # should really be considered
-        based on the number of OSDs which are eligible to be selected by the
-        pool. Since the pool creation doesn't specify any of CRUSH set rules,
-        the default rule will be dependent upon the type of pool being
-        created (replicated or erasure).
+        Per the upstream guidelines, the OSD # is the number of OSDs which
+        are eligible to be selected by the pool, i.e. the OSDs below the
+        roots taken by its CRUSH rule, or the OSDs of device_class below root
+        for pools placed by an erasure profile.  The %Data of the pool is
+        scaled down when together with the target ratios of the pools
+        sharing its OSDs it exceeds the whole of the OSDs, see
+        ``charmhelpers.contrib.storage.linux.ceph_pgs``.  The cluster
+        topology is read once per hook.
 
-        This code makes no attempt to determine the number of OSDs which can be
-        selected for the specific rule, rather it is left to the user to tune
-        in the form of 'expected-osd-count' config option.
+        The 'expected-osd-count' config option applies to pools placed on
+        all OSDs of the cluster.
 
         :param pool_size: pool_size is either the number of replicas for
             replicated pools or the K+M sum for erasure coded pools
@@ -538,6 +628,11 @@ class BasePool(object):
             calculation; ceph supports nvme, ssd and hdd by default based
             on presence of devices of each type in the deployment.
         :type device_class: str
+        :param rule: CRUSH rule of the pool (default: the default rule).
+        :type rule: Optional[str]
+        :param root: CRUSH root to select the OSDs of device_class from
+            (default: 'default').
+        :type root: Optional[str]
         :returns: The number of pgs to use.
         :rtype: int
         """
@@ -551,56 +646,32 @@ class BasePool(object):
         if percent_data is None:
             percent_data = DEFAULT_POOL_WEIGHT
 
-        # If the expected-osd-count is specified, then use the max between
-        # the expected-osd-count and the actual osd_count
-        osd_list = get_osds(self.service, device_class)
         expected = config('expected-osd-count') or 0
-
-        if osd_list:
-            if device_class:
-                osd_count = len(osd_list)
-            else:
-                osd_count = max(expected, len(osd_list))
-
-            # Log a message to provide some insight if the calculations claim
-            # to be off because someone is setting the expected count and
-            # there are more OSDs in reality. Try to make a proper guess
-            # based upon the cluster itself.
-            if not device_class and expected and osd_count != expected:
-                log("Found more OSDs than provided expected count. "
-                    "Using the actual count instead", INFO)
-        elif expected:
-            # Use the expected-osd-count in older ceph versions to allow for
-            # a more accurate pg calculations
-            osd_count = expected
-        else:
-            # NOTE(james-page): Default to 200 for older ceph versions
-            # which don't support OSD query from cli
-            return LEGACY_PG_COUNT
-
-        percent_data /= 100.0
         target_pgs_per_osd = config(
             'pgs-per-osd') or DEFAULT_PGS_PER_OSD_TARGET
-        num_pg = (target_pgs_per_osd * osd_count * percent_data) // pool_size
-
-        # NOTE: ensure a sane minimum number of PGS otherwise we don't get any
-        #       reasonable data distribution in minimal OSD configurations
-        if num_pg < DEFAULT_MINIMUM_PGS:
-            num_pg = DEFAULT_MINIMUM_PGS
-
-        # The CRUSH algorithm has a slight optimization for placement groups
-        # with powers of 2 so find the nearest power of 2. If the nearest
-        # power of 2 is more than 25% below the original value, the next
-        # highest value is used. To do this, find the nearest power of 2 such
-        # that 2^n <= num_pg, check to see if its within the 25% tolerance.
-        exponent = math.floor(math.log(num_pg, 2))
-        nearest = 2 ** exponent
-        if (num_pg - nearest) > (num_pg * 0.25):
-            # Choose the next highest power of 2 since the nearest is more
-            # than 25% below the original value.
-            return int(nearest * 2)
-        else:
-            return int(nearest)
+        topology = get_topology(self.service)
+        if topology is not None and topology.osds:
+            planner = PGPlanner(topology, pgs_per_osd=target_pgs_per_osd,
+                                expected_osd_count=expected)
+            spec = PoolSpec(self.name, pool_size, percent_data, rule=rule,
+                            device_class=device_class, root=root)
+            entry, = planner.plan([spec])
+            log('Placement groups of pool {}:\n{}'.format(
+                self.name, planner.report([entry])), level=DEBUG)
+            if entry.pg_num is not None:
+                self.pg_spec = spec
+                return entry.pg_num
+            log('No OSDs found for pool {}'.format(self.name), WARNING)
+
+        if expected:
+            # Use the expected-osd-count in older ceph versions to allow for
+            # a more accurate pg calculations
+            return round_pgs(
+                (target_pgs_per_osd * expected * percent_data / 100.0) //
+                pool_size)
+        # NOTE(james-page): Default to 200 for older ceph versions
+        # which don't support OSD query from cli
+        return LEGACY_PG_COUNT
 
 
 class Pool(BasePool):
@@ -617,7 +688,8 @@ class Pool(BasePool):
 
 class ReplicatedPool(BasePool):
     def __init__(self, service, name=None, pg_num=None, replicas=None,
-                 percent_data=None, app_name=None, op=None):
+                 percent_data=None, app_name=None, op=None,
+                 crush_profile=None):
         """Initialize ReplicatedPool object.
 
         Pool information is either initialized from individual keyword
@@ -633,6 +705,10 @@ class ReplicatedPool(BasePool):
         :param replicas: Number of copies there should be of each object added
                          to this replicated pool.
         :type replicas: int
+        :param crush_profile: Name of the CRUSH rule to place the pool with,
+                              e.g. a rule restricted to a device class
+                              (default: the cluster's default rule).
+        :type crush_profile: Optional[str]
         :raises: KeyError
         """
         # NOTE: Do not perform initialization steps that require live data from
@@ -648,19 +724,28 @@ class ReplicatedPool(BasePool):
             # we will fail with KeyError if it is not provided.
             self.replicas = op['replicas']
             self.pg_num = op.get('pg_num')
+            self.crush_profile = op.get('crush-profile')
         else:
             self.replicas = replicas or 2
             self.pg_num = pg_num
+            self.crush_profile = crush_profile
 
     def _create(self):
         # Do extra validation on pg_num with data from live cluster
         if self.pg_num:
             # Since the number of placement groups were specified, ensure
             # that there aren't too many created.
-            max_pgs = self.get_pgs(self.replicas, 100.0)
+            max_pgs = self.get_pgs(self.replicas, 100.0,
+                                   rule=self.crush_profile)
             self.pg_num = min(self.pg_num, max_pgs)
+            # The pool takes its weight, not the whole of its OSDs, when
+            # sizing further pools.
+            if self.pg_spec is not None:
+                self.pg_spec = self.pg_spec._replace(
+                    weight=self.percent_data)
         else:
-            self.pg_num = self.get_pgs(self.replicas, self.percent_data)
+            self.pg_num = self.get_pgs(self.replicas, self.percent_data,
+                                       rule=self.crush_profile)
 
         # Create it
         if self.nautilus_or_later:
@@ -676,6 +761,8 @@ class ReplicatedPool(BasePool):
                 'ceph', '--id', self.service, 'osd', 'pool', 'create',
                 self.name, str(self.pg_num)
             ]
+        if self.crush_profile:
+            cmd.extend([str(self.pg_num), 'replicated', self.crush_profile])
         check_call(cmd)
 
     def _post_create(self):
@@ -746,7 +833,10 @@ class ErasurePool(BasePool):
 
         k = int(erasure_profile['k'])
         m = int(erasure_profile['m'])
-        pgs = self.get_pgs(k + m, self.percent_data)
+        pgs = self.get_pgs(
+            k + m, self.percent_data,
+            device_class=erasure_profile.get('crush-device-class'),
+            root=erasure_profile.get('crush-root'))
         self.nautilus_or_later = cmp_pkgrevno('ceph-common', '14.2.0') >= 0
         # Create it
         if self.nautilus_or_later:
@@ -790,18 +880,19 @@ def enabled_manager_modules():
     return modules['enabled_modules']
 
 
-def enable_pg_autoscale(service, pool_name):
+def enable_pg_autoscale(service, pool_name, mode='on'):
     """Enable Ceph's PG autoscaler for the specified pool.
 
     :param service: The Ceph user name to run the command under
     :type service: str
     :param pool_name: The name of the pool to enable sutoscaling on
     :type pool_name: str
+    :param mode: Autoscale mode, one of ('on', 'warn', 'off')
+    :type mode: str
     :raises: CalledProcessError if the command fails
     """
-    check_call([
-        'ceph', '--id', service,
-        'osd', 'pool', 'set', pool_name, 'pg_autoscale_mode', 'on'])
+    get_client(service).mon_command(
+        'osd pool set', pool_name, 'pg_autoscale_mode', mode, fmt=None)
 
 
 def get_mon_map(service):
@@ -815,10 +906,7 @@ def get_mon_map(service):
              ceph command fails.
     """
     try:
-        mon_status = check_output(['ceph', '--id', service,
-                                   'mon_status', '--format=json'])
-        if six.PY3:
-            mon_status = mon_status.decode('UTF-8')
+        mon_status = get_client(service).mon_command('mon_status')
         try:
             return json.loads(mon_status)
         except ValueError as v:
@@ -869,9 +957,7 @@ def monitor_key_delete(service, key):
     :raises: CalledProcessError
     """
     try:
-        check_output(
-            ['ceph', '--id', service,
-             'config-key', 'del', str(key)])
+        get_client(service).mon_command('config-key del', key, fmt=None)
     except CalledProcessError as e:
         log("Monitor config-key put failed with message: {}"
             .format(e.output))
@@ -890,9 +976,8 @@ def monitor_key_set(service, key, value):
     :raises: CalledProcessError
     """
     try:
-        check_output(
-            ['ceph', '--id', service,
-             'config-key', 'put', str(key), str(value)])
+        get_client(service).mon_command('config-key put', key, value,
+                                        fmt=None)
     except CalledProcessError as e:
         log("Monitor config-key put failed with message: {}"
             .format(e.output))
@@ -910,10 +995,8 @@ def monitor_key_get(service, key):
     :rtype: Optional[str]
     """
     try:
-        output = check_output(
-            ['ceph', '--id', service,
-             'config-key', 'get', str(key)]).decode('UTF-8')
-        return output
+        return get_client(service).mon_command('config-key get', key,
+                                               fmt=None)
     except CalledProcessError as e:
         log("Monitor config-key get failed with message: {}"
             .format(e.output))
@@ -932,9 +1015,7 @@ def monitor_key_exists(service, key):
     :raises: CalledProcessError if an unknown error occurs.
     """
     try:
-        check_call(
-            ['ceph', '--id', service,
-             'config-key', 'exists', str(key)])
+        get_client(service).mon_command('config-key exists', key, fmt=None)
         # I can return true here regardless because Ceph returns
         # ENOENT if the key wasn't found
         return True
@@ -958,11 +1039,8 @@ def get_erasure_profile(service, name):
     :rtype: Optional[Dict[str]]
     """
     try:
-        out = check_output(['ceph', '--id', service,
-                            'osd', 'erasure-code-profile', 'get',
-                            name, '--format=json'])
-        if six.PY3:
-            out = out.decode('UTF-8')
+        out = get_client(service).mon_command(
+            'osd erasure-code-profile get', name)
         return json.loads(out)
     except (CalledProcessError, OSError, ValueError):
         return None
@@ -981,10 +1059,8 @@ def pool_set(service, pool_name, key, value):
     :type value: str
     :raises: CalledProcessError
     """
-    cmd = [
-        'ceph', '--id', service,
-        'osd', 'pool', 'set', pool_name, key, str(value).lower()]
-    check_call(cmd)
+    get_client(service).mon_command(
+        'osd pool set', pool_name, key, str(value).lower(), fmt=None)
 
 
 def snapshot_pool(service, pool_name, snapshot_name):
@@ -1028,20 +1104,37 @@ def set_pool_quota(service, pool_name, max_bytes=None, max_objects=None):
     :type service: str
     :param pool_name: Name of pool
     :type pool_name: str
-    :param max_bytes: Maximum bytes quota to apply
-    :type max_bytes: int
-    :param max_objects: Maximum objects quota to apply
-    :type max_objects: int
+    :param max_bytes: Maximum bytes quota to apply, 0 for no limit
+    :type max_bytes: Optional[int]
+    :param max_objects: Maximum objects quota to apply, 0 for no limit
+    :type max_objects: Optional[int]
     :raises: subprocess.CalledProcessError
     """
-    cmd = [
-        'ceph', '--id', service,
-        'osd', 'pool', 'set-quota', pool_name]
-    if max_bytes:
-        cmd = cmd + ['max_bytes', str(max_bytes)]
-    if max_objects:
-        cmd = cmd + ['max_objects', str(max_objects)]
-    check_call(cmd)
+    commands = []
+    if max_bytes is not None:
+        commands.append(('osd pool set-quota', pool_name,
+                         'max_bytes', max_bytes))
+    if max_objects is not None:
+        commands.append(('osd pool set-quota', pool_name,
+                         'max_objects', max_objects))
+    get_client(service).mon_commands(commands, fmt=None)
+
+
+def get_pool_quota(service, pool_name):
+    """Return the quotas of a RADOS pool in Ceph.
+
+    :param service: The Ceph user name to run the command under
+    :type service: str
+    :param pool_name: Name of pool
+    :type pool_name: str
+    :returns: max_bytes and max_objects quotas, 0 for no limit
+    :rtype: Dict[str, int]
+    :raises: CalledProcessError
+    """
+    quota = json.loads(get_client(service).mon_command(
+        'osd pool get-quota', pool_name))
+    return {'max_bytes': quota.get('quota_max_bytes', 0),
+            'max_objects': quota.get('quota_max_objects', 0)}
 
 
 def remove_pool_quota(service, pool_name):
@@ -1053,10 +1146,8 @@ def remove_pool_quota(service, pool_name):
     :type pool_name: str
     :raises: CalledProcessError
     """
-    cmd = [
-        'ceph', '--id', service,
-        'osd', 'pool', 'set-quota', pool_name, 'max_bytes', '0']
-    check_call(cmd)
+    get_client(service).mon_command(
+        'osd pool set-quota', pool_name, 'max_bytes', '0', fmt=None)
 
 
 def remove_erasure_profile(service, profile_name):
@@ -1283,10 +1374,7 @@ def get_cache_mode(service, pool_name):
     """
     validator(value=service, valid_type=six.string_types)
     validator(value=pool_name, valid_type=six.string_types)
-    out = check_output(['ceph', '--id', service,
-                        'osd', 'dump', '--format=json'])
-    if six.PY3:
-        out = out.decode('UTF-8')
+    out = get_client(service).mon_command('osd dump')
     try:
         osd_json = json.loads(out)
         for pool in osd_json['pools']:
@@ -1300,14 +1388,10 @@ def get_cache_mode(service, pool_name):
 def pool_exists(service, name):
     """Check to see if a RADOS pool already exists."""
     try:
-        out = check_output(['rados', '--id', service, 'lspools'])
-        if six.PY3:
-            out = out.decode('UTF-8')
+        return name in get_client(service).list_pools()
     except CalledProcessError:
         return False
 
-    return name in out.split()
-
 
 def get_osds(service, device_class=None):
     """Return a list of all Ceph Object Storage Daemons currently in the
@@ -1317,20 +1401,40 @@ def get_osds(service, device_class=None):
     :type device_class: str
     """
     luminous_or_later = cmp_pkgrevno('ceph-common', '12.0.0') >= 0
+    client = get_client(service)
     if luminous_or_later and device_class:
-        out = check_output(['ceph', '--id', service,
-                            'osd', 'crush', 'class',
-                            'ls-osd', device_class,
-                            '--format=json'])
+        out = client.mon_command('osd crush class ls-osd', device_class)
     else:
-        out = check_output(['ceph', '--id', service,
-                            'osd', 'ls',
-                            '--format=json'])
-    if six.PY3:
-        out = out.decode('UTF-8')
+        out = client.mon_command('osd ls')
     return json.loads(out)
 
 
+def plan_request_pgs(service, rq, pgs_per_osd=None,
+                     expected_osd_count=None):
+    """Dry run of the placement group sizing of the pools of a request.
+
+    The pools are sized as a whole against the current cluster, as done by
+    BasePool.get_pgs() when the broker creates them.
+
+    :param service: The Ceph user name to read the cluster topology as.
+    :type service: str
+    :param rq: The request.
+    :type rq: CephBrokerRq
+    :param pgs_per_osd: Target placement groups per OSD.
+    :type pgs_per_osd: Optional[int]
+    :param expected_osd_count: OSDs the cluster is expected to grow to.
+    :type expected_osd_count: Optional[int]
+    :returns: Report of the plan, None if the topology cannot be read.
+    :rtype: Optional[str]
+    """
+    topology = get_topology(service)
+    if topology is None:
+        return None
+    planner = PGPlanner(topology, pgs_per_osd=pgs_per_osd,
+                        expected_osd_count=expected_osd_count)
+    return planner.report(planner.plan(rq.pool_specs()))
+
+
 def install():
     """Basic Ceph client installation."""
     ceph_dir = "/etc/ceph"
@@ -1360,6 +1464,41 @@ def create_rbd_image(service, pool, image, sizemb):
     check_call(cmd)
 
 
+def get_rbd_pool_config(service, pool):
+    """Return the librbd options in effect for the images of a pool.
+
+    :param service: The Ceph user name to run the command under
+    :type service: str
+    :param pool: Name of pool
+    :type pool: str
+    :returns: Option values by name
+    :rtype: Dict[str, str]
+    :raises: CalledProcessError
+    """
+    out = check_output(['rbd', '--id', service, 'config', 'pool', 'list',
+                        pool, '--format', 'json'])
+    if six.PY3:
+        out = out.decode('UTF-8')
+    return {option['name']: str(option['value'])
+            for option in json.loads(out)}
+
+
+def set_rbd_pool_config(service, pool, settings):
+    """Set pool level librbd options.
+
+    :param service: The Ceph user name to run the command under
+    :type service: str
+    :param pool: Name of pool
+    :type pool: str
+    :param settings: Option values by name, e.g. {'rbd_qos_iops_limit': 500}
+    :type settings: Dict[str, any]
+    :raises: CalledProcessError
+    """
+    for key, value in sorted(settings.items()):
+        check_call(['rbd', '--id', service, 'config', 'pool', 'set', pool,
+                    key, str(value)])
+
+
 def update_pool(client, pool, settings):
     """Update pool properties.
 
@@ -1371,9 +1510,9 @@ def update_pool(client, pool, settings):
     :type settings: Dict[str, str]
     :raises: CalledProcessError
     """
-    cmd = ['ceph', '--id', client, 'osd', 'pool', 'set', pool]
-    for k, v in six.iteritems(settings):
-        check_call(cmd + [k, v])
+    get_client(client).mon_commands(
+        [('osd pool set', pool, k, v) for k, v in six.iteritems(settings)],
+        fmt=None)
 
 
 def set_app_name_for_pool(client, pool, name):
@@ -1389,9 +1528,8 @@ def set_app_name_for_pool(client, pool, name):
     :raises: CalledProcessError if ceph call fails
     """
     if cmp_pkgrevno('ceph-common', '12.0.0') >= 0:
-        cmd = ['ceph', '--id', client, 'osd', 'pool',
-               'application', 'enable', pool, name]
-        check_call(cmd)
+        get_client(client).mon_command(
+            'osd pool application enable', pool, name, fmt=None)
 
 
 def create_pool(service, name, replicas=3, pg_num=None):
@@ -1489,7 +1627,8 @@ def get_ceph_nodes(relation='ceph'):
     hosts = []
     for r_id in relation_ids(relation):
         for unit in related_units(r_id):
-            hosts.append(relation_get('private-address', unit=unit, rid=r_id))
+            hosts.append(relation_snapshot_get('private-address', rid=r_id,
+                                               unit=unit))
 
     return hosts
 
@@ -1652,7 +1791,7 @@ def ensure_ceph_keyring(service, user=None, group=None,
     if not key:
         for rid in relation_ids(relation):
             for unit in related_units(rid):
-                key = relation_get('key', rid=rid, unit=unit)
+                key = relation_snapshot_get('key', rid=rid, unit=unit)
                 if key:
                     break
 
@@ -1667,6 +1806,16 @@ def ensure_ceph_keyring(service, user=None, group=None,
     return True
 
 
+def _canonical_op(op):
+    """Drop the keys of a broker request op which are set to None."""
+    return {k: v for k, v in op.items() if v is not None}
+
+
+def _canonical_json(data):
+    """Compact JSON encoding with sorted keys."""
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
 class CephBrokerRq(object):
     """Ceph broker request.
 
@@ -1767,7 +1916,11 @@ class CephBrokerRq(object):
                                         max_bytes=None,
                                         max_objects=None,
                                         namespace=None,
-                                        weight=None):
+                                        weight=None,
+                                        target_size_ratio=None,
+                                        target_size_bytes=None,
+                                        pg_autoscale_mode=None,
+                                        rbd_config=None):
         """Build common part of a create pool operation.
 
         :param app_name: Tag pool with application name. Note that there is
@@ -1830,11 +1983,25 @@ class CephBrokerRq(object):
                        Used to calculate number of Placement Groups to create
                        for pool.
         :type weight: Optional[float]
+        :param target_size_ratio: Share of the capacity of its OSDs the pool
+                                  is expected to use, for the PG autoscaler
+                                  (default: weight / 100).
+        :type target_size_ratio: Optional[float]
+        :param target_size_bytes: Amount of data the pool is expected to
+                                  hold, for the PG autoscaler. Takes the
+                                  place of target_size_ratio.
+        :type target_size_bytes: Optional[int]
+        :param pg_autoscale_mode: PG autoscale mode of the pool, one of:
+                                  ('on', 'warn', 'off')
+        :type pg_autoscale_mode: Optional[str]
+        :param rbd_config: Pool level librbd options applying to the images
+                           of the pool, e.g. the rbd_qos_* limits.
+        :type rbd_config: Optional[Dict[str, any]]
         :returns: Dictionary with kwarg name as key.
         :rtype: Dict[str,any]
         :raises: AssertionError
         """
-        return {
+        op = {
             'app-name': app_name,
             'compression-algorithm': compression_algorithm,
             'compression-mode': compression_mode,
@@ -1851,9 +2018,18 @@ class CephBrokerRq(object):
             'group-namespace': namespace,
             'weight': weight,
         }
+        # NOTE: only set when requested to leave the ops of existing requests
+        # unchanged.
+        for key, value in (('target-size-ratio', target_size_ratio),
+                           ('target-size-bytes', target_size_bytes),
+                           ('pg-autoscale-mode', pg_autoscale_mode),
+                           ('rbd-config', rbd_config)):
+            if value is not None:
+                op[key] = value
+        return op
 
     def add_op_create_replicated_pool(self, name, replica_count=3, pg_num=None,
-                                      **kwargs):
+                                      crush_profile=None, **kwargs):
         """Adds an operation to create a replicated pool.
 
         Refer to docstring for ``_partial_build_common_op_create`` for
@@ -1866,6 +2042,8 @@ class CephBrokerRq(object):
         :param pg_num: Request specific number of Placement Groups to create
                        for pool.
         :type pg_num: int
+        :param crush_profile: Name of the CRUSH rule to place the pool with.
+        :type crush_profile: Optional[str]
         :raises: AssertionError if provided data is of invalid type/range
         """
         if pg_num and kwargs.get('weight'):
@@ -1877,6 +2055,8 @@ class CephBrokerRq(object):
             'replicas': replica_count,
             'pg_num': pg_num,
         }
+        if crush_profile:
+            op['crush-profile'] = crush_profile
         op.update(self._partial_build_common_op_create(**kwargs))
 
         # Initialize Pool-object to validate type and range of ops.
@@ -1983,34 +2163,71 @@ class CephBrokerRq(object):
         """
         self.ops = ops
 
+    def pool_specs(self):
+        """Pools created by the request, to plan their placement groups.
+
+        Erasure-coded pools are only included when their erasure profile is
+        created by the request too.
+
+        :rtype: List[PoolSpec]
+        """
+        profiles = {op['name']: op for op in self.ops
+                    if op.get('op') == 'create-erasure-profile'}
+        specs = []
+        for op in self.ops:
+            if op.get('op') != 'create-pool':
+                continue
+            weight = op.get('weight') or DEFAULT_POOL_WEIGHT
+            if op.get('pool-type') == 'erasure':
+                profile = profiles.get(op.get('erasure-profile'), {})
+                if not (profile.get('k') and profile.get('m')):
+                    log('Cannot size pool {}, erasure profile {} unknown'
+                        .format(op['name'], op.get('erasure-profile')),
+                        level=DEBUG)
+                    continue
+                specs.append(PoolSpec(
+                    op['name'], profile['k'] + profile['m'], weight,
+                    device_class=profile.get('device-class')))
+            else:
+                specs.append(PoolSpec(op['name'], op['replicas'], weight,
+                                      rule=op.get('crush-profile')))
+        return specs
+
     @property
     def request(self):
         return json.dumps({'api-version': self.api_version, 'ops': self.ops,
                            'request-id': self.request_id})
 
+    @property
+    def canonical(self):
+        """Canonical encoding of the content of the request.
+
+        The request id is left out and so are op keys set to None, which
+        the broker treats like absent keys, so functionally equivalent
+        requests have the same encoding.
+
+        :rtype: str
+        """
+        return _canonical_json({
+            'api-version': self.api_version,
+            'ops': [_canonical_op(op) for op in self.ops]})
+
+    @property
+    def digest(self):
+        """Hex digest of the canonical encoding of the request.
+
+        :rtype: str
+        """
+        return hashlib.sha256(self.canonical.encode('UTF-8')).hexdigest()
+
     def _ops_equal(self, other):
-        keys_to_compare = [
-            'replicas', 'name', 'op', 'pg_num', 'group-permission',
-            'object-prefix-permissions',
-        ]
-        keys_to_compare += list(self._partial_build_common_op_create().keys())
-        if len(self.ops) == len(other.ops):
-            for req_no in range(0, len(self.ops)):
-                for key in keys_to_compare:
-                    if self.ops[req_no].get(key) != other.ops[req_no].get(key):
-                        return False
-        else:
-            return False
-        return True
+        return ([_canonical_op(op) for op in self.ops] ==
+                [_canonical_op(op) for op in other.ops])
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
-        if self.api_version == other.api_version and \
-                self._ops_equal(other):
-            return True
-        else:
-            return False
+        return self.digest == other.digest
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -2086,6 +2303,70 @@ class CephBrokerRsp(object):
 #      },
 #  }
 
+# unitdata key tracking, per relation id, the ops sent to the broker.
+BROKER_OPS_KEY = 'broker-ops.{}'
+# relation key holding the digest of the last request sent, see
+# CephBrokerRq.digest.
+BROKER_REQ_DIGEST_KEY = 'broker_req_digest'
+
+
+def get_broker_op_digest(op):
+    """Return a digest identifying the content of a broker request op.
+
+    :param op: Operation as added to a CephBrokerRq.
+    :type op: dict
+    :returns: Hex digest of the op.
+    :rtype: str
+    """
+    return hashlib.sha256(
+        _canonical_json(_canonical_op(op)).encode('UTF-8')).hexdigest()
+
+
+def get_broker_op_states(rid):
+    """Return the state of the ops sent to the broker on a given relation.
+
+    Ops are tracked by content, see get_broker_op_digest().  An op is
+    recorded with the id of the last request that carried it and is marked
+    complete once the broker reported success for that request.  Without
+    records, e.g. for requests sent before ops were tracked or when the unit
+    data was lost, the ops of the last request found in the relation data
+    are recorded.
+
+    :param rid: Relation id to query for op states
+    :type rid: str
+    :returns: {digest: {'request-id': str, 'complete': bool}}
+    :rtype: Dict[str, Dict[str, Union[str, bool]]]
+    """
+    db = kv()
+    key = BROKER_OPS_KEY.format(rid)
+    records = db.get(key)
+    updated = False
+    if records is None:
+        records = {}
+        previous_request = get_previous_request(rid)
+        if previous_request:
+            records = {
+                get_broker_op_digest(op): {
+                    'request-id': previous_request.request_id,
+                    'complete': False}
+                for op in previous_request.ops}
+            updated = True
+    completed = {}
+    for record in records.values():
+        if record['complete']:
+            continue
+        request_id = record['request-id']
+        if request_id not in completed:
+            completed[request_id] = is_request_id_complete_for_rid(
+                request_id, rid)
+        if completed[request_id]:
+            record['complete'] = True
+            updated = True
+    if updated:
+        db.set(key, records)
+    return records
+
+
 def get_previous_request(rid):
     """Return the last ceph broker request sent on a given relation
 
@@ -2094,8 +2375,8 @@ def get_previous_request(rid):
     :returns: CephBrokerRq object or None if relation data not found.
     :rtype: Optional[CephBrokerRq]
     """
-    broker_req = relation_get(attribute='broker_req', rid=rid,
-                              unit=local_unit())
+    broker_req = relation_snapshot_get('broker_req', rid=rid,
+                                       unit=local_unit())
     if broker_req:
         return CephBrokerRq(raw_request_data=broker_req)
 
@@ -2110,17 +2391,32 @@ def get_request_states(request, relation='ceph'):
 
     @param request: A CephBrokerRq object
     """
-    complete = []
     requests = {}
+    request_digest = request.digest
+    digests = [get_broker_op_digest(op) for op in request.ops]
     for rid in relation_ids(relation):
-        complete = False
-        previous_request = get_previous_request(rid)
-        if request == previous_request:
-            sent = True
-            complete = is_request_complete_for_rid(previous_request, rid)
+        records = get_broker_op_states(rid)
+        sent_digest = relation_snapshot_get(BROKER_REQ_DIGEST_KEY, rid=rid,
+                                            unit=local_unit())
+        if sent_digest:
+            # Records rebuilt from the last, partial, request miss the ops
+            # completed by earlier requests: these have to be sent again.
+            sent = (sent_digest == request_digest and
+                    all(digest in records for digest in digests))
         else:
-            sent = False
-            complete = False
+            # Request sent before digests were recorded: an op is sent if it
+            # completed or is part of the request waiting for the broker.
+            previous_request = get_previous_request(rid)
+            pending_id = (previous_request.request_id
+                          if previous_request else None)
+            sent = all(
+                digest in records and (
+                    records[digest]['complete'] or
+                    records[digest]['request-id'] == pending_id)
+                for digest in digests)
+        complete = all(
+            digest in records and records[digest]['complete']
+            for digest in digests)
 
         requests[rid] = {
             'sent': sent,
@@ -2167,12 +2463,22 @@ def is_request_complete_for_rid(request, rid):
     @param request: A CephBrokerRq object
     @param rid: Relation ID
     """
+    return is_request_id_complete_for_rid(request.request_id, rid)
+
+
+def is_request_id_complete_for_rid(request_id, rid):
+    """Check if the request with the given id has been completed on the given
+    relation
+
+    @param request_id: Id of a CephBrokerRq
+    @param rid: Relation ID
+    """
     broker_key = get_broker_rsp_key()
     for unit in related_units(rid):
-        rdata = relation_get(rid=rid, unit=unit)
+        rdata = relation_snapshot(rid=rid, unit=unit)
         if rdata.get(broker_key):
             rsp = CephBrokerRsp(rdata.get(broker_key))
-            if rsp.request_id == request.request_id:
+            if rsp.request_id == request_id:
                 if not rsp.exit_code:
                     return True
         else:
@@ -2206,16 +2512,47 @@ def get_broker_rsp_key():
 def send_request_if_needed(request, relation='ceph'):
     """Send broker request if an equivalent request has not already been sent
 
+    Only the ops of the request which have not been completed by the broker
+    yet are sent, see get_broker_op_states().  The ops are recorded as sent
+    in the unit kv store, which is only committed once the hook, including
+    the relation settings it buffered, completed.
+
     @param request: A CephBrokerRq object
     """
-    if is_request_sent(request, relation=relation):
-        log('Request already sent but not complete, not sending new request',
-            level=DEBUG)
-    else:
-        for rid in relation_ids(relation):
-            log('Sending request {}'.format(request.request_id), level=DEBUG)
-            relation_set(relation_id=rid, broker_req=request.request)
-            relation_set(relation_id=rid, relation_settings={'unit-name': local_unit()})
+    states = get_request_states(request, relation=relation)
+    db = kv()
+    for rid in relation_ids(relation):
+        if states[rid]['sent']:
+            log('Request already sent but not complete, not sending new '
+                'request', level=DEBUG)
+            continue
+        records = get_broker_op_states(rid)
+        ops = []
+        sent = {}
+        for op in request.ops:
+            digest = get_broker_op_digest(op)
+            if digest in records and records[digest]['complete']:
+                sent[digest] = records[digest]
+            else:
+                ops.append(op)
+                sent[digest] = {'request-id': request.request_id,
+                                'complete': False}
+        if ops:
+            delta = CephBrokerRq(api_version=request.api_version,
+                                 request_id=request.request_id)
+            delta.set_ops(ops)
+            log('Sending request {} ({}) with {} of {} ops'.format(
+                request.request_id, request.digest[:12], len(ops),
+                len(request.ops)), level=DEBUG)
+            relation_set(relation_id=rid, broker_req=delta.request)
+        else:
+            log('All ops of request {} already complete'.format(
+                request.digest[:12]), level=DEBUG)
+        relation_set(relation_id=rid, relation_settings={
+            'unit-name': local_unit(),
+            BROKER_REQ_DIGEST_KEY: request.digest})
+        # committed with the other writes of the hook when it completes
+        db.set(BROKER_OPS_KEY.format(rid), sent)
 
 
 def has_broker_rsp(rid=None, unit=None):
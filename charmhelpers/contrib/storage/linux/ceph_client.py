@@ -0,0 +1,379 @@
+# Copyright 2021 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Clients running Ceph monitor commands.
+
+The query and pool property helpers of
+:mod:`charmhelpers.contrib.storage.linux.ceph` talk to the monitors through
+the client returned by :func:`get_client`.  When the librados Python binding
+is installed, one cluster connection per Ceph user serves every command of
+the hook; otherwise each command runs the ``ceph`` CLI::
+
+    client = get_client('cinder-ceph')
+    pools = client.list_pools()
+    osd_dump = json.loads(client.mon_command('osd dump'))
+    client.mon_commands([('osd pool set', 'cinder-ceph', 'size', '3'),
+                         ('osd pool set', 'cinder-ceph', 'min_size', '2')],
+                        fmt=None)
+
+Hooks share the clients until the end of the hook.  Actions and other
+code not run by :class:`charmhelpers.core.hookenv.Hooks` close the clients
+they open with :func:`client_scope`::
+
+    with client_scope():
+        pools = get_client('cinder-ceph').list_pools()
+
+Tests can run the helpers against :class:`FakeMonClient` with
+:func:`set_client_factory`.
+"""
+
+import abc
+import contextlib
+import errno
+import json
+from subprocess import CalledProcessError, check_output
+
+import six
+
+from charmhelpers.core.hookenv import atexit, log, DEBUG
+
+CEPH_CONF_FILE = '/etc/ceph/ceph.conf'
+CONNECT_TIMEOUT = 30
+
+# Positional arguments of the monitor commands run through the clients, by
+# command prefix.
+MON_COMMAND_ARGS = {
+    'config-key del': ('key',),
+    'config-key exists': ('key',),
+    'config-key get': ('key',),
+    'config-key put': ('key', 'val'),
+    'mon_status': (),
+    'osd crush class ls-osd': ('class',),
+    'osd crush rule dump': (),
+    'osd dump': (),
+    'osd erasure-code-profile get': ('name',),
+    'osd ls': (),
+    'osd pool application enable': ('pool', 'app'),
+    'osd pool get-quota': ('pool',),
+    'osd pool set': ('pool', 'var', 'val'),
+    'osd pool set-quota': ('pool', 'field', 'val'),
+    'osd tree': (),
+}
+
+
+class CephCommandError(CalledProcessError):
+    """A monitor command failed, returncode is the (positive) errno."""
+    pass
+
+
+@six.add_metaclass(abc.ABCMeta)
+class CephClient(object):
+    """Run monitor commands as a Ceph user.
+
+    :param service: The Ceph user name to run the commands under.
+    :type service: str
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    @abc.abstractmethod
+    def mon_command(self, prefix, *args, **kwargs):
+        """Run a monitor command.
+
+        :param prefix: Command, one of MON_COMMAND_ARGS.
+        :type prefix: str
+        :param args: Positional arguments of the command.
+        :param fmt: Output format, 'json' by default, None for plain output.
+        :type fmt: Optional[str]
+        :returns: Output of the command.
+        :rtype: str
+        :raises: CalledProcessError
+        """
+
+    def mon_commands(self, commands, fmt='json'):
+        """Run several monitor commands, in order.
+
+        :param commands: (prefix, arg, ...) tuples.
+        :type commands: Iterable[Tuple[str, ...]]
+        :param fmt: Output format of the commands.
+        :type fmt: Optional[str]
+        :returns: Output of the commands.
+        :rtype: List[str]
+        :raises: CalledProcessError on the first failing command
+        """
+        return [self.mon_command(*command, fmt=fmt) for command in commands]
+
+    @abc.abstractmethod
+    def list_pools(self):
+        """Names of the pools in the cluster.
+
+        :rtype: List[str]
+        :raises: CalledProcessError
+        """
+
+    def shutdown(self):
+        """Release the resources held by the client."""
+        pass
+
+
+class CLICephClient(CephClient):
+    """Client running the ``ceph`` and ``rados`` CLIs."""
+
+    def mon_command(self, prefix, *args, **kwargs):
+        fmt = kwargs.get('fmt', 'json')
+        cmd = ['ceph', '--id', self.service]
+        cmd.extend(prefix.split())
+        cmd.extend(str(arg) for arg in args)
+        if fmt:
+            cmd.append('--format={}'.format(fmt))
+        out = check_output(cmd)
+        if six.PY3:
+            out = out.decode('UTF-8')
+        return out
+
+    def list_pools(self):
+        out = check_output(['rados', '--id', self.service, 'lspools'])
+        if six.PY3:
+            out = out.decode('UTF-8')
+        return out.split()
+
+
+class RadosCephClient(CephClient):
+    """Client sending the commands over a single librados connection.
+
+    :param service: The Ceph user name to connect as.
+    :type service: str
+    :param rados: The librados Python binding.
+    :type rados: module
+    :param conffile: Ceph configuration file.
+    :type conffile: str
+    :raises: rados.Error if the connection fails
+    """
+
+    def __init__(self, service, rados, conffile=CEPH_CONF_FILE):
+        super(RadosCephClient, self).__init__(service)
+        self._cluster = rados.Rados(rados_id=service, conffile=conffile)
+        self._cluster.connect(timeout=CONNECT_TIMEOUT)
+
+    def mon_command(self, prefix, *args, **kwargs):
+        fmt = kwargs.get('fmt', 'json')
+        cmd = {'prefix': prefix}
+        cmd.update(zip(MON_COMMAND_ARGS[prefix], (str(a) for a in args)))
+        if fmt:
+            cmd['format'] = fmt
+        ret, out, status = self._cluster.mon_command(json.dumps(cmd), b'')
+        if ret:
+            raise CephCommandError(-ret, cmd, status)
+        return out.decode('UTF-8')
+
+    def list_pools(self):
+        return self._cluster.list_pools()
+
+    def shutdown(self):
+        self._cluster.shutdown()
+
+
+class FakeMonClient(CephClient):
+    """In-memory stand-in for the monitors, for tests.
+
+    Commands are answered from the attributes, which may be set up by the
+    test, and recorded in ``commands``.
+    """
+
+    def __init__(self, service='admin', pools=None, osds=None,
+                 osd_classes=None, erasure_profiles=None, config_keys=None,
+                 mons=None, crush_nodes=None, crush_rules=None):
+        super(FakeMonClient, self).__init__(service)
+        # pool name -> properties as in 'osd dump'
+        self.pools = dict(pools or {})
+        self.osds = list(osds or [])
+        # device class -> OSD ids
+        self.osd_classes = dict(osd_classes or {})
+        # 'osd tree' nodes and 'osd crush rule dump' rules, by default all
+        # OSDs are below the root 'default' taken by 'replicated_rule'
+        self.crush_nodes = crush_nodes
+        self.crush_rules = crush_rules
+        self.erasure_profiles = dict(erasure_profiles or {})
+        self.config_keys = dict(config_keys or {})
+        self.mons = list(mons or ['juju-mon-0'])
+        self.commands = []
+
+    def mon_command(self, prefix, *args, **kwargs):
+        self.commands.append((prefix,) + args)
+        handler = getattr(self, '_' + prefix.replace(' ', '_').replace(
+            '-', '_'))
+        result = handler(*[str(arg) for arg in args])
+        if result is None:
+            return ''
+        if kwargs.get('fmt', 'json') == 'json' or not isinstance(
+                result, six.string_types):
+            return json.dumps(result)
+        return result
+
+    def list_pools(self):
+        return sorted(self.pools)
+
+    @staticmethod
+    def _enoent(what):
+        raise CephCommandError(errno.ENOENT, what, '{} not found'.format(what))
+
+    def _pool(self, pool):
+        if pool not in self.pools:
+            self._enoent(pool)
+        return self.pools[pool]
+
+    def _config_key_del(self, key):
+        self.config_keys.pop(key, None)
+
+    def _config_key_exists(self, key):
+        if key not in self.config_keys:
+            self._enoent(key)
+
+    def _config_key_get(self, key):
+        if key not in self.config_keys:
+            self._enoent(key)
+        return self.config_keys[key]
+
+    def _config_key_put(self, key, value):
+        self.config_keys[key] = value
+
+    def _mon_status(self):
+        return {'monmap': {'mons': [{'name': name} for name in self.mons]}}
+
+    def _osd_crush_class_ls_osd(self, device_class):
+        return self.osd_classes.get(device_class, [])
+
+    def _osd_crush_rule_dump(self):
+        if self.crush_rules is not None:
+            return self.crush_rules
+        return [{'rule_id': 0, 'rule_name': 'replicated_rule',
+                 'steps': [{'op': 'take', 'item': -1,
+                            'item_name': 'default'},
+                           {'op': 'chooseleaf_firstn', 'num': 0,
+                            'type': 'host'},
+                           {'op': 'emit'}]}]
+
+    def _osd_tree(self):
+        if self.crush_nodes is not None:
+            return {'nodes': self.crush_nodes, 'stray': []}
+        classes = {osd: device_class
+                   for device_class, osds in self.osd_classes.items()
+                   for osd in osds}
+        nodes = [{'id': -1, 'name': 'default', 'type': 'root',
+                  'children': list(self.osds)}]
+        for osd in self.osds:
+            node = {'id': osd, 'name': 'osd.{}'.format(osd), 'type': 'osd'}
+            if osd in classes:
+                node['device_class'] = classes[osd]
+            nodes.append(node)
+        return {'nodes': nodes, 'stray': []}
+
+    def _osd_dump(self):
+        return {'pools': [dict(properties, pool_name=name)
+                          for name, properties in sorted(self.pools.items())]}
+
+    def _osd_erasure_code_profile_get(self, name):
+        if name not in self.erasure_profiles:
+            self._enoent(name)
+        return self.erasure_profiles[name]
+
+    def _osd_ls(self):
+        return self.osds
+
+    def _osd_pool_application_enable(self, pool, app):
+        self._pool(pool).setdefault('application_metadata', {})[app] = {}
+
+    def _osd_pool_get_quota(self, pool):
+        properties = self._pool(pool)
+        return {'pool_name': pool,
+                'quota_max_objects': properties.get('quota_max_objects', 0),
+                'quota_max_bytes': properties.get('quota_max_bytes', 0)}
+
+    def _osd_pool_set(self, pool, var, val):
+        self._pool(pool)[var] = val
+
+    def _osd_pool_set_quota(self, pool, field, val):
+        self._pool(pool)['quota_{}'.format(field)] = int(val)
+
+
+def default_client_factory(service):
+    """Connect with librados if available, use the CLI otherwise.
+
+    :param service: The Ceph user name.
+    :type service: str
+    :rtype: CephClient
+    """
+    try:
+        import rados
+    except ImportError:
+        return CLICephClient(service)
+    try:
+        return RadosCephClient(service, rados)
+    except Exception as e:
+        log('Could not connect with librados, using the ceph CLI: {}'
+            .format(e), level=DEBUG)
+        return CLICephClient(service)
+
+
+_client_factory = default_client_factory
+_clients = {}
+
+
+def set_client_factory(factory=None):
+    """Set the factory producing the clients of get_client().
+
+    :param factory: Callable taking the Ceph user name and returning a
+                    CephClient, None for default_client_factory().
+    :type factory: Optional[Callable[[str], CephClient]]
+    """
+    global _client_factory
+    close_clients()
+    _client_factory = factory or default_client_factory
+
+
+def get_client(service):
+    """Client for the Ceph user service, shared for the rest of the hook.
+
+    :param service: The Ceph user name.
+    :type service: str
+    :rtype: CephClient
+    """
+    client = _clients.get(service)
+    if client is None:
+        if not _clients:
+            atexit(close_clients)
+        client = _clients[service] = _client_factory(service)
+    return client
+
+
+def close_clients():
+    """Shut down the clients handed out by get_client()."""
+    while _clients:
+        _, client = _clients.popitem()
+        client.shutdown()
+
+
+@contextlib.contextmanager
+def client_scope():
+    """Shut down the clients get_client() opens within the block.
+
+    Clients opened before the block are left open for their other users.
+    """
+    opened = set(_clients)
+    try:
+        yield
+    finally:
+        for service in set(_clients) - opened:
+            _clients.pop(service).shutdown()
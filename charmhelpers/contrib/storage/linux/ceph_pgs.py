@@ -0,0 +1,315 @@
+# Copyright 2021 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Placement group sizing against the CRUSH topology of the cluster.
+
+The number of placement groups of a pool follows the Ceph PG calculator:
+
+    (Target PGs per OSD) * (OSD #) * (%Data)
+    ----------------------------------------
+                 (Pool size)
+
+where the OSDs are the ones the CRUSH rule of the pool can select, and the
+share of data of the pools placed on the same OSDs is scaled down when
+together the pools claim more than the whole of the OSDs.  The topology is
+read once per hook::
+
+    topology = get_topology('admin')
+    planner = PGPlanner(topology, pgs_per_osd=100)
+    plan = planner.plan([
+        PoolSpec('fast', size=3, weight=10, rule='replicated_nvme'),
+        PoolSpec('bulk', size=6, weight=60, device_class='hdd')])
+    log(planner.report(plan))
+"""
+
+import collections
+import json
+import math
+from subprocess import CalledProcessError
+
+from charmhelpers.core.hookenv import log, DEBUG, WARNING
+from charmhelpers.contrib.storage.linux.ceph_client import (
+    client_scope,
+    get_client,
+)
+
+DEFAULT_PGS_PER_OSD_TARGET = 100
+DEFAULT_MINIMUM_PGS = 2
+DEFAULT_CRUSH_ROOT = 'default'
+
+
+class PoolSpec(collections.namedtuple(
+        'PoolSpec', 'name size weight rule device_class root')):
+    """A pool to size.
+
+    :param name: Name of the pool.
+    :type name: str
+    :param size: Replicas, or k+m for erasure-coded pools.
+    :type size: int
+    :param weight: Expected share of the data of its OSDs, in percent.
+    :type weight: float
+    :param rule: Name of the CRUSH rule of the pool, None for the default
+                 rule unless device_class is given.
+    :type rule: Optional[str]
+    :param device_class: Device class of the OSDs under root, for pools
+                         placed by an erasure profile.
+    :type device_class: Optional[str]
+    :param root: CRUSH root of the pool when device_class is given.
+    :type root: Optional[str]
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, name, size, weight, rule=None, device_class=None,
+                root=None):
+        return super(PoolSpec, cls).__new__(
+            cls, name, size, weight, rule, device_class, root)
+
+
+PGPlanEntry = collections.namedtuple(
+    'PGPlanEntry', 'name size osds ratio pg_num existing')
+
+
+def round_pgs(num_pg):
+    """Round a number of placement groups to a power of 2.
+
+    The nearest power of 2 below is used unless it is more than 25% below
+    num_pg, then the next one up is used.
+
+    :param num_pg: Number of placement groups.
+    :type num_pg: float
+    :rtype: int
+    """
+    num_pg = max(num_pg, DEFAULT_MINIMUM_PGS)
+    nearest = 2 ** int(math.floor(math.log(num_pg, 2)))
+    if (num_pg - nearest) > (num_pg * 0.25):
+        return int(nearest * 2)
+    return int(nearest)
+
+
+class ClusterTopology(object):
+    """Snapshot of the OSDs, CRUSH rules and pools of the cluster.
+
+    :param tree: Output of 'osd tree'.
+    :type tree: Dict[str, Any]
+    :param rules: Output of 'osd crush rule dump'.
+    :type rules: List[Dict[str, Any]]
+    :param osd_dump: Output of 'osd dump'.
+    :type osd_dump: Dict[str, Any]
+    """
+
+    def __init__(self, tree, rules, osd_dump):
+        self.nodes = {node['id']: node for node in tree.get('nodes', [])}
+        self.names = {node['name']: node['id']
+                      for node in self.nodes.values()}
+        self.rules = {rule['rule_name']: rule for rule in rules}
+        self.rule_names = {rule['rule_id']: rule['rule_name']
+                           for rule in rules}
+        # pool name -> (size, OSD ids, target ratio)
+        self.pools = {}
+        for pool in osd_dump.get('pools', []):
+            self.pools[pool['pool_name']] = (
+                pool.get('size'),
+                self.rule_osds(self.rule_names.get(pool.get('crush_rule'))),
+                (pool.get('options') or {}).get('target_size_ratio'))
+
+    @classmethod
+    def from_cluster(cls, service):
+        """Read the topology with one round of monitor commands.
+
+        :param service: The Ceph user name to run the commands under.
+        :type service: str
+        :rtype: ClusterTopology
+        :raises: CalledProcessError
+        """
+        tree, rules, osd_dump = get_client(service).mon_commands([
+            ('osd tree',), ('osd crush rule dump',), ('osd dump',)])
+        return cls(json.loads(tree), json.loads(rules), json.loads(osd_dump))
+
+    @property
+    def osds(self):
+        """Ids of all OSDs.
+
+        :rtype: FrozenSet[int]
+        """
+        return frozenset(node_id for node_id, node in self.nodes.items()
+                         if node.get('type') == 'osd')
+
+    def bucket_osds(self, bucket, device_class=None):
+        """OSDs below a CRUSH bucket.
+
+        :param bucket: Name of the bucket, 'root~class' names the class
+                       shadow of root.
+        :type bucket: str
+        :param device_class: Only OSDs of this device class.
+        :type device_class: Optional[str]
+        :rtype: FrozenSet[int]
+        """
+        if '~' in bucket:
+            bucket, device_class = bucket.split('~', 1)
+        if bucket not in self.names:
+            return frozenset()
+        osds = set()
+        pending = [self.names[bucket]]
+        while pending:
+            node = self.nodes.get(pending.pop())
+            if node is None:
+                continue
+            if node.get('type') == 'osd':
+                if (device_class is None or
+                        node.get('device_class') == device_class):
+                    osds.add(node['id'])
+            else:
+                pending.extend(node.get('children', []))
+        return frozenset(osds)
+
+    def rule_osds(self, rule):
+        """OSDs a CRUSH rule can select.
+
+        :param rule: Name of the rule, None for the first rule.
+        :type rule: Optional[str]
+        :rtype: FrozenSet[int]
+        """
+        if rule is None and self.rule_names:
+            rule = self.rule_names[min(self.rule_names)]
+        osds = set()
+        for step in self.rules.get(rule, {}).get('steps', []):
+            if step.get('op') == 'take':
+                osds.update(self.bucket_osds(step['item_name']))
+        return frozenset(osds)
+
+    def pool_osds(self, spec):
+        """OSDs the pool of a PoolSpec is placed on.
+
+        :type spec: PoolSpec
+        :rtype: FrozenSet[int]
+        """
+        if spec.rule or not spec.device_class:
+            return self.rule_osds(spec.rule)
+        return self.bucket_osds(spec.root or DEFAULT_CRUSH_ROOT,
+                                spec.device_class)
+
+    def note_pool(self, spec):
+        """Record a pool created after the snapshot was taken.
+
+        :type spec: PoolSpec
+        """
+        self.pools[spec.name] = (spec.size, self.pool_osds(spec),
+                                 spec.weight / 100.0)
+
+
+class PGPlanner(object):
+    """Size the placement groups of pools against a ClusterTopology.
+
+    :param topology: The cluster.
+    :type topology: ClusterTopology
+    :param pgs_per_osd: Target placement groups per OSD.
+    :type pgs_per_osd: Optional[int]
+    :param expected_osd_count: OSDs the cluster is expected to grow to,
+                               applies to pools placed on all OSDs.
+    :type expected_osd_count: Optional[int]
+    """
+
+    def __init__(self, topology, pgs_per_osd=None, expected_osd_count=None):
+        self.topology = topology
+        self.pgs_per_osd = pgs_per_osd or DEFAULT_PGS_PER_OSD_TARGET
+        self.expected_osd_count = expected_osd_count or 0
+
+    def plan(self, specs):
+        """Placement groups of new pools.
+
+        The target ratio of every pool is compared with the ratios of the
+        existing and planned pools sharing OSDs with it.  When these add up
+        to more than 1 the pool's ratio is scaled down accordingly.
+
+        :param specs: The pools to size.
+        :type specs: List[PoolSpec]
+        :rtype: List[PGPlanEntry]
+        """
+        # pool name -> (OSD ids, target ratio) of every pool competing for
+        # capacity, the planned pools replacing existing ones of that name
+        claims = {name: (osds, ratio or 0.0)
+                  for name, (_, osds, ratio) in self.topology.pools.items()}
+        planned = []
+        for spec in specs:
+            osds = self.topology.pool_osds(spec)
+            planned.append((spec, osds))
+            claims[spec.name] = (osds, spec.weight / 100.0)
+
+        plan = []
+        all_osds = self.topology.osds
+        for spec, osds in planned:
+            ratio = spec.weight / 100.0
+            total = sum(other_ratio for other_osds, other_ratio in
+                        claims.values() if other_osds & osds)
+            if total > 1.0:
+                ratio /= total
+            osd_count = len(osds)
+            if osds == all_osds:
+                osd_count = max(osd_count, self.expected_osd_count)
+            if osd_count:
+                pg_num = round_pgs(
+                    self.pgs_per_osd * osd_count * ratio / spec.size)
+            else:
+                pg_num = None
+            plan.append(PGPlanEntry(spec.name, spec.size, osd_count, ratio,
+                                    pg_num, spec.name in self.topology.pools))
+        return plan
+
+    @staticmethod
+    def report(plan):
+        """Render a plan as a table.
+
+        :type plan: List[PGPlanEntry]
+        :rtype: str
+        """
+        lines = ['{:<32} {:>5} {:>5} {:>7} {:>7}'.format(
+            'pool', 'size', 'osds', 'ratio', 'pg_num')]
+        for entry in plan:
+            lines.append('{:<32} {:>5} {:>5} {:>7.4f} {:>7}{}'.format(
+                entry.name, entry.size, entry.osds, entry.ratio,
+                entry.pg_num if entry.pg_num is not None else '-',
+                ' (exists)' if entry.existing else ''))
+        return '\n'.join(lines)
+
+
+_topologies = {}
+
+
+def get_topology(service):
+    """Topology of the cluster, read once per hook.
+
+    :param service: The Ceph user name to read the topology as.
+    :type service: str
+    :returns: The topology, None if it cannot be read.
+    :rtype: Optional[ClusterTopology]
+    """
+    if service not in _topologies:
+        try:
+            with client_scope():
+                _topologies[service] = ClusterTopology.from_cluster(service)
+        except (CalledProcessError, ValueError, KeyError) as e:
+            log('Could not read the cluster topology: {}'.format(e),
+                level=WARNING)
+            _topologies[service] = None
+        else:
+            log('Read the cluster topology: {} OSDs, {} CRUSH rules'.format(
+                len(_topologies[service].osds),
+                len(_topologies[service].rules)), level=DEBUG)
+    return _topologies[service]
+
+
+def reset_topology():
+    """Forget the topologies read by get_topology()."""
+    _topologies.clear()
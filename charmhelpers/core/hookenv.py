@@ -19,12 +19,12 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+import collections
 import copy
-from distutils.version import LooseVersion
 from enum import Enum
 from functools import wraps
-from collections import namedtuple
 import glob
+import inspect
 import os
 import json
 import yaml
@@ -33,6 +33,7 @@ import subprocess
 import sys
 import errno
 import tempfile
+import time
 from subprocess import CalledProcessError
 
 from charmhelpers import deprecate
@@ -66,7 +67,190 @@ class WORKLOAD_STATES(Enum):
     WAITING = 'waiting'
 
 
-cache = {}
+# Names of function parameters identifying a relation and a unit, used to
+# index cached results per relation so relation_set() can invalidate them.
+_CACHE_RELATION_PARAMS = ('rid', 'relid', 'relation_id', 'r_id')
+_CACHE_UNIT_PARAMS = ('unit',)
+
+
+class HookCache(object):
+    """Cache of function results for the duration of a hook.
+
+    Entries are keyed on a tuple of the function name and its arguments and
+    indexed by function name, by string argument and by (relation id, unit)
+    so that they can be invalidated without scanning the whole cache.
+
+    The cache is unbounded by default; when ``max_size`` is set the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        # key -> (function name, tokens, relation index key)
+        self._meta = {}
+        self._by_func = {}
+        self._by_token = {}
+        self._by_relation = {}
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __delitem__(self, key):
+        del self._data[key]
+        func_name, tokens, relation = self._meta.pop(key)
+        self._unindex(self._by_func, func_name, key)
+        for token in tokens:
+            self._unindex(self._by_token, token, key)
+        if relation:
+            self._unindex(self._by_relation, relation, key)
+
+    @staticmethod
+    def _unindex(index, name, key):
+        keys = index.get(name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[name]
+
+    def lookup(self, key):
+        """Get a cached value, maintaining LRU order and counters.
+
+        :raises: KeyError if the key is not cached.
+        """
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        if self.max_size:
+            self._data.move_to_end(key)
+        return value
+
+    def store(self, key, value, func_name, tokens=(), relation=None):
+        """Cache a value.
+
+        :param key: Hashable cache key.
+        :param value: Value to cache.
+        :param func_name: Name of the function the value was produced by.
+        :type func_name: str
+        :param tokens: String arguments the value was produced with.
+        :type tokens: Iterable[str]
+        :param relation: (relation id, unit) the value was read from.
+        :type relation: Optional[Tuple[Optional[str], str]]
+        """
+        if key in self._data:
+            del self[key]
+        tokens = frozenset(tokens)
+        self._data[key] = value
+        self._meta[key] = (func_name, tokens, relation)
+        self._by_func.setdefault(func_name, set()).add(key)
+        for token in tokens:
+            self._by_token.setdefault(token, set()).add(key)
+        if relation:
+            self._by_relation.setdefault(relation, set()).add(key)
+        if self.max_size:
+            while len(self._data) > self.max_size:
+                del self[next(iter(self._data))]
+                self.evictions += 1
+
+    def _flush_keys(self, keys):
+        for key in list(keys or ()):
+            if key in self._data:
+                del self[key]
+
+    def flush_function(self, func_name):
+        """Drop all cached results of a function."""
+        self._flush_keys(self._by_func.get(func_name))
+
+    def flush_token(self, token):
+        """Drop all cached results produced with ``token`` as an argument."""
+        self._flush_keys(self._by_token.get(token))
+
+    def flush_matching(self, text):
+        """Drop all cached results whose function name or arguments contain
+        ``text``.
+
+        Unlike the indexed flushes this scans the whole cache.
+        """
+        self._flush_keys([key for key in self._data
+                          if text in json.dumps(key, default=str)])
+
+    def flush_relation(self, rid, unit):
+        """Drop cached results read from ``unit``'s data on relation ``rid``.
+
+        Results cached without an explicit relation id refer to the current
+        relation and are dropped too.  When ``rid`` is None all results
+        produced for the unit are dropped.
+        """
+        if rid is None:
+            self.flush_token(unit)
+            return
+        self._flush_keys(self._by_relation.get((rid, unit)))
+        self._flush_keys(self._by_relation.get((None, unit)))
+
+    def clear(self):
+        """Drop all entries, counters are preserved."""
+        self._data.clear()
+        self._meta.clear()
+        self._by_func.clear()
+        self._by_token.clear()
+        self._by_relation.clear()
+
+    def stats(self):
+        """Cache statistics.
+
+        :rtype: Dict[str, int]
+        """
+        return {
+            'size': len(self._data),
+            'max-size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+cache = HookCache()
+
+
+def _cache_relation(signature, args, kwargs):
+    """Determine the (relation id, unit) a cached call reads from.
+
+    :returns: (rid, unit) or None if the call does not name a unit.
+    :rtype: Optional[Tuple[Optional[str], str]]
+    """
+    if signature is None:
+        return None
+    try:
+        bound = signature.bind(*args, **kwargs)
+    except TypeError:
+        return None
+    params = bound.arguments
+    unit = None
+    for name in _CACHE_UNIT_PARAMS:
+        unit = unit or params.get(name)
+    if not isinstance(unit, six.string_types):
+        return None
+    rid = None
+    for name in _CACHE_RELATION_PARAMS:
+        rid = rid or params.get(name)
+    if not isinstance(rid, six.string_types):
+        rid = None
+    return (rid, unit)
 
 
 def cached(func):
@@ -82,16 +266,32 @@ def cached(func):
 
     will cache the result of unit_get + 'test' for future calls.
     """
+    func_name = func.__name__
+    func_id = '{}.{}'.format(func.__module__, func_name)
+    try:
+        signature = inspect.signature(func)
+    except (TypeError, ValueError):
+        signature = None
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
+        key = (func_id, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable arguments, fall back to a serialized key.
+            key = (func_id, json.dumps((args, kwargs), sort_keys=True,
+                                       default=str))
         try:
-            return cache[key]
+            return cache.lookup(key)
         except KeyError:
             pass  # Drop out of the exception handler scope.
         res = func(*args, **kwargs)
-        cache[key] = res
+        tokens = [a for a in args if isinstance(a, six.string_types)]
+        tokens.extend(v for v in kwargs.values()
+                      if isinstance(v, six.string_types))
+        cache.store(key, res, func_name, tokens=tokens,
+                    relation=_cache_relation(signature, args, kwargs))
         return res
     wrapper._wrapped = func
     return wrapper
@@ -100,12 +300,14 @@ def cached(func):
 def flush(key):
     """Flushes any entries from function cache where the
     key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    cache.flush_matching(key)
+
+
+def flush_exact(key):
+    """Flushes any entries from function cache where the key is the name of
+    the function or one of its arguments"""
+    cache.flush_function(key)
+    cache.flush_token(key)
 
 
 def log(message, level=None):
@@ -459,6 +661,9 @@ def config(scope=None):
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    buffered = _buffered_relation_settings(rid, unit)
+    if buffered and attribute in buffered:
+        return buffered[attribute]
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -467,23 +672,135 @@ def relation_get(attribute=None, unit=None, rid=None):
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        data = json.loads(subprocess.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except CalledProcessError as e:
         if e.returncode == 2:
             return None
         raise
+    if not buffered or attribute:
+        return data
+    data = dict(data or {})
+    data.update(buffered)
+    return {k: v for k, v in data.items() if v is not None}
+
+
+def relation_snapshot(rid=None, unit=None):
+    """Get the complete relation data for a unit on a relation.
+
+    The data is fetched with a single ``relation-get`` execution and kept in
+    the hook cache, so any number of attribute lookups for the same unit and
+    relation are answered from memory.  The cached data is flushed by
+    :func:`relation_set` when the local unit writes to the relation.
+
+    The returned dictionary is shared with other callers and must be treated
+    as read-only.
+
+    :param rid: Relation id, defaults to the current relation.
+    :type rid: Optional[str]
+    :param unit: Unit name, defaults to the current remote unit.
+    :type unit: Optional[str]
+    :returns: Relation data for the unit.
+    :rtype: Dict[str, str]
+    """
+    return relation_get(rid=rid, unit=unit) or {}
+
+
+def relation_snapshot_get(attribute, rid=None, unit=None):
+    """Get a single relation attribute through :func:`relation_snapshot`.
+
+    Behaves like ``relation_get(attribute, unit=unit, rid=rid)`` but reads
+    from the unit's relation data snapshot instead of executing a
+    ``relation-get`` per attribute.
+
+    :param attribute: Name of the relation attribute.
+    :type attribute: str
+    :param rid: Relation id, defaults to the current relation.
+    :type rid: Optional[str]
+    :param unit: Unit name, defaults to the current remote unit.
+    :type unit: Optional[str]
+    :returns: Value of the attribute or None if not set.
+    :rtype: Optional[str]
+    """
+    return relation_snapshot(rid=rid, unit=unit).get(attribute)
+
+
+RELATION_SET_FILE_KEY = 'hookenv.relation-set-accepts-file'
+
+# Settings buffered by relation_set() by relation id, see
+# buffer_relation_settings(); None when relation_set() writes immediately.
+_relation_settings_buffer = None
+# Whether relation-set supports --file, by Juju version.
+_relation_set_accepts_file = {}
+
+
+def relation_set_accepts_file():
+    """Whether relation-set supports the --file option.
+
+    The answer is probed with ``relation-set --help`` once per process and,
+    when the Juju version is known, kept in the unit kv store so that later
+    hooks run by the same Juju version do not probe again.
+
+    :rtype: bool
+    """
+    version = os.environ.get('JUJU_VERSION')
+    if version not in _relation_set_accepts_file:
+        accepts_file = None
+        if version:
+            from charmhelpers.core import unitdata
+            known = unitdata.kv().get(RELATION_SET_FILE_KEY) or {}
+            accepts_file = known.get(version)
+        if accepts_file is None:
+            accepts_file = "--file" in subprocess.check_output(
+                ['relation-set', '--help'], universal_newlines=True)
+            if version:
+                # committed with the other writes of the hook when it
+                # completes, see Hooks.execute()
+                unitdata.kv().set(RELATION_SET_FILE_KEY,
+                                  {version: accepts_file})
+        _relation_set_accepts_file[version] = accepts_file
+    return _relation_set_accepts_file[version]
+
+
+def buffer_relation_settings():
+    """Buffer relation_set() calls until the end of the hook.
+
+    Settings for the same relation accumulate and are written with a single
+    relation-set per relation by flush_relation_settings(), which is
+    scheduled with atexit().  relation_get() of the local unit's data
+    returns the buffered settings in the meantime.  Juju only publishes
+    relation settings once a hook succeeds, so buffering does not change
+    what the remote units see.
+    """
+    global _relation_settings_buffer
+    if _relation_settings_buffer is None:
+        _relation_settings_buffer = collections.OrderedDict()
+        atexit(flush_relation_settings)
+
+
+def flush_relation_settings():
+    """Write the settings buffered since buffer_relation_settings().
+
+    relation_set() writes immediately afterwards.
+    """
+    global _relation_settings_buffer
+    pending, _relation_settings_buffer = _relation_settings_buffer, None
+    for rid, settings in (pending or {}).items():
+        _relation_set(rid, settings)
+
+
+def _buffered_relation_settings(rid, unit):
+    """Settings buffered for unit's data on relation rid, if any."""
+    if not _relation_settings_buffer or unit != local_unit():
+        return None
+    return _relation_settings_buffer.get(
+        rid or os.environ.get('JUJU_RELATION_ID'))
 
 
 def relation_set(relation_id=None, relation_settings=None, **kwargs):
     """Set relation information for the current unit"""
     relation_settings = relation_settings if relation_settings else {}
-    relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
-        relation_cmd_line + ["--help"], universal_newlines=True)
-    if relation_id is not None:
-        relation_cmd_line.extend(('-r', relation_id))
     settings = relation_settings.copy()
     settings.update(kwargs)
     for key, value in settings.items():
@@ -491,7 +808,20 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # sites pass in things like dicts or numbers.
         if value is not None:
             settings[key] = "{}".format(value)
-    if accepts_file:
+    if _relation_settings_buffer is not None:
+        rid = relation_id or os.environ.get('JUJU_RELATION_ID')
+        _relation_settings_buffer.setdefault(rid, {}).update(settings)
+    else:
+        _relation_set(relation_id, settings)
+    # Flush cache of any relation-gets for local unit on this relation
+    cache.flush_relation(relation_id, local_unit())
+
+
+def _relation_set(relation_id, settings):
+    relation_cmd_line = ['relation-set']
+    if relation_id is not None:
+        relation_cmd_line.extend(('-r', relation_id))
+    if relation_set_accepts_file():
         # --file was introduced in Juju 1.23.2. Use it by default if
         # available, since otherwise we'll break if the relation data is
         # too big. Ideally we should tell relation-set to read the data from
@@ -508,8 +838,6 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
         subprocess.check_call(relation_cmd_line)
-    # Flush cache of any relation-gets for local unit
-    flush(local_unit())
 
 
 def relation_clear(r_id=None):
@@ -611,7 +939,8 @@ def expected_related_units(reltype=None):
 def relation_for_unit(unit=None, rid=None):
     """Get the json represenation of a unit's relation"""
     unit = unit or remote_unit()
-    relation = relation_get(unit=unit, rid=rid)
+    # NOTE: copy the cached relation data, it is shared with other callers.
+    relation = dict(relation_snapshot(unit=unit, rid=rid))
     for key in relation:
         if key.endswith('-list'):
             relation[key] = relation[key].split()
@@ -783,10 +1112,10 @@ def is_relation_made(relation, keys='private-address'):
         keys = [keys]
     for r_id in relation_ids(relation):
         for unit in related_units(r_id):
+            rdata = relation_snapshot(rid=r_id, unit=unit)
             context = {}
             for k in keys:
-                context[k] = relation_get(k, rid=r_id,
-                                          unit=unit)
+                context[k] = rdata.get(k)
             if None not in context.values():
                 return True
     return False
@@ -896,6 +1225,281 @@ def storage_list(storage_name=None):
         raise
 
 
+# Opt-in profiling of the external commands executed during a hook.
+#
+# Profiling is enabled when the HOOK_PROFILE_ENV environment variable is set,
+# or when the HOOK_PROFILE_MARKER file exists in the charm directory.  The
+# environment variable may hold the directory to write profiles to; profiles
+# are otherwise written to HOOK_PROFILE_DIR in the charm directory.
+HOOK_PROFILE_ENV = 'CHARM_HOOK_PROFILE'
+HOOK_PROFILE_BUDGET_ENV = 'CHARM_HOOK_PROFILE_BUDGET'
+HOOK_PROFILE_MARKER = '.hook-profile'
+HOOK_PROFILE_DIR = '.hook-profiles'
+HOOK_PROFILE_TOP_N = 10
+
+# Commands that multiplex sub-commands, their first positional argument is
+# part of the command class.
+_PROFILE_MULTIPLEXED_COMMANDS = (
+    'apt-get', 'ceph', 'dpkg', 'rados', 'rbd', 'systemctl', 'service',
+)
+_PROFILE_OPTIONS_WITH_VALUE = (
+    '--id', '-n', '--name', '--user', '-c', '--conf', '--cluster', '-k',
+    '--keyring', '-f', '--format', '-p', '--pool',
+)
+
+_hook_profile = None
+_unprofiled_popen = subprocess.Popen
+
+
+def _command_class(args):
+    """Classify a command line for profiling.
+
+    Only the command name, and the sub-command for commands that multiplex
+    them, is kept so that no secrets passed as arguments end up in profiles.
+
+    :param args: Command line as passed to ``subprocess.Popen``.
+    :type args: Union[str, List[str]]
+    :returns: Command class, e.g. 'relation-get' or 'ceph osd'.
+    :rtype: str
+    """
+    if isinstance(args, (six.string_types, bytes)):
+        args = args.split()
+    args = [a.decode('UTF-8') if isinstance(a, bytes) else str(a)
+            for a in args]
+    if not args:
+        return ''
+    cmd = os.path.basename(args[0])
+    if cmd in _PROFILE_MULTIPLEXED_COMMANDS:
+        skip = False
+        for arg in args[1:]:
+            if skip:
+                skip = False
+            elif arg in _PROFILE_OPTIONS_WITH_VALUE:
+                skip = True
+            elif not arg.startswith('-'):
+                return '{} {}'.format(cmd, arg)
+    return cmd
+
+
+class HookProfile(object):
+    """Record of the external commands executed during a hook."""
+
+    def __init__(self, path=None, budget=None):
+        self.path = path
+        self.budget = budget
+        self.started = time.time()
+        self.records = []
+
+    def record(self, args):
+        """Start a record for an external command.
+
+        :param args: Command line as passed to ``subprocess.Popen``.
+        :type args: Union[str, List[str]]
+        :returns: The record, updated by the caller once the command ends.
+        :rtype: Dict[str, any]
+        """
+        entry = {
+            'command': _command_class(args),
+            'duration': None,
+            'exit-code': None,
+            'output-bytes': 0,
+        }
+        self.records.append(entry)
+        return entry
+
+    def summary(self, top=HOOK_PROFILE_TOP_N):
+        """Aggregate records per command class.
+
+        :param top: Number of command classes to return.
+        :type top: int
+        :returns: Command classes ordered by total duration, descending.
+        :rtype: List[Dict[str, any]]
+        """
+        totals = {}
+        for entry in self.records:
+            agg = totals.setdefault(entry['command'], {
+                'command': entry['command'],
+                'count': 0,
+                'duration': 0.0,
+                'max-duration': 0.0,
+                'failures': 0,
+                'output-bytes': 0,
+            })
+            duration = entry['duration'] or 0.0
+            agg['count'] += 1
+            agg['duration'] += duration
+            agg['max-duration'] = max(agg['max-duration'], duration)
+            agg['output-bytes'] += entry['output-bytes']
+            if entry['exit-code']:
+                agg['failures'] += 1
+        return sorted(totals.values(),
+                      key=lambda agg: agg['duration'], reverse=True)[:top]
+
+    def as_dict(self, hook):
+        """Profile in a form suitable for serialization.
+
+        :param hook: Name of the hook that was profiled.
+        :type hook: str
+        :rtype: Dict[str, any]
+        """
+        return {
+            'hook': hook,
+            'unit': os.environ.get('JUJU_UNIT_NAME'),
+            'started': self.started,
+            'duration': time.time() - self.started,
+            'command-count': len(self.records),
+            'command-duration': sum(e['duration'] or 0.0
+                                    for e in self.records),
+            'budget': self.budget,
+            'summary': self.summary(top=len(self.records)),
+            'commands': self.records,
+        }
+
+
+class _ProfiledPopen(_unprofiled_popen):
+    """``subprocess.Popen`` recording each command in the hook profile.
+
+    ``subprocess.call``, ``check_call``, ``check_output`` and ``run`` all
+    create their process through the module level ``Popen`` name, so
+    replacing it covers every helper regardless of how it was imported.
+    """
+
+    def __init__(self, args, *pargs, **kwargs):
+        self._profile_start = time.time()
+        self._profile_entry = (_hook_profile.record(args)
+                               if _hook_profile else None)
+        try:
+            super(_ProfiledPopen, self).__init__(args, *pargs, **kwargs)
+        except OSError as e:
+            self._profile_done(-e.errno if e.errno else -1)
+            raise
+
+    def _profile_done(self, exit_code):
+        if self._profile_entry and self._profile_entry['duration'] is None:
+            self._profile_entry['duration'] = (
+                time.time() - self._profile_start)
+            self._profile_entry['exit-code'] = exit_code
+
+    def wait(self, *args, **kwargs):
+        ret = super(_ProfiledPopen, self).wait(*args, **kwargs)
+        self._profile_done(ret)
+        return ret
+
+    def communicate(self, *args, **kwargs):
+        output = super(_ProfiledPopen, self).communicate(*args, **kwargs)
+        if self._profile_entry:
+            self._profile_entry['output-bytes'] += sum(
+                len(o) for o in output if o)
+        return output
+
+
+def hook_profile_requested():
+    """Whether profiling of hook commands was requested for this unit.
+
+    :rtype: bool
+    """
+    if os.environ.get(HOOK_PROFILE_ENV):
+        return True
+    _charm_dir = charm_dir()
+    return bool(_charm_dir and os.path.exists(
+        os.path.join(_charm_dir, HOOK_PROFILE_MARKER)))
+
+
+def enable_hook_profile(path=None, budget=None):
+    """Start recording the external commands executed by this process.
+
+    :param path: Directory to write the profile to, defaults to the
+                 directory named in the HOOK_PROFILE_ENV environment variable
+                 or HOOK_PROFILE_DIR in the charm directory.
+    :type path: Optional[str]
+    :param budget: Number of commands above which a warning is logged,
+                   defaults to the HOOK_PROFILE_BUDGET_ENV environment
+                   variable.
+    :type budget: Optional[int]
+    """
+    global _hook_profile
+    if path is None:
+        path = os.environ.get(HOOK_PROFILE_ENV, '')
+        if not os.path.isabs(path):
+            path = os.path.join(charm_dir() or os.getcwd(), HOOK_PROFILE_DIR)
+    if budget is None and os.environ.get(HOOK_PROFILE_BUDGET_ENV):
+        try:
+            budget = int(os.environ[HOOK_PROFILE_BUDGET_ENV])
+        except ValueError:
+            # Profiling must never fail the hook.
+            log('Ignoring invalid {} value: {!r}'.format(
+                HOOK_PROFILE_BUDGET_ENV, os.environ[HOOK_PROFILE_BUDGET_ENV]),
+                level=WARNING)
+    _hook_profile = HookProfile(path=path, budget=budget)
+    subprocess.Popen = _ProfiledPopen
+
+
+def disable_hook_profile():
+    """Stop recording external commands.
+
+    :returns: The profile recorded so far, if any.
+    :rtype: Optional[HookProfile]
+    """
+    global _hook_profile
+    profile = _hook_profile
+    _hook_profile = None
+    if subprocess.Popen is _ProfiledPopen:
+        subprocess.Popen = _unprofiled_popen
+    return profile
+
+
+def write_hook_profile(hook):
+    """Stop profiling, write the profile and log a top-N summary.
+
+    The profile is written as JSON to ``<path>/<hook>-<timestamp>.json``.
+
+    :param hook: Name of the hook that was profiled.
+    :type hook: str
+    :returns: Path to the written profile or None if profiling was disabled.
+    :rtype: Optional[str]
+    """
+    profile = disable_hook_profile()
+    if profile is None:
+        return None
+    data = profile.as_dict(hook)
+    filename = os.path.join(
+        profile.path, '{}-{}.json'.format(hook, int(profile.started)))
+    try:
+        if not os.path.isdir(profile.path):
+            os.makedirs(profile.path)
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=2)
+    except (IOError, OSError) as e:
+        # Profiling must never fail the hook.
+        log('Unable to write hook profile {}: {}'.format(filename, e),
+            level=WARNING)
+        filename = None
+    top = ', '.join(
+        '{} x{} {:.3f}s'.format(agg['command'], agg['count'], agg['duration'])
+        for agg in data['summary'][:HOOK_PROFILE_TOP_N])
+    log('Hook profile for {}: {} commands took {:.3f}s of {:.3f}s; top: {} '
+        '(written to {})'.format(hook, data['command-count'],
+                                 data['command-duration'], data['duration'],
+                                 top, filename),
+        level=DEBUG)
+    if profile.budget is not None and data['command-count'] > profile.budget:
+        log('Hook {} executed {} commands, over the budget of {}'
+            .format(hook, data['command-count'], profile.budget),
+            level=WARNING)
+    return filename
+
+
+def _commit_unit_state():
+    """Commit the writes of the hook to the unit kv store, if it was opened.
+
+    Helpers recording state in the unit kv store during the hook leave the
+    commit to the end of a successful hook, a failed hook commits nothing.
+    """
+    from charmhelpers.core import unitdata
+    if unitdata._KV is not None and not unitdata._KV.revision:
+        unitdata._KV.flush()
+
+
 class UnregisteredHookError(Exception):
     """Raised when an undefined hook is called"""
     pass
@@ -937,17 +1541,26 @@ class Hooks(object):
         self._hooks[name] = function
 
     def execute(self, args):
-        """Execute a registered hook based on args[0]"""
+        """Execute a registered hook based on args[0]
+
+        When hook profiling is enabled the profile of the external commands
+        executed so far is written on exit, see :func:`write_hook_profile`.
+        """
         _run_atstart()
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
             try:
-                self._hooks[hook_name]()
-            except SystemExit as x:
-                if x.code is None or x.code == 0:
-                    _run_atexit()
-                raise
-            _run_atexit()
+                try:
+                    self._hooks[hook_name]()
+                except SystemExit as x:
+                    if x.code is None or x.code == 0:
+                        _run_atexit()
+                        _commit_unit_state()
+                    raise
+                _run_atexit()
+                _commit_unit_state()
+            finally:
+                write_hook_profile(hook_name)
         else:
             raise UnregisteredHookError(hook_name)
 
@@ -1290,6 +1903,9 @@ def juju_version():
 
 def has_juju_version(minimum_version):
     """Return True if the Juju version is at least the provided version"""
+    # NOTE: distutils pulls in setuptools, which is slow to import and only
+    # needed here.
+    from distutils.version import LooseVersion
     return LooseVersion(juju_version()) >= LooseVersion(minimum_version)
 
 
@@ -1437,7 +2053,7 @@ def iter_units_for_relation_name(relation_name):
     :param relation_name: string relation name
     :yield: Named Tuple with rid and unit field names
     """
-    RelatedUnit = namedtuple('RelatedUnit', 'rid, unit')
+    RelatedUnit = collections.namedtuple('RelatedUnit', 'rid, unit')
     for rid in relation_ids(relation_name):
         for unit in related_units(rid):
             yield RelatedUnit(rid, unit)
@@ -1611,3 +2227,7 @@ def _contains_range(addresses):
         addresses.startswith(".") or
         ",." in addresses or
         " ." in addresses)
+
+
+if hook_profile_requested():
+    enable_hook_profile()
@@ -28,14 +28,16 @@ import random
 import string
 import subprocess
 import hashlib
+import time
 import functools
 import itertools
 import six
 
 from contextlib import contextmanager
 from collections import OrderedDict
-from .hookenv import log, INFO, DEBUG, local_unit, charm_name
+from .hookenv import atexit, log, INFO, DEBUG, local_unit, charm_name
 from .fstab import Fstab
+from .unitdata import file_stamp, kv
 from charmhelpers.osplatform import get_platform
 
 __platform__ = get_platform()
@@ -308,6 +310,44 @@ def service_running(service_name, **kwargs):
         return False
 
 
+def services_running(service_names):
+    """Determine whether system services are running.
+
+    The state of all systemd services is queried with a single
+    ``systemctl show``, other services are checked with service_running().
+
+    :param service_names: names of the services
+    :type service_names: List[str]
+    :returns: whether each service is running
+    :rtype: Dict[str, bool]
+    """
+    running = {}
+    systemd = []
+    for service_name in service_names:
+        if init_is_systemd(service_name=service_name):
+            systemd.append(service_name)
+        else:
+            running[service_name] = service_running(service_name)
+    if systemd:
+        cmd = ['systemctl', 'show', '--property=ActiveState']
+        cmd.extend(systemd)
+        try:
+            output = subprocess.check_output(
+                cmd, universal_newlines=True).strip()
+        except subprocess.CalledProcessError:
+            output = ''
+        # one block per unit, in the order given
+        states = [block.strip().partition('=')[2]
+                  for block in output.split('\n\n')] if output else []
+        if len(states) == len(systemd):
+            for service_name, state in zip(systemd, states):
+                running[service_name] = state in ('active', 'reloading')
+        else:
+            for service_name in systemd:
+                running[service_name] = service_running(service_name)
+    return running
+
+
 SYSTEMD_SYSTEM = '/run/systemd/system'
 
 
@@ -565,6 +605,7 @@ def write_file(path, content, owner='root', group='root', perms=0o444):
             if six.PY3 and isinstance(content, six.string_types):
                 content = content.encode('UTF-8')
             target.write(content)
+        note_file_write(path, content)
         return
     # the contents were the same, but we might still need to change the
     # ownership or permissions.
@@ -643,21 +684,61 @@ def fstab_mount(mountpoint):
     return True
 
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(path, hash_type='md5'):
+    """Hash the content of path through a buffer of HASH_CHUNK_SIZE.
+
+    :raises: IOError/OSError if path can not be read.
+    """
+    h = getattr(hashlib, hash_type)()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as source:
+        for size in iter(functools.partial(source.readinto, buf), 0):
+            h.update(view[:size])
+    return h.hexdigest()
+
+
 def file_hash(path, hash_type='md5'):
     """Generate a hash checksum of the contents of 'path' or None if not found.
 
+    The file is read in chunks of HASH_CHUNK_SIZE, memory use does not
+    depend on its size.
+
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
                           such as md5, sha1, sha256, sha512, etc.
     """
     if os.path.exists(path):
-        h = getattr(hashlib, hash_type)()
-        with open(path, 'rb') as source:
-            h.update(source.read())
-        return h.hexdigest()
+        return _hash_file(path, hash_type)
     else:
         return None
 
 
+def file_hashes(paths, hash_type='md5', max_workers=1):
+    """Generate hash checksums of the contents of several files.
+
+    hashlib releases the GIL while hashing, with max_workers > 1 the files
+    are hashed in parallel by a pool of threads.
+
+    :param paths: the files to hash
+    :type paths: Iterable[str]
+    :param str hash_type: Any hash algorithm supported by :mod:`hashlib`.
+    :param int max_workers: Number of files hashed at the same time.
+    :return: dict: A { filename: hash } dictionary, hash is None for files
+                   that are not found.
+    """
+    paths = list(paths)
+    if max_workers > 1 and len(paths) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = executor.map(
+                functools.partial(file_hash, hash_type=hash_type), paths)
+            return dict(zip(paths, hashes))
+    return {path: file_hash(path, hash_type) for path in paths}
+
+
 def path_hash(path):
     """Generate a hash checksum of all files matching 'path'. Standard
     wildcards like '*' and '?' are supported, see documentation for the 'glob'
@@ -666,10 +747,7 @@ def path_hash(path):
     :return: dict: A { filename: hash } dictionary for all matched files.
                    Empty if none found.
     """
-    return {
-        filename: file_hash(filename)
-        for filename in glob.iglob(path)
-    }
+    return file_hashes(glob.iglob(path))
 
 
 def check_hash(path, checksum, hash_type='md5'):
@@ -692,7 +770,117 @@ class ChecksumError(ValueError):
     pass
 
 
-def restart_on_change(restart_map, stopstart=False, restart_functions=None):
+CHANGE_HASH_TYPE = 'md5'
+FILE_DIGESTS_KEY = 'host.file-digests'
+
+# digests of the content written by charmhelpers in this hook, by real path
+_file_writes = {}
+
+
+def note_file_write(path, content):
+    """Record that content was just written to path.
+
+    Writers that hold the content anyway let the change tracking of
+    restart_on_change() use its digest instead of reading the file back.
+
+    :param path: the file written
+    :type path: str
+    :param content: the content written
+    :type content: bytes
+    """
+    _file_writes[os.path.realpath(path)] = (
+        file_stamp(path),
+        getattr(hashlib, CHANGE_HASH_TYPE)(content).hexdigest())
+
+
+class FileChangeTracker(object):
+    """Detect changes of the files matching a set of glob patterns.
+
+    The (mtime_ns, size, inode) stamp of the files is compared first, the
+    content is only hashed when the stamp differs and no write of the file
+    was noted with note_file_write().  Digests are cached in the unit kv
+    store along with the stamp they were computed for, so a file whose
+    stamp did not move since an earlier hook is not read either.  They are
+    committed with the other writes of the hook when it completes.
+
+    :param paths: glob patterns of the files to track
+    :type paths: Iterable[str]
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._digests = kv().get(FILE_DIGESTS_KEY) or {}
+        # digests computed by this tracker, saved by changed()
+        self._computed = {}
+        self._started = int(time.time() * 1e9)
+        # only files without a usable cached digest are read here
+        self._before = {
+            path: {filename: (stamp, self._digest(filename, stamp))
+                   for filename, stamp in stamps.items()}
+            for path, stamps in self._snapshot().items()}
+
+    def _snapshot(self):
+        return {path: {filename: file_stamp(filename)
+                       for filename in glob.iglob(path)}
+                for path in self.paths}
+
+    def _trusted(self, stamp):
+        # a write in the same clock tick as the stamp may not move it
+        return stamp[0] < self._started
+
+    def _digest(self, filename, stamp):
+        """Digest of the content of filename, which is at stamp."""
+        if stamp is None:
+            return None
+        noted = _file_writes.get(os.path.realpath(filename))
+        cached = self._digests.get(filename)
+        if noted and noted[0] == stamp:
+            digest = noted[1]
+        elif cached and cached['stamp'] == stamp and self._trusted(stamp):
+            digest = cached['digest']
+        else:
+            try:
+                digest = _hash_file(filename, CHANGE_HASH_TYPE)
+            except (IOError, OSError):
+                return None
+        self._digests[filename] = self._computed[filename] = {
+            'stamp': stamp, 'digest': digest}
+        return digest
+
+    def changed(self):
+        """Glob patterns whose files changed since the tracker was created.
+
+        :rtype: List[str]
+        """
+        after = self._snapshot()
+        changed = []
+        for path in self.paths:
+            before, current = self._before[path], after[path]
+            for filename in set(before) | set(current):
+                old, digest = before.get(filename, (None, None))
+                new = current.get(filename)
+                if old == new and (old is None or self._trusted(old)):
+                    continue
+                if digest != self._digest(filename, new):
+                    changed.append(path)
+                    break
+        # other trackers of the hook may have saved digests meanwhile, only
+        # the ones of this tracker are replaced
+        db = kv()
+        digests = db.get(FILE_DIGESTS_KEY) or {}
+        digests.update(self._computed)
+        # digests of removed files, possibly tracked by other hooks, are
+        # dropped so the map does not keep growing
+        present = {filename for stamps in after.values()
+                   for filename, stamp in stamps.items() if stamp}
+        db.set(FILE_DIGESTS_KEY, {
+            filename: entry for filename, entry in digests.items()
+            if filename in present or os.path.exists(filename)})
+        return changed
+
+
+def restart_on_change(restart_map, stopstart=False, restart_functions=None,
+                      deferred=False):
     """Restart services based on configuration files changing
 
     This function is used a decorator, for example::
@@ -715,6 +903,8 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
     @param stopstart: DEFAULT false; whether to stop, start OR restart
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param deferred: DEFAULT false; restart at the end of the hook, once per
+                     service, see defer_restart()
     @returns result from decorated function
     """
     def wrap(f):
@@ -722,13 +912,13 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
         def wrapped_f(*args, **kwargs):
             return restart_on_change_helper(
                 (lambda: f(*args, **kwargs)), restart_map, stopstart,
-                restart_functions)
+                restart_functions, deferred)
         return wrapped_f
     return wrap
 
 
 def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
-                             restart_functions=None):
+                             restart_functions=None, deferred=False):
     """Helper function to perform the restart_on_change function.
 
     This is provided for decorators to restart services if files described
@@ -739,29 +929,85 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     @param stopstart: whether to stop, start or restart a service
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param deferred: whether to restart at the end of the hook, once per
+                     service, see defer_restart()
     @returns result of lambda_f()
     """
     if restart_functions is None:
         restart_functions = {}
-    checksums = {path: path_hash(path) for path in restart_map}
+    tracker = FileChangeTracker(restart_map)
     r = lambda_f()
     # create a list of lists of the services to restart
-    restarts = [restart_map[path]
-                for path in restart_map
-                if path_hash(path) != checksums[path]]
+    restarts = [restart_map[path] for path in tracker.changed()]
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
-    if services_list:
-        actions = ('stop', 'start') if stopstart else ('restart',)
-        for service_name in services_list:
-            if service_name in restart_functions:
-                restart_functions[service_name](service_name)
-            else:
-                for action in actions:
-                    service(action, service_name)
+    for service_name in services_list:
+        if deferred:
+            defer_restart(service_name, stopstart,
+                          restart_functions.get(service_name))
+        else:
+            _restart(service_name, stopstart,
+                     restart_functions.get(service_name))
     return r
 
 
+def _restart(service_name, stopstart=False, restart_function=None):
+    if restart_function:
+        restart_function(service_name)
+    else:
+        actions = ('stop', 'start') if stopstart else ('restart',)
+        for action in actions:
+            service(action, service_name)
+
+
+# restarts requested with defer_restart(), by service name
+_deferred_restarts = OrderedDict()
+
+
+def defer_restart(service_name, stopstart=False, restart_function=None):
+    """Restart a service once at the end of the hook.
+
+    Any number of requests for the same service within a hook result in a
+    single restart, performed by run_deferred_restarts() which is scheduled
+    with hookenv.atexit() on the first request.  Hook frameworks which do
+    not run the atexit callbacks must call run_deferred_restarts().
+
+    @param service_name: the service to restart
+    @param stopstart: whether to stop and start instead of restart; applies
+                      if any request for the service asks for it
+    @param restart_function: nonstandard function to restart the service
+    """
+    if not _deferred_restarts:
+        atexit(run_deferred_restarts)
+    request = _deferred_restarts.setdefault(
+        service_name, {'stopstart': False, 'restart_function': None,
+                       'requests': 0})
+    request['stopstart'] = request['stopstart'] or stopstart
+    request['restart_function'] = (restart_function or
+                                   request['restart_function'])
+    request['requests'] += 1
+    log('Restart of {} deferred to the end of the hook'.format(service_name),
+        level=DEBUG)
+
+
+def run_deferred_restarts():
+    """Perform the restarts requested with defer_restart().
+
+    @returns list of the restarted services
+    """
+    restarted = list(_deferred_restarts)
+    avoided = 0
+    while _deferred_restarts:
+        service_name, request = _deferred_restarts.popitem(last=False)
+        _restart(service_name, request['stopstart'],
+                 request['restart_function'])
+        avoided += request['requests'] - 1
+    if restarted:
+        log('Restarted {}; {} redundant restart(s) avoided'
+            .format(', '.join(restarted), avoided), level=INFO)
+    return restarted
+
+
 def pwgen(length=None):
     """Generate a random pasword."""
     if length is None:
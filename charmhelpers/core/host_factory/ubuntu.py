@@ -98,7 +98,10 @@ def cmp_pkgrevno(package, revno, pkgcache=None):
     """
     from charmhelpers.fetch import apt_pkg
     if not pkgcache:
-        from charmhelpers.fetch import apt_cache
+        from charmhelpers.fetch import apt_cache, get_installed_version
+        current_ver = get_installed_version(package)
+        if current_ver:
+            return apt_pkg.version_compare(current_ver, revno)
         pkgcache = apt_cache()
     pkg = pkgcache[package]
     return apt_pkg.version_compare(pkg.current_ver.ver_str, revno)
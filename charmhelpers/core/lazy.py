@@ -0,0 +1,131 @@
+# Copyright 2021 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deferred imports for hook entry points.
+
+Every hook of a charm executes the same module, which usually imports
+everything any of the hooks may need.  The helpers here allow a module to
+name the modules and symbols it uses without importing them until they are
+first used::
+
+    from charmhelpers.core.lazy import lazy_import
+
+    ceph = lazy_import('charmhelpers.contrib.storage.linux.ceph')
+    CephBrokerRq = lazy_import('charmhelpers.contrib.storage.linux.ceph',
+                               'CephBrokerRq')
+
+The returned proxies forward attribute access, calls, iteration and item
+access to the resolved object.  Use resolve() where the object itself is
+needed, e.g. for isinstance() checks.
+"""
+
+import importlib
+
+
+class LazyObject(object):
+    """Proxy for an object that is produced on first use.
+
+    :param factory: Callable returning the proxied object.
+    :type factory: Callable[[], Any]
+    :param name: Name of the object, used in repr() before it is resolved.
+    :type name: Optional[str]
+    """
+
+    __slots__ = ('_factory', '_name', '_resolved', '_object')
+
+    def __init__(self, factory, name=None):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_name', name or repr(factory))
+        object.__setattr__(self, '_resolved', False)
+        object.__setattr__(self, '_object', None)
+
+    def _resolve(self):
+        if not self._resolved:
+            object.__setattr__(self, '_object', self._factory())
+            object.__setattr__(self, '_resolved', True)
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __contains__(self, item):
+        return item in self._resolve()
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+    def __len__(self):
+        return len(self._resolve())
+
+    def __bool__(self):
+        return bool(self._resolve())
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        if self._resolved:
+            return repr(self._object)
+        return '<lazy {}>'.format(self._name)
+
+
+def resolve(obj):
+    """Return the object behind a LazyObject, or obj itself.
+
+    :param obj: Object to resolve.
+    :type obj: Any
+    :returns: The proxied object.
+    :rtype: Any
+    """
+    if isinstance(obj, LazyObject):
+        return obj._resolve()
+    return obj
+
+
+def is_resolved(obj):
+    """Whether the object behind a LazyObject has been produced yet.
+
+    :param obj: Object to check.
+    :type obj: Any
+    :rtype: bool
+    """
+    return not isinstance(obj, LazyObject) or obj._resolved
+
+
+def lazy_import(module, attribute=None):
+    """Import a module, or an attribute of it, on first use.
+
+    :param module: Absolute name of the module.
+    :type module: str
+    :param attribute: Name of the attribute of the module to proxy.
+    :type attribute: Optional[str]
+    :returns: Proxy for the module or attribute.
+    :rtype: LazyObject
+    """
+    def _import():
+        mod = importlib.import_module(module)
+        if attribute is None:
+            return mod
+        return getattr(mod, attribute)
+
+    name = module if attribute is None else '{}.{}'.format(module, attribute)
+    return LazyObject(_import, name=name)
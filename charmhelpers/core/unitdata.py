@@ -158,6 +158,11 @@ import sys
 
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# Host facts derived from installed packages are invalidated whenever the
+# dpkg status database changes.
+DPKG_STATUS = '/var/lib/dpkg/status'
+FACT_PREFIX = 'facts.'
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -323,6 +328,41 @@ class Storage(object):
 
         return value
 
+    def fact(self, name, producer, depends=(DPKG_STATUS,)):
+        """Get a host fact, persisted across hooks.
+
+        Facts are slow to determine values about the host, such as installed
+        package versions, which only change when the files in ``depends``
+        change.  The value returned by ``producer`` is stored together with
+        the modification time, size and inode of those files and reused for
+        as long as they do not change.
+
+        A ``None`` value is never stored, allowing producers to signal that
+        the fact could not be determined yet.
+
+        Like any other write the stored value is only committed by
+        :meth:`flush`, which ``hookenv.Hooks.execute`` calls once the hook
+        completed.
+
+        :param name: Name of the fact.
+        :type name: str
+        :param producer: Callable returning the JSON-serializable value.
+        :type producer: Callable[[], any]
+        :param depends: Paths whose change invalidates the fact.
+        :type depends: Iterable[str]
+        :returns: Value of the fact.
+        :rtype: any
+        """
+        key = '{}{}'.format(FACT_PREFIX, name)
+        stamp = [file_stamp(path) for path in depends]
+        stored = self.get(key)
+        if stored and stored.get('stamp') == stamp:
+            return stored['value']
+        value = producer()
+        if value is not None:
+            self.set(key, {'stamp': stamp, 'value': value})
+        return value
+
     def delta(self, mapping, prefix):
         """
         return a delta containing values that have changed.
@@ -422,6 +462,19 @@ class Storage(object):
         pprint.pprint(self.cursor.fetchall(), stream=fh)
 
 
+def file_stamp(path):
+    """Identify the current content of a file without reading it.
+
+    :returns: [mtime_ns, size, inode] or None if the file does not exist.
+    :rtype: Optional[List[int]]
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
 def _parse_history(d):
     return (d[0], d[1], json.loads(d[2]), d[3],
             datetime.datetime.strptime(d[-1], "%Y-%m-%dT%H:%M:%S.%f"))
@@ -15,6 +15,7 @@
 import os
 import hashlib
 import re
+import shutil
 
 from charmhelpers.fetch import (
     BaseFetchHandler,
@@ -24,7 +25,7 @@ from charmhelpers.payload.archive import (
     get_archive_handler,
     extract,
 )
-from charmhelpers.core.host import mkdir, check_hash
+from charmhelpers.core.host import mkdir, check_hash, HASH_CHUNK_SIZE
 
 import six
 if six.PY3:
@@ -107,7 +108,7 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
         response = urlopen(source)
         try:
             with open(dest, 'wb') as dest_file:
-                dest_file.write(response.read())
+                shutil.copyfileobj(response, dest_file, HASH_CHUNK_SIZE)
         except Exception as e:
             if os.path.isfile(dest):
                 os.unlink(dest)
@@ -20,6 +20,7 @@ import subprocess
 import sys
 import time
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.host import get_distrib_codename, get_system_env
 
 from charmhelpers.core.hookenv import (
@@ -201,6 +202,9 @@ CLOUD_ARCHIVE_POCKETS = {
 }
 
 
+# Fact cache value of packages which are not installed, None is not cached.
+NOT_INSTALLED = False
+
 APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
 CMD_RETRY_DELAY = 10  # Wait 10 seconds between command retries.
 CMD_RETRY_COUNT = 3  # Retry a failing fatal command X times.
@@ -208,17 +212,8 @@ CMD_RETRY_COUNT = 3  # Retry a failing fatal command X times.
 
 def filter_installed_packages(packages):
     """Return a list of packages that require installation."""
-    cache = apt_cache()
-    _pkgs = []
-    for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
-    return _pkgs
+    return [package for package in packages
+            if not get_installed_version(package)]
 
 
 def filter_missing_packages(packages):
@@ -780,23 +775,50 @@ def _run_apt_command(cmd, fatal=False):
         subprocess.call(cmd, env=get_apt_dpkg_env())
 
 
+def get_installed_version(package):
+    """Determine the version string of an installed package.
+
+    The version, or that the package is not installed, is kept in the
+    unit's fact cache so that it is only looked up again after the dpkg
+    status database changed, see
+    :meth:`charmhelpers.core.unitdata.Storage.fact`.
+
+    :param package: Name of package
+    :type package: str
+    :returns: None (if not installed) or the installed version
+    :rtype: Optional[str]
+    :raises: subprocess.CalledProcessError
+    """
+    def _installed_version():
+        try:
+            pkg = apt_cache()[package]
+        except KeyError:
+            log('Package {} has no installation candidate.'.format(package),
+                level='WARNING')
+            return NOT_INSTALLED
+        if pkg.current_ver:
+            return pkg.current_ver.ver_str
+        return NOT_INSTALLED
+
+    return unitdata.kv().fact('package-version.{}'.format(package),
+                              _installed_version) or None
+
+
 def get_upstream_version(package):
     """Determine upstream version based on installed package
 
     @returns None (if not installed) or the upstream version
     """
-    cache = apt_cache()
     try:
-        pkg = cache[package]
+        version = get_installed_version(package)
     except Exception:
-        # the package is unknown to the current apt cache.
         return None
 
-    if not pkg.current_ver:
-        # package is known, but no version is currently installed.
+    if not version:
+        # package is unknown or no version is currently installed.
         return None
 
-    return ubuntu_apt_pkg.upstream_version(pkg.current_ver.ver_str)
+    return ubuntu_apt_pkg.upstream_version(version)
 
 
 def get_apt_dpkg_env():
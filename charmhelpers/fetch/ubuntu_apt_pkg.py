@@ -14,8 +14,9 @@
 
 """Provide a subset of the ``python-apt`` module API.
 
-Data collection is done through subprocess calls to ``apt-cache`` and
-``dpkg-query`` commands.
+Data collection about installed packages is done by reading the dpkg
+status database directly, anything else is left to subprocess calls to
+``apt-cache`` and ``dpkg-query`` commands.
 
 The main purpose for this module is to avoid dependency on the
 ``python-apt`` python module.
@@ -35,11 +36,21 @@ so with this we get rid of the dependency.
 2: https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=845330#10
 """
 
+import collections
 import locale
+import mmap
 import os
+import re
 import subprocess
 import sys
 
+from charmhelpers.core.lazy import LazyObject
+from charmhelpers.core.unitdata import file_stamp
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+_PACKAGE_RE = re.compile(br'^Package: *(\S+)', re.MULTILINE)
+
 
 class _container(dict):
     """Simple container for attributes."""
@@ -55,6 +66,81 @@ class Version(_container):
     """Simple container for version attributes."""
 
 
+def _parse_stanza(text):
+    """Parse a stanza of a Debian control file.
+
+    :param text: The stanza
+    :type text: str
+    :returns: Fields of the stanza with lower case keys
+    :rtype: Dict[str, str]
+    """
+    fields = {}
+    previous = None
+    for line in text.splitlines():
+        if line.startswith((' ', '\t')):
+            if previous:
+                fields[previous] += os.linesep + line.lstrip()
+            continue
+        key, sep, value = line.partition(':')
+        if sep:
+            previous = key.lower()
+            fields[previous] = value.strip()
+    return fields
+
+
+class _ControlFile(object):
+    """Memory mapped Debian control file indexed by package name."""
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = file_stamp(path)
+        self._index = collections.defaultdict(list)
+        with open(path, 'rb') as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                self._data = b''
+        for match in _PACKAGE_RE.finditer(self._data):
+            self._index[match.group(1).decode('UTF-8')].append(match.start())
+
+    def stanzas(self, package):
+        """Parsed stanzas of package.
+
+        :param package: Name of package
+        :type package: str
+        :returns: Fields of each stanza for package
+        :rtype: Iterator[Dict[str, str]]
+        """
+        for start in self._index.get(package, ()):
+            end = self._data.find(b'\n\n', start)
+            if end < 0:
+                end = len(self._data)
+            text = self._data[start:end].decode('UTF-8', 'replace')
+            yield _parse_stanza(text)
+
+
+_control_files = {}
+
+
+def _control_file(path):
+    """Index of a control file, re-read when the file changes.
+
+    :param path: Path to the control file
+    :type path: str
+    :returns: Index of the file or None if it does not exist
+    :rtype: Optional[_ControlFile]
+    """
+    stamp = file_stamp(path)
+    if stamp is None:
+        _control_files.pop(path, None)
+        return None
+    control_file = _control_files.get(path)
+    if control_file is None or control_file.stamp != stamp:
+        control_file = _control_files[path] = _ControlFile(path)
+    return control_file
+
+
 class Cache(object):
     """Simulation of ``apt_pkg`` Cache object."""
     def __init__(self, progress=None):
@@ -70,6 +156,35 @@ class Cache(object):
     def __getitem__(self, package):
         """Get information about a package from apt and dpkg databases.
 
+        The fields of an installed package are read from the dpkg status
+        database, those of any other package are those of the apt candidate
+        so pinning and the architecture are respected.
+
+        :param package: Name of package
+        :type package: str
+        :returns: Package object
+        :rtype: object
+        :raises: KeyError, subprocess.CalledProcessError
+        """
+        status = _control_file(DPKG_STATUS)
+        if status is None:
+            return self._query(package)
+        installed = None
+        for fields in status.stanzas(package):
+            if fields.get('status') == 'install ok installed':
+                installed = fields
+                break
+        if installed is None:
+            return self._query(package)
+        installed['name'] = installed.pop('package')
+        pkg = Package(installed)
+        pkg.current_ver = Version({'ver_str': installed['version']})
+        pkg.architecture = installed.get('architecture')
+        return pkg
+
+    def _query(self, package):
+        """Get information about a package from apt-cache and dpkg-query.
+
         :param package: Name of package
         :type package: str
         :returns: Package object
@@ -204,8 +319,9 @@ class Config(_container):
         return cfgs
 
 
-# Backwards compatibility with old apt_pkg module
-sys.modules[__name__].config = Config()
+# Backwards compatibility with old apt_pkg module.
+# NOTE: populated on first use, importing this module must not run apt-config.
+sys.modules[__name__].config = LazyObject(Config, name='apt_pkg.config')
 
 
 def init():
@@ -230,12 +346,86 @@ def upstream_version(version):
     return version
 
 
+_DIGITS = '0123456789'
+_LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+_version_compare_cache = {}
+
+
+def _order(c):
+    """Weight of a non-digit character of a version, see ``dpkg``."""
+    if c in _LETTERS:
+        return ord(c)
+    if c == '~':
+        return -1
+    return ord(c) + 256
+
+
+def _verrevcmp(a, b):
+    """Compare upstream versions or revisions the way ``dpkg`` does.
+
+    Upstream reference: https://git.dpkg.org/cgit/dpkg/dpkg.git/tree/
+                                lib/dpkg/version.c#n140
+
+    :returns: >0, 0 or <0 like ``cmp``
+    :rtype: int
+    """
+    i = j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while ((i < len(a) and a[i] not in _DIGITS) or
+               (j < len(b) and b[j] not in _DIGITS)):
+            ac = _order(a[i]) if i < len(a) and a[i] not in _DIGITS else 0
+            bc = _order(b[j]) if j < len(b) and b[j] not in _DIGITS else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        while (i < len(a) and a[i] in _DIGITS and
+               j < len(b) and b[j] in _DIGITS):
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i] in _DIGITS:
+            return 1
+        if j < len(b) and b[j] in _DIGITS:
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _parse_version(version):
+    """Split a version string in epoch, upstream version and revision.
+
+    :raises: ValueError
+    """
+    version = version.strip()
+    epoch, sep, rest = version.partition(':')
+    if sep:
+        epoch = int(epoch)
+    else:
+        epoch, rest = 0, version
+    upstream, sep, revision = rest.rpartition('-')
+    if not sep:
+        upstream, revision = revision, ''
+    if not upstream:
+        raise ValueError('Invalid version "{}"'.format(version))
+    return epoch, upstream, revision
+
+
 def version_compare(a, b):
     """Compare the given versions.
 
-    Call out to ``dpkg`` to make sure the code doing the comparison is
-    compatible with what the ``apt`` library would do.  Mimic the return
-    values.
+    Implements the version ordering of ``dpkg``: epochs compare
+    numerically, then upstream versions and revisions compare by
+    alternating non-digit and digit parts, where a ``~`` sorts before
+    anything, even the end of the part.  Results are memoized.
 
     Upstream reference:
     https://apt-team.pages.debian.net/python-apt/library/apt_pkg.html
@@ -248,6 +438,32 @@ def version_compare(a, b):
     :returns: >0 if ``a`` is greater than ``b``, 0 if a equals b,
               <0 if ``a`` is smaller than ``b``
     :rtype: int
+    :raises: ValueError
+    """
+    try:
+        return _version_compare_cache[(a, b)]
+    except KeyError:
+        pass
+    epoch_a, upstream_a, revision_a = _parse_version(a)
+    epoch_b, upstream_b, revision_b = _parse_version(b)
+    result = ((epoch_a > epoch_b) - (epoch_a < epoch_b) or
+              _verrevcmp(upstream_a, upstream_b) or
+              _verrevcmp(revision_a, revision_b))
+    result = (result > 0) - (result < 0)
+    _version_compare_cache[(a, b)] = result
+    return result
+
+
+def _dpkg_version_compare(a, b):
+    """Compare the given versions by calling out to ``dpkg``.
+
+    :param a: version string
+    :type a: str
+    :param b: version string
+    :type b: str
+    :returns: 1 if ``a`` is greater than ``b``, 0 if a equals b,
+              -1 if ``a`` is smaller than ``b``
+    :rtype: int
     :raises: subprocess.CalledProcessError, RuntimeError
     """
     for op in ('gt', 1), ('eq', 0), ('lt', -1):
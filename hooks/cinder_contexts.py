@@ -12,8 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+from collections import OrderedDict
+
+import yaml
+
 from charmhelpers.core.hookenv import (
     config,
+    ERROR,
+    log,
     service_name,
     is_relation_made,
     leader_get,
@@ -22,21 +29,380 @@ from charmhelpers.core.hookenv import (
 )
 
 from charmhelpers.contrib.openstack.context import (
+    CephBlueStoreCompressionContext,
     OSContextGenerator,
 )
 
 from charmhelpers.contrib.openstack.utils import (
+    config_flags_parser,
     get_os_codename_package,
     CompareOpenStackReleases,
 )
 
+from charmhelpers.contrib.storage.linux.ceph import BasePool
+
 CHARM_CEPH_CONF = '/var/lib/charm/{}/ceph.conf'
+# ceph.conf of an entry of rbd-backends, naming its data pool
+CHARM_BACKEND_CEPH_CONF = '/var/lib/charm/{}/backends/{}/ceph.conf'
+
+# Pool level rbd QoS limits of the images, named after the librbd options
+# they set.
+RBD_QOS_OPTIONS = (
+    'rbd-qos-iops-limit',
+    'rbd-qos-iops-burst',
+    'rbd-qos-bps-limit',
+    'rbd-qos-bps-burst',
+)
+# Quotas of the pools, by the charm option setting them.
+POOL_QUOTA_OPTIONS = (
+    ('max-bytes', 'ceph-pool-max-bytes'),
+    ('max-objects', 'ceph-pool-max-objects'),
+)
+
+BACKEND_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+# Keys of an rbd-backends entry which default to the charm option of the
+# same name.
+BACKEND_OPTIONS = (
+    'ec-profile-k',
+    'ec-profile-m',
+    'ec-profile-plugin',
+    'ec-profile-technique',
+    'pool-type',
+) + RBD_QOS_OPTIONS
+BACKEND_COMPRESSION_OPTIONS = tuple(
+    op_key for _, op_key in CephBlueStoreCompressionContext.options)
+BACKEND_KEYS = BACKEND_OPTIONS + BACKEND_COMPRESSION_OPTIONS + (
+    'crush-rule',
+    'device-class',
+    'max-bytes',
+    'max-objects',
+    'name',
+    'pg-autoscale-mode',
+    'pool',
+    'replicas',
+    'target-size-bytes',
+    'volume-backend-name',
+    'weight',
+)
+PG_AUTOSCALE_MODES = ('on', 'warn', 'off')
+# Share of the weight and target size of an erasure-coded pool assigned to
+# its metadata pool: metadata sizing is in effect driven by the number of
+# rbd's rather than their size.
+METADATA_POOL_SHARE = 0.01
+
+# librbd and objecter options of the [client] section of ceph.conf which can
+# be tuned with rbd-client-tuning-profile and rbd-client-tuning, by type.
+RBD_CLIENT_OPTIONS = {
+    'rbd cache': bool,
+    'rbd cache writethrough until flush': bool,
+    'rbd cache size': int,
+    'rbd cache max dirty': int,
+    'rbd cache target dirty': int,
+    'rbd cache max dirty age': float,
+    'rbd readahead max bytes': int,
+    'rbd readahead trigger requests': int,
+    'rbd readahead disable after bytes': int,
+    'objecter inflight ops': int,
+    'objecter inflight op bytes': int,
+    'rbd concurrent management ops': int,
+}
+
+MiB = 1024 * 1024
+RBD_CLIENT_PROFILES = {
+    # large sequential I/O: big write-back cache, aggressive readahead and
+    # more I/O in flight
+    'throughput': {
+        'rbd cache': True,
+        'rbd cache size': 128 * MiB,
+        'rbd cache max dirty': 96 * MiB,
+        'rbd cache target dirty': 64 * MiB,
+        'rbd readahead max bytes': 4 * MiB,
+        'rbd readahead trigger requests': 10,
+        'rbd readahead disable after bytes': 0,
+        'objecter inflight ops': 10240,
+        'objecter inflight op bytes': 1024 * MiB,
+        'rbd concurrent management ops': 20,
+    },
+    # small synchronous I/O: write-through cache, no readahead
+    'latency': {
+        'rbd cache': True,
+        'rbd cache writethrough until flush': True,
+        'rbd cache size': 32 * MiB,
+        'rbd cache max dirty': 0,
+        'rbd cache target dirty': 0,
+        'rbd readahead max bytes': 0,
+    },
+    # slow backing OSDs: larger write-back cache to absorb bursts, moderate
+    # readahead
+    'hdd-backed': {
+        'rbd cache': True,
+        'rbd cache size': 64 * MiB,
+        'rbd cache max dirty': 48 * MiB,
+        'rbd cache target dirty': 32 * MiB,
+        'rbd cache max dirty age': 2.0,
+        'rbd readahead max bytes': 1 * MiB,
+        'rbd readahead trigger requests': 10,
+        'objecter inflight ops': 4096,
+        'objecter inflight op bytes': 256 * MiB,
+    },
+}
 
 
 def ceph_config_file():
     return CHARM_CEPH_CONF.format(service_name())
 
 
+def backend_ceph_config_file(backend):
+    return CHARM_BACKEND_CEPH_CONF.format(service_name(), backend['name'])
+
+
+def backend_has_ceph_config(backend):
+    """Whether a backend needs a ceph.conf of its own.
+
+    The ceph.conf of the application names the data pool of the default
+    backend when it is erasure-coded, so an erasure-coded backend, or any
+    backend next to an erasure-coded default backend, gets its own.
+
+    :param backend: Entry of get_backends().
+    :type backend: Dict[str, Any]
+    :rtype: bool
+    """
+    return 'erasure-coded' in (backend['pool-type'], config('pool-type'))
+
+
+def pool_autoscale_mode():
+    """PG autoscale mode of the pools, ceph-pool-autoscale-mode.
+
+    :rtype: Optional[str]
+    :raises: ValueError if the mode is invalid.
+    """
+    mode = config('ceph-pool-autoscale-mode')
+    if mode and mode not in PG_AUTOSCALE_MODES:
+        raise ValueError("ceph-pool-autoscale-mode: '{}' is not one of {}"
+                         .format(mode, ', '.join(PG_AUTOSCALE_MODES)))
+    return mode or None
+
+
+def pool_target_size_bytes():
+    """Expected amount of data of the pools, ceph-pool-target-size-bytes.
+
+    :rtype: Optional[int]
+    :raises: ValueError if the size is negative.
+    """
+    target_bytes = config('ceph-pool-target-size-bytes')
+    if target_bytes is not None and target_bytes < 0:
+        raise ValueError('ceph-pool-target-size-bytes must be a non-negative '
+                         'integer')
+    return target_bytes or None
+
+
+def pool_autoscale_kwargs(weight, target_size_bytes=None, mode=None):
+    """PG autoscaler keyword arguments of a create pool operation.
+
+    :param weight: Weight of the pool, in percent.
+    :type weight: float
+    :param target_size_bytes: Expected amount of data in the pool.
+    :type target_size_bytes: Optional[int]
+    :param mode: PG autoscale mode of the pool.
+    :type mode: Optional[str]
+    :rtype: Dict[str, Any]
+    """
+    kwargs = {'target_size_ratio': weight / 100.0}
+    if target_size_bytes:
+        kwargs['target_size_bytes'] = int(target_size_bytes)
+    if mode:
+        kwargs['pg_autoscale_mode'] = mode
+    return kwargs
+
+
+def pool_limits():
+    """Quotas and rbd QoS limits of the pools from the charm options.
+
+    :returns: max-bytes, max-objects and the rbd-qos-* limits, None when
+              unset.
+    :rtype: Dict[str, Optional[int]]
+    :raises: ValueError if a limit is negative.
+    """
+    limits = {}
+    for key, option in POOL_QUOTA_OPTIONS + tuple(
+            (option, option) for option in RBD_QOS_OPTIONS):
+        limits[key] = config(option)
+        if limits[key] is not None and limits[key] < 0:
+            raise ValueError('{} must not be negative'.format(option))
+    return limits
+
+
+def pool_limit_kwargs(limits, quota=True, qos=True):
+    """Quota and rbd QoS keyword arguments of a create pool operation.
+
+    The rbd QoS limits are pool level rbd configuration read from the pool
+    holding the images, the metadata pool of erasure-coded pools, whereas
+    the quotas bound the pool holding the data.
+
+    :param limits: Limits as returned by pool_limits(), or a backend.
+    :type limits: Dict[str, Optional[int]]
+    :param quota: Include the quotas.
+    :type quota: bool
+    :param qos: Include the rbd QoS limits.
+    :type qos: bool
+    :rtype: Dict[str, Any]
+    """
+    kwargs = {}
+    if quota:
+        kwargs.update((key.replace('-', '_'), limits[key])
+                      for key, _ in POOL_QUOTA_OPTIONS
+                      if limits.get(key) is not None)
+    rbd_config = {option.replace('-', '_'): limits[option]
+                  for option in RBD_QOS_OPTIONS
+                  if qos and limits.get(option) is not None}
+    if rbd_config:
+        kwargs['rbd_config'] = rbd_config
+    return kwargs
+
+
+def split_metadata_pool(weight, target_size_bytes=None):
+    """Split the weight and target size of an erasure-coded backend.
+
+    :param weight: Weight of the backend, in percent.
+    :type weight: float
+    :param target_size_bytes: Expected amount of data of the backend.
+    :type target_size_bytes: Optional[int]
+    :returns: (weight, target size) of the metadata pool and of the data
+              pool.
+    :rtype: Tuple[Tuple[float, Optional[int]], Tuple[float, Optional[int]]]
+    """
+    metadata_weight = weight * METADATA_POOL_SHARE
+    metadata_bytes = None
+    if target_size_bytes:
+        metadata_bytes = int(target_size_bytes * METADATA_POOL_SHARE)
+        target_size_bytes = target_size_bytes - metadata_bytes
+    return ((metadata_weight, metadata_bytes),
+            (weight - metadata_weight, target_size_bytes))
+
+
+def get_backends():
+    """RBD backends configured with rbd-backends.
+
+    The backends are provided in addition to the default backend named
+    after the application, whose pools may not be reused.
+    Every entry is completed with its defaults: the pool and the cinder.conf
+    section are named <application>-<name>, replicas, weight and the erasure
+    coding, BlueStore compression, PG autoscale and rbd QoS settings default
+    to the charm options, the weight being shared evenly between the
+    backends.  The pools of a backend have no quota unless max-bytes or
+    max-objects is given.
+    Replicated backends with a device class are placed with the CRUSH rule
+    replicated_<device-class> unless crush-rule is given.
+
+    :returns: The backends, empty when rbd-backends is not set.
+    :rtype: List[Dict[str, Any]]
+    :raises: ValueError if rbd-backends is invalid.
+    """
+    raw = config('rbd-backends')
+    if not raw:
+        return []
+    try:
+        entries = yaml.safe_load(raw)
+    except yaml.YAMLError as e:
+        raise ValueError('rbd-backends: invalid YAML: {}'.format(e))
+    if not isinstance(entries, list) or not entries or not all(
+            isinstance(entry, dict) for entry in entries):
+        raise ValueError('rbd-backends: expected a list of mappings')
+
+    service = service_name()
+    compression = CephBlueStoreCompressionContext().get_op()
+    backends = []
+    for entry in entries:
+        name = str(entry.get('name') or '')
+        if not BACKEND_NAME_RE.match(name):
+            raise ValueError("rbd-backends: invalid backend name '{}'"
+                             .format(name))
+        unknown = sorted(set(entry) - set(BACKEND_KEYS))
+        if unknown:
+            raise ValueError('rbd-backends: {}: unknown keys {}'.format(
+                name, ', '.join(map(str, unknown))))
+
+        backend = {key: config(key) for key in BACKEND_OPTIONS}
+        backend.update(compression)
+        backend.update({
+            'name': name,
+            'section': '{}-{}'.format(service, name),
+            'pool': '{}-{}'.format(service, name),
+            'replicas': config('ceph-osd-replication-count'),
+            'weight': config('ceph-pool-weight') / len(entries),
+            'device-class': None,
+            'crush-rule': None,
+            'target-size-bytes': None,
+            'pg-autoscale-mode': pool_autoscale_mode(),
+            'max-bytes': None,
+            'max-objects': None,
+        })
+        backend.update(entry)
+        backend.setdefault('volume-backend-name', backend['section'])
+        if backend['pool-type'] not in ('replicated', 'erasure-coded'):
+            raise ValueError("rbd-backends: {}: invalid pool-type '{}'"
+                             .format(name, backend['pool-type']))
+        if backend['pool-type'] == 'erasure-coded':
+            backend['metadata-pool'] = '{}-metadata'.format(backend['pool'])
+            backend['ec-profile-name'] = '{}-profile'.format(backend['pool'])
+        if backend['device-class'] and not backend['crush-rule']:
+            backend['crush-rule'] = 'replicated_{}'.format(
+                backend['device-class'])
+        if (backend['pg-autoscale-mode'] and
+                backend['pg-autoscale-mode'] not in PG_AUTOSCALE_MODES):
+            raise ValueError("rbd-backends: {}: invalid pg-autoscale-mode "
+                             "'{}'".format(name, backend['pg-autoscale-mode']))
+        for key in ('replicas', 'ec-profile-k', 'ec-profile-m',
+                    'target-size-bytes'):
+            if backend[key] is not None and (
+                    not isinstance(backend[key], int) or backend[key] < 1):
+                raise ValueError('rbd-backends: {}: {} must be a positive '
+                                 'integer'.format(name, key))
+        for key in ('max-bytes', 'max-objects') + RBD_QOS_OPTIONS:
+            if backend[key] is not None and (
+                    not isinstance(backend[key], int) or backend[key] < 0):
+                raise ValueError('rbd-backends: {}: {} must be a '
+                                 'non-negative integer'.format(name, key))
+        if (not isinstance(backend['weight'], (int, float)) or
+                backend['weight'] <= 0):
+            raise ValueError('rbd-backends: {}: weight must be a positive '
+                             'number'.format(name))
+        backend['weight'] = float(backend['weight'])
+        op = {key: backend[key] for key in BACKEND_COMPRESSION_OPTIONS}
+        op['name'] = backend['pool']
+        try:
+            BasePool('dummy-service', op=op).validate()
+        except (AssertionError, ValueError) as e:
+            raise ValueError('rbd-backends: {}: {}'.format(name, e))
+        backends.append(backend)
+
+    for key in ('name', 'pool'):
+        values = [backend[key] for backend in backends]
+        if len(set(values)) != len(values):
+            raise ValueError('rbd-backends: duplicate {}'.format(key))
+    # The pools of the default backend stay in use next to the rbd-backends.
+    default_pool = config('rbd-pool-name') or service
+    default_pools = {default_pool,
+                     '{}-metadata'.format(default_pool),
+                     '{}-metadata'.format(service),
+                     config('ec-rbd-metadata-pool') or default_pool}
+    for backend in backends:
+        pools = {backend['pool'], backend.get('metadata-pool')}
+        if pools & default_pools:
+            raise ValueError('rbd-backends: {}: pool of the default backend'
+                             .format(backend['name']))
+    return backends
+
+
+def backend_pool_kwargs(backend):
+    """BlueStore compression keyword arguments of a backend's data pool.
+
+    :rtype: Dict[str, Any]
+    """
+    return {key.replace('-', '_'): backend[key]
+            for key in BACKEND_COMPRESSION_OPTIONS}
+
+
 class CephAccessContext(OSContextGenerator):
     interfaces = ['ceph-access']
 
@@ -55,6 +421,9 @@ class CephSubordinateContext(OSContextGenerator):
         """
         Used to generate template context to be added to cinder.conf in the
         presence of a ceph relation.
+
+        A section named after the application is generated for the default
+        backend, followed by one for every entry of rbd-backends.
         """
         if not is_relation_made('ceph', 'key'):
             return {}
@@ -73,29 +442,176 @@ class CephSubordinateContext(OSContextGenerator):
             )
         else:
             pool_name = config('rbd-pool-name') or service
+        sections = [(service, service, pool_name, ceph_config_file())]
+        sections.extend(
+            (backend['section'], backend['volume-backend-name'],
+             backend.get('metadata-pool', backend['pool']),
+             backend_ceph_config_file(backend)
+             if backend_has_ceph_config(backend)
+             else ceph_config_file())
+            for backend in get_backends())
 
-        section = {service: [('volume_backend_name', service),
-                             ('volume_driver', volume_driver),
-                             ('rbd_pool', pool_name),
-                             ('rbd_user', service),
-                             ('rbd_secret_uuid', leader_get('secret-uuid')),
-                             ('rbd_ceph_conf', ceph_config_file())]}
+        section = OrderedDict()
+        for name, backend_name, pool_name, ceph_conf in sections:
+            section[name] = self._section(
+                os_codename, volume_driver, backend_name, pool_name,
+                ceph_conf)
+
+        return {'cinder': {'/etc/cinder/cinder.conf': {'sections': section}}}
+
+    @staticmethod
+    def _section(os_codename, volume_driver, backend_name, pool_name,
+                 ceph_conf):
+        service = service_name()
+        section = [('volume_backend_name', backend_name),
+                   ('volume_driver', volume_driver),
+                   ('rbd_pool', pool_name),
+                   ('rbd_user', service),
+                   ('rbd_secret_uuid', leader_get('secret-uuid')),
+                   ('rbd_ceph_conf', ceph_conf)]
 
         if CompareOpenStackReleases(os_codename) >= "mitaka":
-            section[service].append(('report_discard_supported', True))
+            section.append(('report_discard_supported', True))
 
         if CompareOpenStackReleases(os_codename) >= "ocata":
-            section[service].append(('rbd_exclusive_cinder_pool', True))
+            section.append(('rbd_exclusive_cinder_pool', True))
 
         if CompareOpenStackReleases(os_codename) >= "pike" \
                 and config('backend-availability-zone'):
-            section[service].append(
+            section.append(
                 ('backend_availability_zone',
                  config('backend-availability-zone')))
 
         if CompareOpenStackReleases(os_codename) >= "queens":
-            section[service].append(
+            section.append(
                 ('rbd_flatten_volume_from_snapshot',
                  config('rbd-flatten-volume-from-snapshot')))
+        return section
 
-        return {'cinder': {'/etc/cinder/cinder.conf': {'sections': section}}}
+    @staticmethod
+    def enabled_backends():
+        """Names of the generated cinder.conf sections.
+
+        :rtype: List[str]
+        """
+        return [service_name()] + [backend['section']
+                                   for backend in get_backends()]
+
+
+class RBDDataPoolContext(OSContextGenerator):
+    """Data pool of the RBD images for a ceph.conf.
+
+    RBD images keep their data in the erasure-coded pool of an erasure-coded
+    backend, which is configured with rbd default data pool.  The ceph.conf
+    of the application keeps the data pool of the default backend set by
+    CephContext, the ceph.conf of an rbd-backends entry names the entry's
+    data pool, if any.
+
+    :param backend: Name of the rbd-backends entry of the ceph.conf, None
+                    for the ceph.conf of the application.
+    :type backend: Optional[str]
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def __call__(self):
+        if self.backend is None:
+            return {}
+        try:
+            backends = get_backends()
+        except ValueError:
+            backends = []
+        data_pool = None
+        for backend in backends:
+            if (backend['name'] == self.backend and
+                    backend['pool-type'] == 'erasure-coded'):
+                data_pool = backend['pool']
+        return {'rbd_default_data_pool': data_pool}
+
+
+class RBDClientTuningContext(OSContextGenerator):
+    """librbd cache and I/O settings for the [client] section of ceph.conf.
+
+    The settings of the rbd-client-tuning-profile are overridden by the
+    key=value pairs of rbd-client-tuning.  Keys may be given with spaces,
+    underscores or dashes, e.g. rbd_cache_size=67108864.
+    """
+
+    def settings(self):
+        """Validated settings, sorted by name.
+
+        :returns: Setting name to value as written to ceph.conf.
+        :rtype: OrderedDict[str, str]
+        :raises: ValueError if the configuration is invalid.
+        """
+        profile = config('rbd-client-tuning-profile')
+        if profile and profile not in RBD_CLIENT_PROFILES:
+            raise ValueError(
+                "rbd-client-tuning-profile: '{}' is not one of {}".format(
+                    profile, ', '.join(sorted(RBD_CLIENT_PROFILES))))
+        settings = dict(RBD_CLIENT_PROFILES.get(profile) or {})
+        overrides = config('rbd-client-tuning')
+        if overrides:
+            try:
+                overrides = config_flags_parser(overrides)
+            except Exception:
+                raise ValueError(
+                    'rbd-client-tuning: expected key=value pairs')
+            for key, value in overrides.items():
+                name = ' '.join(str(key).replace('_', ' ')
+                                .replace('-', ' ').split()).lower()
+                settings[name] = self._parse(name, value)
+
+        size = settings.get('rbd cache size')
+        max_dirty = settings.get('rbd cache max dirty')
+        target_dirty = settings.get('rbd cache target dirty')
+        if None not in (size, max_dirty) and max_dirty > size:
+            raise ValueError('rbd-client-tuning: rbd cache max dirty must '
+                             'not exceed rbd cache size')
+        if None not in (max_dirty, target_dirty) and target_dirty > max_dirty:
+            raise ValueError('rbd-client-tuning: rbd cache target dirty '
+                             'must not exceed rbd cache max dirty')
+
+        return OrderedDict(
+            (name, str(value).lower() if isinstance(value, bool) else
+             str(value))
+            for name, value in sorted(settings.items()))
+
+    @staticmethod
+    def _parse(name, value):
+        if name not in RBD_CLIENT_OPTIONS:
+            raise ValueError("rbd-client-tuning: unsupported option '{}'"
+                             .format(name))
+        value_type = RBD_CLIENT_OPTIONS[name]
+        value = str(value).strip()
+        try:
+            if value_type is bool:
+                if value.lower() not in ('true', 'false'):
+                    raise ValueError
+                return value.lower() == 'true'
+            value = value_type(value)
+        except ValueError:
+            raise ValueError("rbd-client-tuning: invalid value '{}' for {}"
+                             .format(value, name))
+        if value < 0:
+            raise ValueError("rbd-client-tuning: {} must not be negative"
+                             .format(name))
+        return value
+
+    def validate(self):
+        """Validate options.
+
+        :raises: ValueError
+        """
+        self.settings()
+
+    def __call__(self):
+        try:
+            settings = self.settings()
+        except ValueError as e:
+            log('Not applying RBD client tuning: {}'.format(e), level=ERROR)
+            return {}
+        if not settings:
+            return {}
+        return {'rbd_client_cache_settings': settings}
@@ -31,11 +31,6 @@ def _add_path(path):
 
 _add_path(_root)
 
-from charmhelpers.contrib.openstack.alternatives import remove_alternative
-from charmhelpers.contrib.openstack.context import (
-    CephBlueStoreCompressionContext,
-    CephContext,
-)
 from charmhelpers.contrib.openstack.utils import (
     clear_unit_paused,
     clear_unit_upgrading,
@@ -44,17 +39,11 @@ from charmhelpers.contrib.openstack.utils import (
     set_unit_paused,
     set_unit_upgrading,
 )
-from charmhelpers.contrib.storage.linux.ceph import (
-    CephBrokerRq,
-    delete_keyring,
-    ensure_ceph_keyring,
-    is_request_complete,
-    send_application_name,
-    send_request_if_needed,
-)
 from charmhelpers.core.hookenv import (
+    buffer_relation_settings,
     DEBUG,
     config,
+    hook_name,
     Hooks,
     is_leader,
     leader_get,
@@ -66,31 +55,66 @@ from charmhelpers.core.hookenv import (
     status_set,
     UnregisteredHookError,
 )
-from charmhelpers.core.host import (
-    restart_on_change,
-    service_restart,
-)
+from charmhelpers.core.host import restart_on_change
+from charmhelpers.core.lazy import lazy_import
+from charmhelpers.core.unitdata import kv
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.payload.execd import execd_preinstall
 
-from cinder_contexts import (
-    ceph_config_file,
-    CephSubordinateContext,
-)
 from cinder_utils import (
     CEPH_CONF,
+    check_rbd_config,
     PACKAGES,
+    rbd_config_unapplied,
     register_configs,
     REQUIRED_INTERFACES,
+    restart_functions,
     restart_map,
+    run_scheduled_restarts,
+    schedule_restart,
     scrub_old_style_ceph,
+    status_fingerprint,
+    STATUS_FINGERPRINT_KEY,
     VERSION_PACKAGE,
+    WORKLOAD_STATUS_KEY,
 )
 
+# NOTE: every hook executes this module, the modules below are only imported
+# by the hooks which use them.
+_CH_CONTEXT = 'charmhelpers.contrib.openstack.context'
+_CH_CEPH = 'charmhelpers.contrib.storage.linux.ceph'
+remove_alternative = lazy_import('charmhelpers.contrib.openstack.alternatives',
+                                 'remove_alternative')
+CephBlueStoreCompressionContext = lazy_import(
+    _CH_CONTEXT, 'CephBlueStoreCompressionContext')
+CephContext = lazy_import(_CH_CONTEXT, 'CephContext')
+CephBrokerRq = lazy_import(_CH_CEPH, 'CephBrokerRq')
+delete_keyring = lazy_import(_CH_CEPH, 'delete_keyring')
+ensure_ceph_keyring = lazy_import(_CH_CEPH, 'ensure_ceph_keyring')
+is_request_complete = lazy_import(_CH_CEPH, 'is_request_complete')
+send_application_name = lazy_import(_CH_CEPH, 'send_application_name')
+send_request_if_needed = lazy_import(_CH_CEPH, 'send_request_if_needed')
+ceph_config_file = lazy_import('cinder_contexts', 'ceph_config_file')
+CephSubordinateContext = lazy_import('cinder_contexts',
+                                     'CephSubordinateContext')
+RBDClientTuningContext = lazy_import('cinder_contexts',
+                                     'RBDClientTuningContext')
+backend_pool_kwargs = lazy_import('cinder_contexts', 'backend_pool_kwargs')
+get_backends = lazy_import('cinder_contexts', 'get_backends')
+pool_autoscale_kwargs = lazy_import('cinder_contexts',
+                                    'pool_autoscale_kwargs')
+pool_autoscale_mode = lazy_import('cinder_contexts', 'pool_autoscale_mode')
+pool_limit_kwargs = lazy_import('cinder_contexts', 'pool_limit_kwargs')
+pool_limits = lazy_import('cinder_contexts', 'pool_limits')
+pool_target_size_bytes = lazy_import('cinder_contexts',
+                                     'pool_target_size_bytes')
+split_metadata_pool = lazy_import('cinder_contexts', 'split_metadata_pool')
 
 hooks = Hooks()
 
-CONFIGS = register_configs()
+# NOTE: update-status fires every few minutes and only needs the registered
+# configs when the workload status must be re-assessed, see assess_status().
+CONFIGS = None if hook_name() == 'update-status' else register_configs()
 
 
 @hooks.hook('install.real')
@@ -109,12 +133,74 @@ def ceph_joined():
     send_application_name()
 
 
+def add_backend_pool_ops(rq, backend):
+    """Add the operations creating the pools of an rbd-backends entry.
+
+    :param rq: Request to add the operations to.
+    :type rq: CephBrokerRq
+    :param backend: Entry of get_backends().
+    :type backend: Dict[str, Any]
+    """
+    weight = backend['weight']
+    target_bytes = backend['target-size-bytes']
+    mode = backend['pg-autoscale-mode']
+    kwargs = backend_pool_kwargs(backend)
+    if backend['pool-type'] == 'erasure-coded':
+        ((metadata_weight, metadata_bytes),
+         (weight, target_bytes)) = split_metadata_pool(weight, target_bytes)
+        metadata_kwargs = {
+            'name': backend['metadata-pool'],
+            'replica_count': backend['replicas'],
+            'weight': metadata_weight,
+            'group': 'volumes',
+            'app_name': 'rbd',
+            'crush_profile': backend['crush-rule'],
+        }
+        metadata_kwargs.update(pool_autoscale_kwargs(
+            metadata_weight, metadata_bytes, mode))
+        metadata_kwargs.update(pool_limit_kwargs(backend, quota=False))
+        rq.add_op_create_replicated_pool(**metadata_kwargs)
+        rq.add_op_create_erasure_profile(
+            name=backend['ec-profile-name'],
+            k=backend['ec-profile-k'], m=backend['ec-profile-m'],
+            device_class=backend['device-class'],
+            erasure_type=backend['ec-profile-plugin'],
+            erasure_technique=backend['ec-profile-technique'])
+        kwargs.update({
+            'name': backend['pool'],
+            'erasure_profile': backend['ec-profile-name'],
+            'weight': weight,
+            'group': 'volumes',
+            'app_name': 'rbd',
+            'allow_ec_overwrites': True,
+        })
+        kwargs.update(pool_autoscale_kwargs(weight, target_bytes, mode))
+        kwargs.update(pool_limit_kwargs(backend, qos=False))
+        rq.add_op_create_erasure_pool(**kwargs)
+    else:
+        kwargs.update({
+            'name': backend['pool'],
+            'replica_count': backend['replicas'],
+            'weight': weight,
+            'group': 'volumes',
+            'app_name': 'rbd',
+            'crush_profile': backend['crush-rule'],
+        })
+        kwargs.update(pool_autoscale_kwargs(weight, target_bytes, mode))
+        kwargs.update(pool_limit_kwargs(backend))
+        rq.add_op_create_replicated_pool(**kwargs)
+
+
 def get_ceph_request():
     rq = CephBrokerRq()
     service = service_name()
+    backends = get_backends()
     pool_name = config('rbd-pool-name') or service
     weight = config('ceph-pool-weight')
     replicas = config('ceph-osd-replication-count')
+    target_bytes = pool_target_size_bytes()
+    autoscale_mode = pool_autoscale_mode()
+    limits = pool_limits()
     bluestore_compression = CephBlueStoreCompressionContext()
 
     if config('pool-type') == 'erasure-coded':
@@ -143,14 +229,22 @@ def get_ceph_request():
         # Metadata sizing is approximately 1% of overall data weight
         # but is in effect driven by the number of rbd's rather than
         # their size - so it can be very lightweight.
-        metadata_weight = weight * 0.01
-        # Resize data pool weight to accomodate metadata weight
-        weight = weight - metadata_weight
+        # The data pool weight and target size are resized to accomodate
+        # the metadata pool's.
+        ((metadata_weight, metadata_bytes),
+         (weight, target_bytes)) = split_metadata_pool(weight, target_bytes)
         # Create metadata pool
-        rq.add_op_create_pool(
-            name=metadata_pool_name, replica_count=replicas,
-            weight=metadata_weight, group='volumes', app_name='rbd'
-        )
+        kwargs = {
+            'name': metadata_pool_name,
+            'replica_count': replicas,
+            'weight': metadata_weight,
+            'group': 'volumes',
+            'app_name': 'rbd',
+        }
+        kwargs.update(pool_autoscale_kwargs(
+            metadata_weight, metadata_bytes, autoscale_mode))
+        kwargs.update(pool_limit_kwargs(limits, quota=False))
+        rq.add_op_create_replicated_pool(**kwargs)
 
         # Create erasure profile
         rq.add_op_create_erasure_profile(
@@ -181,6 +275,9 @@ def get_ceph_request():
             'allow_ec_overwrites': True,
         }
         kwargs.update(bluestore_compression.get_kwargs())
+        kwargs.update(pool_autoscale_kwargs(
+            weight, target_bytes, autoscale_mode))
+        kwargs.update(pool_limit_kwargs(limits, qos=False))
         rq.add_op_create_erasure_pool(**kwargs)
     else:
         # NOTE(fnordahl): once we deprecate Python 3.5 support we can do
@@ -195,7 +292,14 @@ def get_ceph_request():
             'app_name': 'rbd',
         }
         kwargs.update(bluestore_compression.get_kwargs())
+        kwargs.update(pool_autoscale_kwargs(
+            weight, target_bytes, autoscale_mode))
+        kwargs.update(pool_limit_kwargs(limits))
         rq.add_op_create_replicated_pool(**kwargs)
+    # The pools of the rbd-backends are created next to the ones of the
+    # default backend, which keeps serving the existing volumes.
+    for backend in backends:
+        add_backend_pool_ops(rq, backend)
     if config('restrict-ceph-pools'):
         rq.add_op_request_access_to_group(
             name='volumes',
@@ -213,7 +317,8 @@ def get_ceph_request():
 
 
 @hooks.hook('ceph-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions(),
+                   deferred=True)
 def ceph_changed():
     if 'ceph' not in CONFIGS.complete_contexts():
         log('ceph relation incomplete. Peer not ready?')
@@ -226,18 +331,21 @@ def ceph_changed():
         return
 
     try:
-        if is_request_complete(get_ceph_request()):
+        request = get_ceph_request()
+        if is_request_complete(request):
             log('Request complete')
+            check_rbd_config(request)
             CONFIGS.write_all()
             for rid in relation_ids('storage-backend'):
                 storage_backend(rid)
             for r_id in relation_ids('ceph-access'):
                 ceph_access_joined(r_id)
             # Ensure that cinder-volume is restarted since only now can we
-            # guarantee that ceph resources are ready.
-            service_restart('cinder-volume')
+            # guarantee that ceph resources are ready.  All units get here
+            # at about the same time, the restarts are staggered.
+            schedule_restart('cinder-volume')
         else:
-            send_request_if_needed(get_ceph_request())
+            send_request_if_needed(request)
     except ValueError as e:
         # The end user has most likely provided a invalid value for a
         # configuration option. Just log the traceback here, the end user will
@@ -257,7 +365,8 @@ def ceph_broken():
 
 
 @hooks.hook('config-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions(),
+                   deferred=True)
 def write_and_restart():
     # NOTE(jamespage): seed uuid for use on compute nodes with libvirt
     if not leader_get('secret-uuid') and is_leader():
@@ -273,13 +382,23 @@ def write_and_restart():
 def storage_backend(rel_id=None):
     if 'ceph' not in CONFIGS.complete_contexts():
         log('ceph relation incomplete. Peer not ready?')
-    else:
-        relation_set(
-            relation_id=rel_id,
-            backend_name=service_name(),
-            subordinate_configuration=json.dumps(CephSubordinateContext()()),
-            stateless=True,
-        )
+        return
+    try:
+        subordinate_context = CephSubordinateContext()
+        configuration = subordinate_context()
+        # NOTE: cinder joins the backend names of its storage backends into
+        # enabled_backends.
+        backend_name = ','.join(subordinate_context.enabled_backends())
+    except ValueError as e:
+        log('Not updating the storage backend, invalid rbd-backends: {}'
+            .format(e), level=DEBUG)
+        return
+    relation_set(
+        relation_id=rel_id,
+        backend_name=backend_name,
+        subordinate_configuration=json.dumps(configuration),
+        stateless=True,
+    )
 
 
 @hooks.hook('storage-backend-relation-changed')
@@ -291,7 +410,8 @@ def storage_backend_changed():
 
 
 @hooks.hook('upgrade-charm')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions(),
+                   deferred=True)
 def upgrade_charm():
     if 'ceph' in CONFIGS.complete_contexts():
         CONFIGS.write_all()
@@ -361,21 +481,59 @@ def dummy_update_status():
     pass
 
 
-def assess_status():
-    """Assess status of current unit."""
+def assess_status(restarted=None):
+    """Assess status of current unit.
+
+    In the update-status hook the previously assessed status is kept when
+    none of its inputs changed, see status_fingerprint(), and no scheduled
+    restart ran: waiting for one replaces the workload status.
+
+    :param restarted: Services restarted by run_scheduled_restarts().
+    :type restarted: Optional[List[str]]
+    """
+    global CONFIGS
+    db = kv()
+    fingerprint = status_fingerprint()
+    if (hook_name() == 'update-status' and not restarted and
+            db.get(STATUS_FINGERPRINT_KEY) == fingerprint):
+        log('Workload status inputs unchanged, keeping status: {}'
+            .format(db.get(WORKLOAD_STATUS_KEY)), level=DEBUG)
+        return
+
+    if CONFIGS is None:
+        CONFIGS = register_configs()
     os_application_version_set(VERSION_PACKAGE)
-    set_os_workload_status(CONFIGS, REQUIRED_INTERFACES)
+    status = set_os_workload_status(CONFIGS, REQUIRED_INTERFACES)
 
     try:
         bluestore_compression = CephBlueStoreCompressionContext()
         bluestore_compression.validate()
+        RBDClientTuningContext().validate()
+        get_backends()
+        pool_autoscale_mode()
+        pool_target_size_bytes()
+        pool_limits()
     except ValueError as e:
-        status_set('blocked', 'Invalid configuration: {}'.format(str(e)))
+        status = ('blocked', 'Invalid configuration: {}'.format(str(e)))
+        status_set(*status)
+    else:
+        unapplied = rbd_config_unapplied()
+        if unapplied:
+            status = ('blocked', 'rbd-qos-* not applied by ceph-mon to {}'
+                      .format(', '.join(unapplied)))
+            status_set(*status)
+
+    db.set(STATUS_FINGERPRINT_KEY, fingerprint)
+    db.set(WORKLOAD_STATUS_KEY, status)
+    db.flush()
 
 
 if __name__ == '__main__':
+    # NOTE: write the relation settings of the hook with one relation-set
+    # per relation when the hook completes.
+    buffer_relation_settings()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e))
-    assess_status()
+    assess_status(restarted=run_scheduled_restarts())
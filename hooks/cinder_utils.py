@@ -12,25 +12,51 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
 import re
+import time
 from collections import OrderedDict
+from subprocess import CalledProcessError
 from tempfile import NamedTemporaryFile
 
-from charmhelpers.contrib.openstack import (
-    context,
-    templating,
+from charmhelpers.contrib.openstack.utils import (
+    get_os_codename_package,
+    is_unit_paused_set,
+    is_unit_upgrading_set,
 )
-from charmhelpers.contrib.openstack.alternatives import install_alternative
-from charmhelpers.contrib.openstack.utils import get_os_codename_package
 from charmhelpers.core.hookenv import (
+    DEBUG,
+    WARNING,
+    config,
+    goal_state,
     hook_name,
+    local_unit,
+    log,
+    related_units,
     relation_ids,
     service_name,
+    status_set,
 )
-from charmhelpers.core.host import mkdir
+from charmhelpers.core.host import (
+    defer_restart,
+    mkdir,
+    service_restart,
+)
+from charmhelpers.core.lazy import lazy_import
+from charmhelpers.core.unitdata import kv
+from charmhelpers.fetch import get_upstream_version
 
-import cinder_contexts
+# NOTE: the contexts and the renderer are only needed by hooks which render
+# configuration, see register_configs().
+context = lazy_import('charmhelpers.contrib.openstack.context')
+templating = lazy_import('charmhelpers.contrib.openstack.templating')
+install_alternative = lazy_import(
+    'charmhelpers.contrib.openstack.alternatives', 'install_alternative')
+cinder_contexts = lazy_import('cinder_contexts')
+get_rbd_pool_config = lazy_import('charmhelpers.contrib.storage.linux.ceph',
+                                  'get_rbd_pool_config')
 
 
 PACKAGES = [
@@ -47,6 +73,20 @@ REQUIRED_INTERFACES = {
 CHARM_CEPH_CONF = '/var/lib/charm/{}/ceph.conf'
 CEPH_CONF = '/etc/ceph/ceph.conf'
 
+# unitdata keys recording the last assessed workload status and the
+# fingerprint of its inputs
+STATUS_FINGERPRINT_KEY = 'cinder-ceph.status-fingerprint'
+WORKLOAD_STATUS_KEY = 'cinder-ceph.workload-status'
+RESTART_QUEUE_KEY = 'cinder-ceph.restart-queue'
+RESTART_METRICS_KEY = 'cinder-ceph.restart-metrics'
+RESTART_METRICS_KEEP = 20
+# unitdata key recording the pools ceph-mon did not apply the requested rbd
+# configuration to
+RBD_CONFIG_UNAPPLIED_KEY = 'cinder-ceph.rbd-config-unapplied'
+# Longest wait for a scheduled restart within a hook, restarts due later are
+# left to a later hook (update-status runs every few minutes).
+RESTART_MAX_HOOK_WAIT = 60
+
 TEMPLATES = 'templates/'
 
 # Map config files to hook contexts and services that will be associated
@@ -88,10 +128,32 @@ def register_configs():
                             CEPH_CONF, ceph_config_file())
         CONFIG_FILES[ceph_config_file()] = {
             'hook_contexts': [context.CephContext(),
-                              cinder_contexts.CephAccessContext()],
+                              cinder_contexts.CephAccessContext(),
+                              cinder_contexts.RBDClientTuningContext(),
+                              cinder_contexts.RBDDataPoolContext()],
             'services': ['cinder-volume'],
         }
         confs.append(ceph_config_file())
+        # rbd-backends name their data pool in a ceph.conf of their own when
+        # it differs from the one of the default backend.
+        try:
+            backends = cinder_contexts.get_backends()
+        except ValueError:
+            backends = []
+        for backend in backends:
+            if not cinder_contexts.backend_has_ceph_config(backend):
+                continue
+            path = cinder_contexts.backend_ceph_config_file(backend)
+            mkdir(os.path.dirname(path))
+            CONFIG_FILES[path] = {
+                'hook_contexts': [
+                    context.CephContext(),
+                    cinder_contexts.CephAccessContext(),
+                    cinder_contexts.RBDClientTuningContext(),
+                    cinder_contexts.RBDDataPoolContext(backend['name'])],
+                'services': ['cinder-volume'],
+            }
+            confs.append(path)
 
     for conf in confs:
         configs.register(conf, CONFIG_FILES[conf]['hook_contexts'])
@@ -117,6 +179,219 @@ def restart_map():
     return OrderedDict(_map)
 
 
+def status_fingerprint():
+    """Fingerprint the inputs of the workload status assessment.
+
+    Covers the charm configuration, the units on the required relations,
+    the paused and upgrading flags and the versions of the installed
+    packages.  Changes to relation data always run a relation hook which
+    re-assesses the workload status, so relation data is not part of the
+    fingerprint.
+
+    :returns: Hex digest of the inputs.
+    :rtype: str
+    """
+    relations = {}
+    for interfaces in REQUIRED_INTERFACES.values():
+        for interface in interfaces:
+            relations[interface] = {
+                rid: sorted(related_units(rid))
+                for rid in relation_ids(interface)}
+    data = {
+        'config': dict(config() or {}),
+        'relations': relations,
+        'paused': is_unit_paused_set(),
+        'upgrading': is_unit_upgrading_set(),
+        'versions': {pkg: get_upstream_version(pkg)
+                     for pkg in PACKAGES + [VERSION_PACKAGE]},
+    }
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+def application_unit_numbers():
+    """Unit numbers of the application, from the Juju goal state.
+
+    :returns: The sorted unit numbers, None if they cannot be told.
+    :rtype: Optional[List[int]]
+    """
+    try:
+        units = goal_state().get('units') or {}
+    except (NotImplementedError, CalledProcessError, ValueError) as e:
+        log('Could not read the goal state: {}'.format(e), level=WARNING)
+        return None
+    return sorted(int(unit.split('/')[1]) for unit in units) or None
+
+
+def restart_delay():
+    """Seconds to wait before a restart requested on all units at once.
+
+    The units of the application are ordered by unit number and split in
+    groups of restart-max-concurrent consecutive units, group n restarts
+    n * restart-min-gap seconds after the restart was requested.  Units do
+    not share state, the grouping relies on all units reading the same goal
+    state.  Without the unit numbers, or when this unit is not part of them
+    yet, the restart is not delayed.
+
+    :rtype: int
+    """
+    max_concurrent = config('restart-max-concurrent')
+    if not max_concurrent or max_concurrent < 1:
+        return 0
+    unit_numbers = application_unit_numbers()
+    unit_number = int(local_unit().split('/')[1])
+    if not unit_numbers or unit_number not in unit_numbers:
+        return 0
+    group = unit_numbers.index(unit_number) // max_concurrent
+    return group * (config('restart-min-gap') or 0)
+
+
+def restart_functions():
+    """Restart functions of the services of restart_map().
+
+    To be passed to restart_on_change() so the restarts triggered by
+    configuration changes go through restart_unless_scheduled().
+
+    :rtype: Dict[str, Callable[[str], None]]
+    """
+    return {'cinder-volume': restart_unless_scheduled}
+
+
+def restart_unless_scheduled(service):
+    """Restart service unless a staggered restart of it is queued.
+
+    The queued restart picks up the configuration written in the hook as
+    well, restarting the service now would restart it twice and the first
+    time on all units at once.
+
+    :param service: Name of the service to restart.
+    :type service: str
+    """
+    if service in (kv().get(RESTART_QUEUE_KEY) or {}):
+        log('Restart of {} left to the scheduled restart'.format(service),
+            level=DEBUG)
+        return
+    service_restart(service)
+
+
+def schedule_restart(service):
+    """Queue a staggered restart of service, see restart_delay().
+
+    A restart already queued for service is kept as it is.  Without a delay
+    the restart is left to the end of the hook, where it is coalesced with
+    the other restarts of service in the hook.
+
+    :param service: Name of the service to restart.
+    :type service: str
+    """
+    db = kv()
+    queue = db.get(RESTART_QUEUE_KEY) or {}
+    if service in queue:
+        log('Restart of {} already scheduled'.format(service), level=DEBUG)
+        return
+    delay = restart_delay()
+    if not delay:
+        defer_restart(service)
+        return
+    now = time.time()
+    queue[service] = {'requested': now, 'not-before': now + delay}
+    db.set(RESTART_QUEUE_KEY, queue)
+    if not db.revision:
+        db.flush()
+    log('Scheduled restart of {} in {}s'.format(service, delay))
+
+
+def run_scheduled_restarts(max_wait=RESTART_MAX_HOOK_WAIT):
+    """Restart the queued services that are due.
+
+    Restarts due within max_wait seconds are waited for, later ones stay
+    queued.  Nothing is restarted while the unit is paused.  The time from
+    the request to the restart is kept in the unit kv store under
+    RESTART_METRICS_KEY.
+
+    :param max_wait: Longest time to wait for a restart, in seconds.
+    :type max_wait: int
+    :returns: The restarted services.
+    :rtype: List[str]
+    """
+    db = kv()
+    queue = db.get(RESTART_QUEUE_KEY) or {}
+    if not queue or is_unit_paused_set():
+        return []
+    metrics = db.get(RESTART_METRICS_KEY) or []
+    restarted = []
+    for service, entry in sorted(queue.items(),
+                                 key=lambda item: item[1]['not-before']):
+        wait = entry['not-before'] - time.time()
+        if wait > max_wait:
+            log('Restart of {} deferred for {:.0f}s'.format(service, wait))
+            continue
+        if wait > 0:
+            status_set('maintenance', 'Waiting {:.0f} seconds to restart {}'
+                       .format(wait, service))
+            time.sleep(wait)
+        service_restart(service)
+        now = time.time()
+        latency = now - entry['requested']
+        log('Restarted {} {:.1f}s after it was requested'
+            .format(service, latency))
+        metrics.append({'service': service,
+                        'requested': entry['requested'],
+                        'restarted': now,
+                        'latency': round(latency, 3)})
+        del queue[service]
+        restarted.append(service)
+    db.set(RESTART_QUEUE_KEY, queue)
+    db.set(RESTART_METRICS_KEY, metrics[-RESTART_METRICS_KEEP:])
+    if not db.revision:
+        db.flush()
+    return restarted
+
+
+def check_rbd_config(request):
+    """Check that ceph-mon applied the rbd configuration of a request.
+
+    The rbd-qos-* limits are sent as the rbd-config key of the create pool
+    operations.  ceph-mon charms whose broker does not know the key ignore
+    it and still report the request as complete, so the pool level
+    configuration is read back once the request completed.  The pools
+    lacking the requested configuration are recorded for assess_status().
+
+    :param request: Completed broker request.
+    :type request: CephBrokerRq
+    :returns: Names of the pools lacking requested rbd configuration.
+    :rtype: List[str]
+    """
+    unapplied = []
+    for op in request.ops:
+        settings = op.get('rbd-config')
+        if not settings:
+            continue
+        try:
+            current = get_rbd_pool_config(service_name(), op['name'])
+        except (CalledProcessError, ValueError) as e:
+            log('Could not read the rbd configuration of pool {}: {}'
+                .format(op['name'], e), level=WARNING)
+            current = {}
+        if any(current.get(key) != str(value)
+               for key, value in settings.items()):
+            unapplied.append(op['name'])
+    if unapplied:
+        log('ceph-mon did not apply the rbd configuration of pool(s) {}, '
+            'its broker may not support rbd-config'
+            .format(', '.join(unapplied)), level=WARNING)
+    kv().set(RBD_CONFIG_UNAPPLIED_KEY, unapplied)
+    return unapplied
+
+
+def rbd_config_unapplied():
+    """Pools lacking requested rbd configuration, see check_rbd_config().
+
+    :rtype: List[str]
+    """
+    return kv().get(RBD_CONFIG_UNAPPLIED_KEY) or []
+
+
 def scrub_old_style_ceph():
     """Purge any legacy ceph configuration from install"""
     # NOTE: purge old override file - no longer needed
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cold start of the charm's hook entry points.
+
+For every hook name the hook module is imported in a fresh interpreter, as
+Juju does when it runs the hook, and the import time, the number of modules
+loaded and the external commands run during the import are reported.  The
+Juju hook tools are replaced by stand-ins answering with empty data so the
+benchmark can run outside of a unit:
+
+    ./tools/startup_benchmark.py
+    ./tools/startup_benchmark.py --runs 10 update-status config-changed
+    ./tools/startup_benchmark.py --json > startup.json
+
+A single module can be measured instead of the hook module, and the run
+made to fail if importing it runs any command:
+
+    ./tools/startup_benchmark.py --module charmhelpers.fetch \\
+        --assert-no-commands update-status
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHARM_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HOOKS_DIR = os.path.join(CHARM_DIR, 'hooks')
+HOOK_MODULE = 'cinder_hooks'
+
+# Output of the hook tool stand-ins, tools not listed print nothing.
+HOOK_TOOLS = {
+    'action-get': '{}',
+    'config-get': '{}',
+    'is-leader': 'false',
+    'leader-get': '{}',
+    'related-units': '[]',
+    'relation-get': '{}',
+    'relation-ids': '[]',
+    'relation-list': '[]',
+    'unit-get': '127.0.0.1',
+    'application-version-set': '',
+    'juju-log': '',
+    'leader-set': '',
+    'relation-set': '',
+    'status-get': '{"status": "unknown", "message": ""}',
+    'status-set': '',
+}
+
+# Run in the child interpreter, prints the measurements as JSON.
+PROBE = """
+import json, sys, time
+sys.path.insert(0, {hooks_dir!r})
+before = len(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+from charmhelpers.core import hookenv
+profile = hookenv.disable_hook_profile()
+print(json.dumps({{
+    'import-time': elapsed,
+    'modules': len(sys.modules) - before,
+    'commands': [r['command'] for r in profile.records] if profile else [],
+}}))
+"""
+
+
+def hook_names():
+    """Hook names implemented by the hook module.
+
+    :rtype: List[str]
+    """
+    target = os.path.join(HOOKS_DIR, HOOK_MODULE + '.py')
+    return sorted(
+        name for name in os.listdir(HOOKS_DIR)
+        if os.path.islink(os.path.join(HOOKS_DIR, name)) and
+        os.path.realpath(os.path.join(HOOKS_DIR, name)) == target)
+
+
+def install_hook_tools(path):
+    """Write the hook tool stand-ins to path."""
+    for tool, output in HOOK_TOOLS.items():
+        script = os.path.join(path, tool)
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\n')
+            if output:
+                f.write("echo '{}'\n".format(output))
+        os.chmod(script, 0o755)
+
+
+def measure(hook, module, workdir, env):
+    """Import module once as hook.
+
+    :returns: Measurements of the import.
+    :rtype: Dict[str, Any]
+    """
+    env = dict(env,
+               JUJU_HOOK_NAME=hook,
+               UNIT_STATE_DB=os.path.join(workdir, 'unit-state.db'))
+    probe = PROBE.format(hooks_dir=HOOKS_DIR, module=module)
+    output = subprocess.check_output(
+        [sys.executable, '-c', probe], env=env, cwd=CHARM_DIR,
+        universal_newlines=True)
+    return json.loads(output.splitlines()[-1])
+
+
+def benchmark(hooks, runs, module=HOOK_MODULE):
+    """Measure the cold start of hooks.
+
+    :param hooks: Names of the hooks to measure.
+    :type hooks: List[str]
+    :param runs: Number of imports per hook.
+    :type runs: int
+    :param module: Module to import.
+    :type module: str
+    :returns: Measurements per hook.
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    workdir = tempfile.mkdtemp(prefix='startup-benchmark-')
+    try:
+        bindir = os.path.join(workdir, 'bin')
+        os.mkdir(bindir)
+        install_hook_tools(bindir)
+        env = dict(os.environ,
+                   PATH=os.pathsep.join([bindir, os.environ.get('PATH', '')]),
+                   CHARM_DIR=CHARM_DIR,
+                   JUJU_UNIT_NAME='cinder-ceph/0',
+                   CHARM_HOOK_PROFILE=os.path.join(workdir, 'profiles'))
+        results = {}
+        for hook in hooks:
+            samples = [measure(hook, module, workdir, env)
+                       for _ in range(runs)]
+            times = [s['import-time'] for s in samples]
+            results[hook] = {
+                'runs': runs,
+                'min': min(times),
+                'median': statistics.median(times),
+                'max': max(times),
+                'modules': samples[-1]['modules'],
+                'commands': samples[-1]['commands'],
+            }
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('hooks', nargs='*',
+                        help='hooks to measure, defaults to all hooks')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='imports per hook (default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the measurements as JSON')
+    parser.add_argument('--module', default=HOOK_MODULE,
+                        help='module to import (default: %(default)s)')
+    parser.add_argument('--assert-no-commands', action='store_true',
+                        help='fail if an import runs any command')
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.hooks or hook_names(), args.runs,
+                        module=args.module)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+    if args.assert_no_commands:
+        forking = {hook: result['commands']
+                   for hook, result in results.items() if result['commands']}
+        for hook, commands in sorted(forking.items()):
+            print('{} ran: {}'.format(hook, ', '.join(commands)),
+                  file=sys.stderr)
+        if forking:
+            sys.exit(1)
+
+
+def report(results):
+    """Print the measurements as a table."""
+    print('{:<36} {:>9} {:>9} {:>8} {:>9}'.format(
+        'hook', 'median ms', 'min ms', 'modules', 'commands'))
+    for hook, result in sorted(results.items()):
+        print('{:<36} {:>9.1f} {:>9.1f} {:>8} {:>9}'.format(
+            hook, result['median'] * 1000, result['min'] * 1000,
+            result['modules'], len(result['commands'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import MagicMock, patch
+import cinder_utils as utils
+
+from charmhelpers.contrib.storage.linux import ceph_client
+
+from test_utils import (
+    CharmTestCase,
+)
+
+# Need to do some early patching to get the module loaded.
+_register_configs = utils.register_configs
+utils.register_configs = MagicMock()
+import actions  # noqa
+utils.register_configs = _register_configs
+
+TO_PATCH = [
+    'action_fail',
+    'action_get',
+    'action_set',
+    'cinder_hooks',
+    'plan_request_pgs',
+    'service_name',
+]
+
+
+class TestShowPGPlan(CharmTestCase):
+
+    def setUp(self):
+        super(TestShowPGPlan, self).setUp(actions, TO_PATCH)
+        self.service_name.return_value = 'cinder-ceph'
+        self.action_get.side_effect = {'pgs-per-osd': 200,
+                                       'expected-osd-count': None}.get
+
+    def test_show_pg_plan(self):
+        self.plan_request_pgs.return_value = 'pool size osds ratio pg_num'
+        actions.main(['actions/show-pg-plan'])
+        self.plan_request_pgs.assert_called_once_with(
+            'cinder-ceph', self.cinder_hooks.get_ceph_request(),
+            pgs_per_osd=200, expected_osd_count=None)
+        self.action_set.assert_called_once_with(
+            {'plan': 'pool size osds ratio pg_num'})
+        self.action_fail.assert_not_called()
+
+    def test_show_pg_plan_closes_client(self):
+        mon = ceph_client.FakeMonClient('cinder-ceph')
+        ceph_client.set_client_factory(lambda service: mon)
+        self.addCleanup(ceph_client.set_client_factory)
+        self.plan_request_pgs.side_effect = (
+            lambda service, rq, **kwargs: ceph_client.get_client(service))
+        with patch.object(ceph_client, 'atexit'), \
+                patch.object(mon, 'shutdown') as shutdown:
+            actions.main(['actions/show-pg-plan'])
+            shutdown.assert_called_once_with()
+        self.assertEqual(ceph_client._clients, {})
+
+    def test_show_pg_plan_no_topology(self):
+        self.plan_request_pgs.return_value = None
+        actions.main(['actions/show-pg-plan'])
+        self.action_set.assert_not_called()
+        self.action_fail.assert_called_once_with(
+            'Could not read the cluster topology')
+
+    def test_show_pg_plan_invalid_config(self):
+        self.cinder_hooks.get_ceph_request.side_effect = ValueError('invalid')
+        actions.main(['actions/show-pg-plan'])
+        self.action_fail.assert_called_once_with('invalid')
+
+    def test_unknown_action(self):
+        self.assertEqual(actions.main(['actions/foo']),
+                         'Action foo undefined')
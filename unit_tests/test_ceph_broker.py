@@ -0,0 +1,151 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+from unittest import mock
+
+from charmhelpers.contrib.storage.linux import ceph
+from charmhelpers.core import unitdata
+
+UNIT = 'cinder-ceph/0'
+MON = 'ceph-mon/0'
+RID = 'ceph:1'
+
+
+def pool_op(name):
+    return {'op': 'create-pool', 'name': name, 'replicas': 3}
+
+
+def request(*names):
+    rq = ceph.CephBrokerRq()
+    for name in names:
+        rq.add_op(pool_op(name))
+    return rq
+
+
+class TestBrokerOpTracking(unittest.TestCase):
+
+    def setUp(self):
+        # relation data by unit, of the single ceph relation
+        self.data = {UNIT: {}, MON: {}}
+        self.db = unitdata.Storage(':memory:')
+        for name, value in [
+                ('local_unit', mock.Mock(return_value=UNIT)),
+                ('relation_ids', mock.Mock(return_value=[RID])),
+                ('related_units', mock.Mock(return_value=[MON])),
+                ('relation_snapshot', self.snapshot),
+                ('relation_snapshot_get', self.snapshot_get),
+                ('relation_set', mock.Mock(side_effect=self.relation_set)),
+                ('kv', lambda: self.db),
+                ('log', mock.Mock())]:
+            patcher = mock.patch.object(ceph, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def snapshot(self, rid=None, unit=None):
+        return self.data.get(unit, {})
+
+    def snapshot_get(self, attribute, rid=None, unit=None):
+        return self.snapshot(rid, unit).get(attribute)
+
+    def relation_set(self, relation_id=None, relation_settings=None,
+                     **kwargs):
+        self.data[UNIT].update(relation_settings or {}, **kwargs)
+
+    def sent_ops(self):
+        return [op['name'] for op in
+                json.loads(self.data[UNIT]['broker_req'])['ops']]
+
+    def respond(self, exit_code=0):
+        request_id = json.loads(self.data[UNIT]['broker_req'])['request-id']
+        self.data[MON]['broker-rsp-cinder-ceph-0'] = json.dumps(
+            {'request-id': request_id, 'exit-code': exit_code})
+
+    def test_completion(self):
+        rq = request('a', 'b')
+        self.assertFalse(ceph.is_request_sent(rq))
+        ceph.send_request_if_needed(rq)
+        self.assertEqual(self.sent_ops(), ['a', 'b'])
+        self.assertTrue(ceph.is_request_sent(rq))
+        self.assertFalse(ceph.is_request_complete(rq))
+        self.respond(exit_code=1)
+        self.assertFalse(ceph.is_request_complete(rq))
+        self.respond()
+        self.assertTrue(ceph.is_request_complete(rq))
+        # a functionally equivalent request is complete as well
+        self.assertTrue(ceph.is_request_complete(request('a', 'b')))
+
+    def test_partial_resend(self):
+        ceph.send_request_if_needed(request('a', 'b'))
+        self.respond()
+        rq = request('a', 'c')
+        self.assertFalse(ceph.is_request_sent(rq))
+        self.assertFalse(ceph.is_request_complete(rq))
+        ceph.send_request_if_needed(rq)
+        self.assertEqual(self.sent_ops(), ['c'])
+        self.assertTrue(ceph.is_request_sent(rq))
+        self.assertFalse(ceph.is_request_complete(rq))
+        self.respond()
+        self.assertTrue(ceph.is_request_complete(rq))
+
+    def test_pre_digest_request(self):
+        # request sent by a charm not tracking ops, not processed yet
+        previous = request('a', 'b')
+        self.data[UNIT]['broker_req'] = previous.request
+        rq = request('a', 'b')
+        self.assertTrue(ceph.is_request_sent(rq))
+        self.assertFalse(ceph.is_request_complete(rq))
+        self.respond()
+        self.assertTrue(ceph.is_request_complete(rq))
+        # an op missing from the previous request is sent on its own
+        rq = request('a', 'b', 'c')
+        self.assertFalse(ceph.is_request_sent(rq))
+        ceph.send_request_if_needed(rq)
+        self.assertEqual(self.sent_ops(), ['c'])
+
+    def test_lost_records(self):
+        ceph.send_request_if_needed(request('a', 'b'))
+        self.respond()
+        rq = request('a', 'b', 'c')
+        ceph.send_request_if_needed(rq)
+        self.assertEqual(self.sent_ops(), ['c'])
+        self.respond()
+        self.assertTrue(ceph.is_request_complete(rq))
+        # the records are rebuilt from the last request, holding c only
+        self.db = unitdata.Storage(':memory:')
+        self.assertFalse(ceph.is_request_complete(rq))
+        self.assertFalse(ceph.is_request_sent(rq))
+        ceph.send_request_if_needed(rq)
+        self.assertEqual(self.sent_ops(), ['a', 'b'])
+        self.respond()
+        self.assertTrue(ceph.is_request_complete(rq))
+
+    def test_failed_hook_not_recorded(self):
+        key = ceph.BROKER_OPS_KEY.format(RID)
+        ceph.send_request_if_needed(request('a'))
+        # the end of the hook
+        self.db.flush()
+        records = self.db.get(key)
+        data = json.loads(json.dumps(self.data))
+        rq = request('a', 'b')
+        ceph.send_request_if_needed(rq)
+        # the hook fails, neither its relation settings nor its records are
+        # committed
+        self.data = data
+        self.db.flush(False)
+        self.assertEqual(self.db.get(key), records)
+        self.assertFalse(ceph.is_request_sent(rq))
+        ceph.send_request_if_needed(rq)
+        self.assertEqual(self.sent_ops(), ['a', 'b'])
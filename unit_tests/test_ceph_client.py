@@ -0,0 +1,183 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+from unittest import mock
+
+from charmhelpers.contrib.storage.linux import ceph, ceph_client
+
+
+class TestCephClient(unittest.TestCase):
+
+    def setUp(self):
+        self.mon = ceph_client.FakeMonClient(
+            'cinder-ceph',
+            pools={'cinder-ceph': {'cache_mode': 'none'}},
+            osds=[0, 1, 2], osd_classes={'ssd': [2]},
+            erasure_profiles={'ec': {'k': '4', 'm': '2'}},
+            config_keys={'key': 'value'})
+        ceph_client.set_client_factory(lambda service: self.mon)
+        self.addCleanup(ceph_client.set_client_factory)
+        patcher = mock.patch.object(ceph_client, 'atexit')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_client_shared(self):
+        client = ceph_client.get_client('cinder-ceph')
+        self.assertIs(ceph_client.get_client('cinder-ceph'), client)
+        ceph_client.atexit.assert_called_once_with(ceph_client.close_clients)
+
+    def test_abstract(self):
+        class Incomplete(ceph_client.CephClient):
+            def list_pools(self):
+                return []
+
+        self.assertRaises(TypeError, Incomplete, 'cinder-ceph')
+
+    def test_client_scope(self):
+        other = ceph_client.FakeMonClient('admin')
+        ceph_client.set_client_factory(
+            {'cinder-ceph': self.mon, 'admin': other}.get)
+        for client in self.mon, other:
+            patcher = mock.patch.object(client, 'shutdown')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        ceph_client.get_client('cinder-ceph')
+        with ceph_client.client_scope():
+            self.assertIs(ceph_client.get_client('cinder-ceph'), self.mon)
+            self.assertIs(ceph_client.get_client('admin'), other)
+        # only the client opened within the block is closed
+        other.shutdown.assert_called_once_with()
+        self.mon.shutdown.assert_not_called()
+        self.assertIs(ceph_client.get_client('cinder-ceph'), self.mon)
+
+    @mock.patch.object(ceph, 'cmp_pkgrevno')
+    def test_queries(self, cmp_pkgrevno):
+        cmp_pkgrevno.return_value = 1
+        self.assertTrue(ceph.pool_exists('cinder-ceph', 'cinder-ceph'))
+        self.assertFalse(ceph.pool_exists('cinder-ceph', 'glance'))
+        self.assertEqual(ceph.get_osds('cinder-ceph'), [0, 1, 2])
+        self.assertEqual(ceph.get_osds('cinder-ceph', 'ssd'), [2])
+        self.assertEqual(ceph.get_cache_mode('cinder-ceph', 'cinder-ceph'),
+                         'none')
+        self.assertEqual(ceph.get_erasure_profile('cinder-ceph', 'ec'),
+                         {'k': '4', 'm': '2'})
+        self.assertIsNone(ceph.get_erasure_profile('cinder-ceph', 'other'))
+        self.assertEqual(ceph.monitor_key_get('cinder-ceph', 'key'), 'value')
+        self.assertTrue(ceph.monitor_key_exists('cinder-ceph', 'key'))
+        self.assertFalse(ceph.monitor_key_exists('cinder-ceph', 'other'))
+
+    @mock.patch.object(ceph, 'cmp_pkgrevno')
+    def test_pool_properties(self, cmp_pkgrevno):
+        cmp_pkgrevno.return_value = 1
+        ceph.update_pool('cinder-ceph', 'cinder-ceph',
+                         {'size': '3', 'min_size': '2'})
+        ceph.set_pool_quota('cinder-ceph', 'cinder-ceph', max_bytes=1024)
+        ceph.set_app_name_for_pool('cinder-ceph', 'cinder-ceph', 'rbd')
+        pool = json.loads(self.mon.mon_command('osd dump'))['pools'][0]
+        self.assertEqual(pool['size'], '3')
+        self.assertEqual(pool['min_size'], '2')
+        self.assertEqual(pool['quota_max_bytes'], 1024)
+        self.assertEqual(pool['application_metadata'], {'rbd': {}})
+
+    @mock.patch.object(ceph, 'enabled_manager_modules')
+    @mock.patch.object(ceph, 'cmp_pkgrevno')
+    def test_pool_autoscale(self, cmp_pkgrevno, enabled_manager_modules):
+        cmp_pkgrevno.return_value = 1
+        enabled_manager_modules.return_value = ['pg_autoscaler']
+        rq = ceph.CephBrokerRq()
+        rq.add_op_create_replicated_pool(
+            'cinder-ceph', weight=20, target_size_ratio=0.2,
+            target_size_bytes=4096, pg_autoscale_mode='warn')
+        op = rq.ops[0]
+        self.assertEqual((op['target-size-ratio'], op['target-size-bytes'],
+                          op['pg-autoscale-mode']), (0.2, 4096, 'warn'))
+        ceph.ReplicatedPool('cinder-ceph', op=op).set_autoscale()
+        pool = self.mon.pools['cinder-ceph']
+        self.assertEqual((pool['target_size_bytes'],
+                          pool['target_size_ratio'],
+                          pool['pg_autoscale_mode']), ('4096', '0', 'warn'))
+
+        # new pools default to the weight and autoscaling on
+        rq = ceph.CephBrokerRq()
+        rq.add_op_create_replicated_pool('cinder-ceph', weight=20)
+        self.assertNotIn('target-size-ratio', rq.ops[0])
+        pool = ceph.ReplicatedPool('cinder-ceph', op=rq.ops[0])
+        self.mon.pools['cinder-ceph'] = {}
+        pool.set_autoscale()
+        self.assertEqual(self.mon.pools['cinder-ceph'], {})
+        pool.set_autoscale(defaults=True)
+        self.assertEqual(self.mon.pools['cinder-ceph'], {
+            'target_size_ratio': '0.2', 'pg_autoscale_mode': 'on'})
+
+        self.assertRaises(ValueError, rq.add_op_create_replicated_pool,
+                          'cinder-ceph', pg_autoscale_mode='always')
+
+    @mock.patch.object(ceph, 'check_call')
+    @mock.patch.object(ceph, 'check_output')
+    @mock.patch.object(ceph, 'cmp_pkgrevno')
+    def test_pool_limits(self, cmp_pkgrevno, check_output, check_call):
+        cmp_pkgrevno.return_value = 1
+        check_output.return_value = json.dumps([
+            {'name': 'rbd_qos_iops_limit', 'value': '500', 'source': 'pool'},
+            {'name': 'rbd_qos_bps_limit', 'value': '0', 'source': 'config'},
+        ]).encode('UTF-8')
+        rq = ceph.CephBrokerRq()
+        rq.add_op_create_replicated_pool(
+            'cinder-ceph', max_bytes=1024, max_objects=0,
+            rbd_config={'rbd_qos_iops_limit': 500,
+                        'rbd_qos_bps_limit': 1048576})
+        self.mon.pools['cinder-ceph']['quota_max_objects'] = 10
+        pool = ceph.ReplicatedPool('cinder-ceph', op=rq.ops[0])
+        pool.set_quota()
+        pool.set_rbd_config()
+        self.assertEqual(
+            (self.mon.pools['cinder-ceph']['quota_max_bytes'],
+             self.mon.pools['cinder-ceph']['quota_max_objects']), (1024, 0))
+        check_output.assert_called_once_with([
+            'rbd', '--id', 'cinder-ceph', 'config', 'pool', 'list',
+            'cinder-ceph', '--format', 'json'])
+        check_call.assert_called_once_with([
+            'rbd', '--id', 'cinder-ceph', 'config', 'pool', 'set',
+            'cinder-ceph', 'rbd_qos_bps_limit', '1048576'])
+
+        # nothing is set when the pool is up to date
+        del self.mon.commands[:]
+        pool.set_quota()
+        self.assertEqual(self.mon.commands,
+                         [('osd pool get-quota', 'cinder-ceph')])
+
+        self.assertRaises(ValueError, rq.add_op_create_replicated_pool,
+                          'cinder-ceph', rbd_config={'qos_iops_limit': 1})
+
+
+class TestRadosCephClient(unittest.TestCase):
+
+    def test_mon_command(self):
+        rados = mock.MagicMock()
+        cluster = rados.Rados.return_value
+        cluster.mon_command.return_value = (0, b'[0]', '')
+        client = ceph_client.RadosCephClient('cinder-ceph', rados)
+        rados.Rados.assert_called_once_with(
+            rados_id='cinder-ceph', conffile=ceph_client.CEPH_CONF_FILE)
+        self.assertEqual(client.mon_command('osd pool set', 'p', 'size', 3,
+                                            fmt=None), '[0]')
+        cluster.mon_command.assert_called_once_with(json.dumps(
+            {'prefix': 'osd pool set', 'pool': 'p', 'var': 'size',
+             'val': '3'}), b'')
+        cluster.mon_command.return_value = (-2, b'', 'not found')
+        with self.assertRaises(ceph_client.CephCommandError) as e:
+            client.mon_command('config-key exists', 'key')
+        self.assertEqual(e.exception.returncode, 2)
@@ -0,0 +1,166 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+from charmhelpers.contrib.storage.linux import ceph, ceph_client, ceph_pgs
+
+# two hosts with one NVMe and two HDD OSDs each
+CRUSH_NODES = [
+    {'id': -1, 'name': 'default', 'type': 'root', 'children': [-2, -3]},
+    {'id': -2, 'name': 'host-a', 'type': 'host', 'children': [0, 2, 3]},
+    {'id': -3, 'name': 'host-b', 'type': 'host', 'children': [1, 4, 5]},
+] + [
+    {'id': osd, 'name': 'osd.{}'.format(osd), 'type': 'osd',
+     'device_class': 'nvme' if osd < 2 else 'hdd'}
+    for osd in range(6)
+]
+CRUSH_RULES = [
+    {'rule_id': 0, 'rule_name': 'replicated_rule',
+     'steps': [{'op': 'take', 'item': -1, 'item_name': 'default'},
+               {'op': 'chooseleaf_firstn', 'num': 0, 'type': 'host'},
+               {'op': 'emit'}]},
+    {'rule_id': 1, 'rule_name': 'replicated_nvme',
+     'steps': [{'op': 'take', 'item': -4, 'item_name': 'default~nvme'},
+               {'op': 'chooseleaf_firstn', 'num': 0, 'type': 'host'},
+               {'op': 'emit'}]},
+]
+
+
+class TestPGPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.mon = ceph_client.FakeMonClient(
+            'admin', osds=list(range(6)),
+            pools={'rbd': {'size': 3, 'crush_rule': 0,
+                           'options': {'target_size_ratio': 0.5}}},
+            crush_nodes=CRUSH_NODES, crush_rules=CRUSH_RULES)
+        ceph_client.set_client_factory(lambda service: self.mon)
+        self.addCleanup(ceph_client.set_client_factory)
+        self.addCleanup(ceph_pgs.reset_topology)
+        for module, name, value in [(ceph_client, 'atexit', None),
+                                    (ceph, 'cmp_pkgrevno', -1),
+                                    (ceph, 'config', None)]:
+            patcher = mock.patch.object(module, name)
+            patcher.start().return_value = value
+            self.addCleanup(patcher.stop)
+
+    def test_round_pgs(self):
+        self.assertEqual(ceph_pgs.round_pgs(0.5), 2)
+        self.assertEqual(ceph_pgs.round_pgs(36.4), 32)
+        self.assertEqual(ceph_pgs.round_pgs(44), 64)
+
+    def test_topology(self):
+        with mock.patch.object(self.mon, 'shutdown') as shutdown:
+            topology = ceph_pgs.get_topology('admin')
+            # no hook closes the client of an action
+            shutdown.assert_called_once_with()
+        self.assertIs(ceph_pgs.get_topology('admin'), topology)
+        self.assertEqual(len(self.mon.commands), 3)
+        self.assertEqual(topology.rule_osds(None), frozenset(range(6)))
+        self.assertEqual(topology.rule_osds('replicated_nvme'),
+                         frozenset([0, 1]))
+        self.assertEqual(topology.bucket_osds('host-a', 'hdd'),
+                         frozenset([2, 3]))
+        self.assertEqual(topology.rule_osds('missing'), frozenset())
+
+    def test_plan(self):
+        planner = ceph_pgs.PGPlanner(ceph_pgs.get_topology('admin'))
+        fast, bulk, orphan = planner.plan([
+            ceph_pgs.PoolSpec('fast', 3, 10, rule='replicated_nvme'),
+            ceph_pgs.PoolSpec('bulk', 6, 60, device_class='hdd'),
+            ceph_pgs.PoolSpec('orphan', 3, 10, rule='missing')])
+        # fast shares its OSDs with rbd only, bulk shares them with rbd too
+        # and together they claim 110% of the HDDs
+        self.assertEqual((fast.osds, fast.ratio, fast.pg_num),
+                         (2, 0.1, 8))
+        self.assertEqual(bulk.osds, 4)
+        self.assertAlmostEqual(bulk.ratio, 0.6 / 1.1)
+        self.assertEqual(bulk.pg_num, 32)
+        self.assertIsNone(orphan.pg_num)
+        report = planner.report([fast, bulk, orphan]).splitlines()
+        self.assertEqual(report[1].split(), ['fast', '3', '2', '0.1000', '8'])
+        self.assertEqual(report[3].split()[-1], '-')
+
+    def test_plan_expected_osd_count(self):
+        planner = ceph_pgs.PGPlanner(ceph_pgs.get_topology('admin'),
+                                     pgs_per_osd=200, expected_osd_count=12)
+        pool, fast = planner.plan([
+            ceph_pgs.PoolSpec('glance', 3, 20),
+            ceph_pgs.PoolSpec('fast', 3, 10, rule='replicated_nvme')])
+        # 200 * 12 * 0.2 / 3 = 160 and 200 * 2 * 0.1 / 3 = 13.3
+        self.assertEqual((pool.osds, pool.pg_num), (12, 128))
+        self.assertEqual((fast.osds, fast.pg_num), (2, 16))
+
+    @mock.patch.object(ceph, 'pool_exists')
+    @mock.patch.object(ceph, 'check_call')
+    def test_replicated_pool_create(self, check_call, pool_exists):
+        pool_exists.return_value = False
+        pool = ceph.ReplicatedPool('admin', name='fast', replicas=3,
+                                   percent_data=10,
+                                   crush_profile='replicated_nvme')
+        with mock.patch.object(pool, '_post_create'), \
+                mock.patch.object(pool, 'update'):
+            pool.create()
+        check_call.assert_called_once_with([
+            'ceph', '--id', 'admin', 'osd', 'pool', 'create', 'fast', '8',
+            '8', 'replicated', 'replicated_nvme'])
+        # the new pool is accounted for when sizing the next one
+        topology = ceph_pgs.get_topology('admin')
+        self.assertIn('fast', topology.pools)
+        entry, = ceph_pgs.PGPlanner(topology).plan([
+            ceph_pgs.PoolSpec('fast2', 3, 45, rule='replicated_nvme')])
+        self.assertAlmostEqual(entry.ratio, 0.45 / 1.05)
+        self.assertEqual(len(self.mon.commands), 3)
+
+    @mock.patch.object(ceph, 'pool_exists')
+    @mock.patch.object(ceph, 'check_call')
+    def test_replicated_pool_create_pg_num(self, check_call, pool_exists):
+        pool_exists.return_value = False
+        pool = ceph.ReplicatedPool('admin', name='fixed', replicas=3,
+                                   pg_num=8, percent_data=10,
+                                   crush_profile='replicated_nvme')
+        with mock.patch.object(pool, '_post_create'), \
+                mock.patch.object(pool, 'update'):
+            pool.create()
+        self.assertEqual(pool.pg_num, 8)
+        # the pool is recorded with its weight, not the 100% of the cap
+        topology = ceph_pgs.get_topology('admin')
+        self.assertAlmostEqual(topology.pools['fixed'][2], 0.1)
+        entry, = ceph_pgs.PGPlanner(topology).plan([
+            ceph_pgs.PoolSpec('next', 3, 40, rule='replicated_nvme')])
+        self.assertAlmostEqual(entry.ratio, 0.4)
+
+    def test_get_pgs_no_topology(self):
+        self.mon.crush_rules = None
+        self.mon._osd_tree = mock.Mock(
+            side_effect=ceph_client.CephCommandError(1, 'osd tree'))
+        pool = ceph.ReplicatedPool('admin', name='fast', replicas=3)
+        self.assertEqual(pool.get_pgs(3, 10), ceph.LEGACY_PG_COUNT)
+
+    def test_plan_request_pgs(self):
+        rq = ceph.CephBrokerRq()
+        rq.add_op_create_replicated_pool('fast', replica_count=3, weight=10,
+                                         crush_profile='replicated_nvme')
+        rq.add_op_create_erasure_profile('bulk-profile', k=4, m=2,
+                                         device_class='hdd')
+        rq.add_op_create_erasure_pool('bulk', erasure_profile='bulk-profile',
+                                      weight=60)
+        self.assertEqual(rq.pool_specs(), [
+            ceph_pgs.PoolSpec('fast', 3, 10, rule='replicated_nvme'),
+            ceph_pgs.PoolSpec('bulk', 6, 60, device_class='hdd')])
+        report = ceph.plan_request_pgs('admin', rq).splitlines()
+        self.assertEqual([line.split()[-1] for line in report[1:]],
+                         ['8', '32'])
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from unittest.mock import patch
+
 import cinder_contexts as contexts
 
 from test_utils import (
@@ -26,8 +28,22 @@ TO_PATCH = [
     'leader_get',
     'relation_ids',
     'related_units',
+    'log',
+    'CephBlueStoreCompressionContext',
 ]
 
+BACKENDS = '''
+- name: fast
+  device-class: nvme
+  weight: 10
+- name: bulk
+  device-class: hdd
+  pool-type: erasure-coded
+  ec-profile-k: 4
+  ec-profile-m: 2
+  compression-mode: aggressive
+'''
+
 
 class TestCinderContext(CharmTestCase):
 
@@ -35,6 +51,13 @@ class TestCinderContext(CharmTestCase):
         super(TestCinderContext, self).setUp(contexts, TO_PATCH)
         self.config.side_effect = self.test_config.get
         self.leader_get.return_value = 'libvirt-uuid'
+        self.CephBlueStoreCompressionContext().get_op.return_value = {
+            key: None for key in contexts.BACKEND_COMPRESSION_OPTIONS}
+        cmp_pkgrevno = patch(
+            'charmhelpers.contrib.storage.linux.ceph.cmp_pkgrevno',
+            return_value=1)
+        cmp_pkgrevno.start()
+        self.addCleanup(cmp_pkgrevno.stop)
         self.maxDiff = None
 
     def test_ceph_not_related(self):
@@ -241,3 +264,203 @@ class TestCinderContext(CharmTestCase):
             contexts.CephAccessContext()(),
             {'complete': True}
         )
+
+    def test_rbd_client_tuning_default(self):
+        self.assertEqual(contexts.RBDClientTuningContext()(), {})
+
+    def test_rbd_client_tuning_profile(self):
+        self.test_config.set('rbd-client-tuning-profile', 'latency')
+        self.test_config.set('rbd-client-tuning',
+                             'rbd_cache_size=16777216, '
+                             'objecter-inflight-ops=2048')
+        settings = contexts.RBDClientTuningContext()()[
+            'rbd_client_cache_settings']
+        self.assertEqual(list(settings.items()), [
+            ('objecter inflight ops', '2048'),
+            ('rbd cache', 'true'),
+            ('rbd cache max dirty', '0'),
+            ('rbd cache size', '16777216'),
+            ('rbd cache target dirty', '0'),
+            ('rbd cache writethrough until flush', 'true'),
+            ('rbd readahead max bytes', '0')])
+
+    def test_rbd_client_tuning_invalid(self):
+        for profile, overrides in [
+                ('fast', None),
+                (None, 'rbd_cache=maybe'),
+                (None, 'rbd_cache_size=-1'),
+                (None, 'debug_rbd=20'),
+                ('throughput', 'rbd_cache_size=1024')]:
+            self.test_config.set('rbd-client-tuning-profile', profile)
+            self.test_config.set('rbd-client-tuning', overrides)
+            ctxt = contexts.RBDClientTuningContext()
+            self.assertRaises(ValueError, ctxt.validate)
+            self.assertEqual(ctxt(), {})
+
+    def test_get_backends_unset(self):
+        self.assertEqual(contexts.get_backends(), [])
+
+    def test_get_backends(self):
+        self.service_name.return_value = 'cinder-ceph'
+        self.test_config.set('rbd-backends', BACKENDS)
+        self.test_config.set('ceph-pool-weight', 40)
+        fast, bulk = contexts.get_backends()
+        self.assertEqual(fast['section'], 'cinder-ceph-fast')
+        self.assertEqual(fast['volume-backend-name'], 'cinder-ceph-fast')
+        self.assertEqual(fast['pool'], 'cinder-ceph-fast')
+        self.assertEqual(fast['pool-type'], 'replicated')
+        self.assertEqual(fast['replicas'], 3)
+        self.assertEqual(fast['weight'], 10.0)
+        self.assertEqual(fast['crush-rule'], 'replicated_nvme')
+        self.assertEqual(bulk['pool-type'], 'erasure-coded')
+        self.assertEqual(bulk['weight'], 20.0)
+        self.assertEqual(bulk['metadata-pool'], 'cinder-ceph-bulk-metadata')
+        self.assertEqual(bulk['ec-profile-name'], 'cinder-ceph-bulk-profile')
+        self.assertEqual((bulk['ec-profile-k'], bulk['ec-profile-m']), (4, 2))
+        self.assertEqual(bulk['compression-mode'], 'aggressive')
+        self.assertEqual(contexts.backend_pool_kwargs(bulk)[
+            'compression_mode'], 'aggressive')
+
+    def test_get_backends_invalid(self):
+        self.service_name.return_value = 'cinder-ceph'
+        for backends in [
+                'name: fast',
+                '- [fast]',
+                '- {name: Fast}',
+                '- {name: fast, size: 3}',
+                '- {name: fast, pool-type: tiered}',
+                '- {name: fast, replicas: 0}',
+                '- {name: fast, weight: -1}',
+                '- {name: fast, compression-mode: sometimes}',
+                '- {name: fast}\n- {name: fast}',
+                '- {name: a, pool: p}\n- {name: b, pool: p}',
+                '- {name: a, pool: cinder-ceph}',
+                '- {name: metadata}']:
+            self.test_config.set('rbd-backends', backends)
+            self.assertRaises(ValueError, contexts.get_backends)
+
+    def test_get_backends_autoscale(self):
+        self.service_name.return_value = 'cinder-ceph'
+        self.test_config.set('ceph-pool-autoscale-mode', 'warn')
+        self.test_config.set('rbd-backends',
+                             BACKENDS + '  target-size-bytes: 1000\n'
+                             '  pg-autoscale-mode: "on"\n')
+        fast, bulk = contexts.get_backends()
+        self.assertEqual(
+            (fast['target-size-bytes'], fast['pg-autoscale-mode']),
+            (None, 'warn'))
+        self.assertEqual(
+            (bulk['target-size-bytes'], bulk['pg-autoscale-mode']),
+            (1000, 'on'))
+        self.test_config.set('rbd-backends',
+                             '- {name: fast, pg-autoscale-mode: always}')
+        self.assertRaises(ValueError, contexts.get_backends)
+
+    def test_pool_autoscale(self):
+        self.assertIsNone(contexts.pool_autoscale_mode())
+        self.test_config.set('ceph-pool-autoscale-mode', 'always')
+        self.assertRaises(ValueError, contexts.pool_autoscale_mode)
+        self.assertIsNone(contexts.pool_target_size_bytes())
+        self.test_config.set('ceph-pool-target-size-bytes', 1000)
+        self.assertEqual(contexts.pool_target_size_bytes(), 1000)
+        self.test_config.set('ceph-pool-target-size-bytes', -1)
+        self.assertRaises(ValueError, contexts.pool_target_size_bytes)
+        self.assertEqual(contexts.pool_autoscale_kwargs(20),
+                         {'target_size_ratio': 0.2})
+        self.assertEqual(contexts.pool_autoscale_kwargs(20, 10, 'off'),
+                         {'target_size_ratio': 0.2, 'target_size_bytes': 10,
+                          'pg_autoscale_mode': 'off'})
+        self.assertEqual(contexts.split_metadata_pool(20, 1000),
+                         ((0.2, 10), (19.8, 990)))
+        self.assertEqual(contexts.split_metadata_pool(20),
+                         ((0.2, None), (19.8, None)))
+
+    def test_pool_limits(self):
+        self.assertEqual(contexts.pool_limit_kwargs(contexts.pool_limits()),
+                         {})
+        self.test_config.set('ceph-pool-max-bytes', 0)
+        self.test_config.set('rbd-qos-iops-limit', 500)
+        self.test_config.set('rbd-qos-iops-burst', 1000)
+        limits = contexts.pool_limits()
+        self.assertEqual(contexts.pool_limit_kwargs(limits), {
+            'max_bytes': 0,
+            'rbd_config': {'rbd_qos_iops_limit': 500,
+                           'rbd_qos_iops_burst': 1000}})
+        self.assertEqual(contexts.pool_limit_kwargs(limits, qos=False),
+                         {'max_bytes': 0})
+        self.assertEqual(
+            contexts.pool_limit_kwargs(limits, quota=False),
+            {'rbd_config': {'rbd_qos_iops_limit': 500,
+                            'rbd_qos_iops_burst': 1000}})
+        self.test_config.set('rbd-qos-bps-limit', -1)
+        self.assertRaises(ValueError, contexts.pool_limits)
+
+    def test_get_backends_limits(self):
+        self.service_name.return_value = 'cinder-ceph'
+        self.test_config.set('rbd-qos-iops-limit', 500)
+        self.test_config.set('rbd-backends',
+                             BACKENDS + '  max-bytes: 1000\n'
+                             '  rbd-qos-iops-limit: 100\n')
+        fast, bulk = contexts.get_backends()
+        self.assertEqual((fast['max-bytes'], fast['rbd-qos-iops-limit']),
+                         (None, 500))
+        self.assertEqual((bulk['max-bytes'], bulk['rbd-qos-iops-limit']),
+                         (1000, 100))
+        self.test_config.set('rbd-backends',
+                             '- {name: fast, max-objects: -1}')
+        self.assertRaises(ValueError, contexts.get_backends)
+
+    def test_ceph_related_backends(self):
+        self.is_relation_made.return_value = True
+        self.get_os_codename_package.return_value = "queens"
+        self.service_name.return_value = 'cinder-ceph'
+        self.test_config.set('rbd-backends', BACKENDS)
+        ctxt = contexts.CephSubordinateContext()
+        sections = ctxt()['cinder']['/etc/cinder/cinder.conf']['sections']
+        # the default backend keeps serving the existing volumes
+        self.assertEqual(list(sections), ['cinder-ceph', 'cinder-ceph-fast',
+                                          'cinder-ceph-bulk'])
+        self.assertIn(('rbd_pool', 'cinder-ceph'), sections['cinder-ceph'])
+        self.assertEqual(sections['cinder-ceph-fast'][:6], [
+            ('volume_backend_name', 'cinder-ceph-fast'),
+            ('volume_driver', 'cinder.volume.drivers.rbd.RBDDriver'),
+            ('rbd_pool', 'cinder-ceph-fast'),
+            ('rbd_user', 'cinder-ceph'),
+            ('rbd_secret_uuid', 'libvirt-uuid'),
+            ('rbd_ceph_conf', '/var/lib/charm/cinder-ceph/ceph.conf')])
+        self.assertEqual(sections['cinder-ceph-bulk'][:6], [
+            ('volume_backend_name', 'cinder-ceph-bulk'),
+            ('volume_driver', 'cinder.volume.drivers.rbd.RBDDriver'),
+            ('rbd_pool', 'cinder-ceph-bulk-metadata'),
+            ('rbd_user', 'cinder-ceph'),
+            ('rbd_secret_uuid', 'libvirt-uuid'),
+            ('rbd_ceph_conf',
+             '/var/lib/charm/cinder-ceph/backends/bulk/ceph.conf')])
+        self.assertEqual(ctxt.enabled_backends(),
+                         ['cinder-ceph', 'cinder-ceph-fast',
+                          'cinder-ceph-bulk'])
+        # next to an erasure-coded default backend, every backend has a
+        # ceph.conf of its own
+        self.test_config.set('pool-type', 'erasure-coded')
+        sections = ctxt()['cinder']['/etc/cinder/cinder.conf']['sections']
+        self.assertIn(('rbd_pool', 'cinder-ceph-metadata'),
+                      sections['cinder-ceph'])
+        self.assertIn(('rbd_ceph_conf',
+                       '/var/lib/charm/cinder-ceph/backends/fast/ceph.conf'),
+                      sections['cinder-ceph-fast'])
+
+    def test_enabled_backends_single(self):
+        self.service_name.return_value = 'cinder-ceph'
+        self.assertEqual(contexts.CephSubordinateContext().enabled_backends(),
+                         ['cinder-ceph'])
+
+    def test_rbd_data_pool(self):
+        self.service_name.return_value = 'cinder-ceph'
+        self.assertEqual(contexts.RBDDataPoolContext()(), {})
+        self.test_config.set('rbd-backends', BACKENDS)
+        # the data pool of the default backend is left to CephContext
+        self.assertEqual(contexts.RBDDataPoolContext()(), {})
+        self.assertEqual(contexts.RBDDataPoolContext('fast')(),
+                         {'rbd_default_data_pool': None})
+        self.assertEqual(contexts.RBDDataPoolContext('bulk')(),
+                         {'rbd_default_data_pool': 'cinder-ceph-bulk'})
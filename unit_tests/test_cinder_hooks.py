@@ -13,10 +13,14 @@
 # limitations under the License.
 
 from unittest.mock import MagicMock, patch, call, ANY
+import inspect
 import os
 import json
+import cinder_contexts as contexts
 import cinder_utils as utils
 
+from charmhelpers.core import unitdata
+
 from test_utils import (
     CharmTestCase,
 )
@@ -35,15 +39,24 @@ TO_PATCH = [
     'scrub_old_style_ceph',
     'is_request_complete',
     'send_request_if_needed',
+    'status_fingerprint',
     'CONFIGS',
     'CEPH_CONF',
+    'check_rbd_config',
+    'rbd_config_unapplied',
     'ceph_config_file',
     # charmhelpers.core.hookenv
     'config',
+    'hook_name',
     'relation_ids',
     'relation_set',
     'service_name',
-    'service_restart',
+    'schedule_restart',
+    'RBDClientTuningContext',
+    'get_backends',
+    'pool_autoscale_mode',
+    'pool_limits',
+    'pool_target_size_bytes',
     'log',
     'leader_get',
     'leader_set',
@@ -59,13 +72,25 @@ TO_PATCH = [
     'status_set',
     'os_application_version_set',
     'send_application_name',
+    # charmhelpers.core.unitdata
+    'kv',
 ]
 
 
 class TestCinderHooks(CharmTestCase):
     def setUp(self):
         super(TestCinderHooks, self).setUp(hooks, TO_PATCH)
+        # restart_on_change() keeps file digests in the unit kv store
+        kv = patch.object(unitdata, '_KV', unitdata.Storage(':memory:'))
+        kv.start()
+        self.addCleanup(kv.stop)
         self.config.side_effect = self.test_config.get
+        self.get_backends.return_value = []
+        self.pool_autoscale_mode.return_value = None
+        self.pool_limits.return_value = {}
+        self.rbd_config_unapplied.return_value = []
+        self.pool_target_size_bytes.side_effect = lambda: (
+            self.test_config.get('ceph-pool-target-size-bytes') or None)
 
     @patch('charmhelpers.core.hookenv.config')
     def test_install(self, mock_config):
@@ -112,6 +137,53 @@ class TestCinderHooks(CharmTestCase):
                                                     user='cinder',
                                                     group='cinder')
         self.assertTrue(self.CONFIGS.write_all.called)
+        self.schedule_restart.assert_called_once_with('cinder-volume')
+        self.check_rbd_config.assert_called_once_with(
+            self.is_request_complete.call_args[0][0])
+
+    @patch.object(utils.time, 'sleep')
+    @patch.object(utils.time, 'time')
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'restart_delay')
+    @patch.object(utils, 'kv')
+    @patch('charmhelpers.core.host.service')
+    @patch('charmhelpers.core.host.FileChangeTracker')
+    @patch.object(hooks, 'get_ceph_request')
+    @patch('charmhelpers.core.hookenv.config')
+    def test_ceph_changed_staggered_restart(self, mock_config,
+                                            mock_get_ceph_request, tracker,
+                                            host_service, kv, restart_delay,
+                                            service_restart, paused, now,
+                                            sleep):
+        '''The completed request restarts cinder-volume once, staggered'''
+        # ceph.conf is written when the request completes
+        restart_map = inspect.getclosurevars(
+            hooks.ceph_changed).nonlocals['restart_map']
+        patcher = patch.dict(restart_map,
+                             {'/var/lib/charm/cinder/ceph.conf':
+                              ['cinder-volume']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tracker.return_value.changed.return_value = [
+            '/var/lib/charm/cinder/ceph.conf']
+        data = {}
+        kv.return_value = MagicMock(get=data.get, set=data.__setitem__)
+        restart_delay.return_value = 30
+        paused.return_value = False
+        now.return_value = 1000.0
+        self.schedule_restart.side_effect = utils.schedule_restart
+        self.is_request_complete.return_value = True
+        self.CONFIGS.complete_contexts.return_value = ['ceph']
+        self.service_name.return_value = 'cinder'
+        self.ensure_ceph_keyring.return_value = True
+        hooks.hooks.execute(['hooks/ceph-relation-changed'])
+        self.assertFalse(service_restart.called)
+        self.assertFalse(host_service.called)
+        self.assertEqual(utils.run_scheduled_restarts(), ['cinder-volume'])
+        sleep.assert_called_once_with(30.0)
+        service_restart.assert_called_once_with('cinder-volume')
+        self.assertFalse(host_service.called)
 
     @patch.object(hooks, 'get_ceph_request')
     @patch('charmhelpers.core.hookenv.config')
@@ -141,14 +213,16 @@ class TestCinderHooks(CharmTestCase):
         hooks.get_ceph_request()
         mock_create_pool.assert_called_with(name='cinder', replica_count=4,
                                             weight=20, group='volumes',
-                                            app_name='rbd')
+                                            app_name='rbd',
+                                            target_size_ratio=0.2)
         mock_request_access.assert_not_called()
 
         self.test_config.set('restrict-ceph-pools', True)
         hooks.get_ceph_request()
         mock_create_pool.assert_called_with(name='cinder', replica_count=4,
                                             weight=20, group='volumes',
-                                            app_name='rbd')
+                                            app_name='rbd',
+                                            target_size_ratio=0.2)
         mock_request_access.assert_has_calls([
             call(
                 name='volumes',
@@ -181,7 +255,8 @@ class TestCinderHooks(CharmTestCase):
                                             replica_count=4,
                                             weight=20,
                                             group='volumes',
-                                            app_name='rbd')
+                                            app_name='rbd',
+                                            target_size_ratio=0.2)
         # confirm operation with bluestore compression
         mock_create_pool.reset_mock()
         mock_bluestore_compression().get_kwargs.return_value = {
@@ -193,7 +268,8 @@ class TestCinderHooks(CharmTestCase):
                                                  weight=20,
                                                  group='volumes',
                                                  app_name='rbd',
-                                                 compression_mode='fake')
+                                                 compression_mode='fake',
+                                                 target_size_ratio=0.2)
 
     @patch.object(hooks, 'CephBlueStoreCompressionContext')
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
@@ -203,7 +279,7 @@ class TestCinderHooks(CharmTestCase):
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
            '.add_op_request_access_to_group')
     @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
-           '.add_op_create_pool')
+           '.add_op_create_replicated_pool')
     def test_create_pool_erasure_coded(self, mock_create_pool,
                                        mock_request_access,
                                        mock_create_erasure_profile,
@@ -220,7 +296,8 @@ class TestCinderHooks(CharmTestCase):
             replica_count=4,
             weight=0.2,
             group='volumes',
-            app_name='rbd'
+            app_name='rbd',
+            target_size_ratio=0.2 / 100
         )
         mock_create_erasure_pool.assert_called_with(
             name='cinder',
@@ -228,7 +305,8 @@ class TestCinderHooks(CharmTestCase):
             weight=19.8,
             group='volumes',
             app_name='rbd',
-            allow_ec_overwrites=True
+            allow_ec_overwrites=True,
+            target_size_ratio=19.8 / 100
         )
         mock_create_erasure_profile.assert_called_with(
             name='cinder-profile',
@@ -256,7 +334,134 @@ class TestCinderHooks(CharmTestCase):
             app_name='rbd',
             allow_ec_overwrites=True,
             compression_mode='fake',
+            target_size_ratio=19.8 / 100
         )
+        # confirm operation with a target size and autoscale mode, 1% of
+        # the target size goes to the metadata pool
+        self.test_config.set('ceph-pool-target-size-bytes', 1000)
+        self.pool_autoscale_mode.return_value = 'warn'
+        mock_bluestore_compression().get_kwargs.return_value = {}
+        hooks.get_ceph_request()
+        mock_create_pool.assert_called_with(
+            name='cinder-metadata', replica_count=4, weight=0.2,
+            group='volumes', app_name='rbd', target_size_ratio=0.2 / 100,
+            target_size_bytes=10, pg_autoscale_mode='warn')
+        mock_create_erasure_pool.assert_called_with(
+            name='cinder', erasure_profile='cinder-profile', weight=19.8,
+            group='volumes', app_name='rbd', allow_ec_overwrites=True,
+            target_size_ratio=19.8 / 100, target_size_bytes=990,
+            pg_autoscale_mode='warn')
+
+    @patch.object(hooks, 'CephBlueStoreCompressionContext')
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_erasure_pool')
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_erasure_profile')
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_replicated_pool')
+    def test_create_pool_limits(self, mock_create_pool,
+                                mock_create_erasure_profile,
+                                mock_create_erasure_pool,
+                                mock_bluestore_compression):
+        mock_bluestore_compression().get_kwargs.return_value = {}
+        self.service_name.return_value = 'cinder'
+        self.test_config.set('ceph-pool-weight', 20)
+        self.pool_limits.return_value = {
+            'max-bytes': 1000, 'max-objects': None,
+            'rbd-qos-iops-limit': 500, 'rbd-qos-iops-burst': None,
+            'rbd-qos-bps-limit': 0, 'rbd-qos-bps-burst': None}
+        hooks.get_ceph_request()
+        mock_create_pool.assert_called_with(
+            name='cinder', replica_count=3, weight=20, group='volumes',
+            app_name='rbd', target_size_ratio=0.2, max_bytes=1000,
+            rbd_config={'rbd_qos_iops_limit': 500, 'rbd_qos_bps_limit': 0})
+        # the images are in the metadata pool, the data in the EC pool
+        self.test_config.set('pool-type', 'erasure-coded')
+        hooks.get_ceph_request()
+        mock_create_pool.assert_called_with(
+            name='cinder-metadata', replica_count=3, weight=0.2,
+            group='volumes', app_name='rbd', target_size_ratio=0.2 / 100,
+            rbd_config={'rbd_qos_iops_limit': 500, 'rbd_qos_bps_limit': 0})
+        mock_create_erasure_pool.assert_called_with(
+            name='cinder', erasure_profile='cinder-profile', weight=19.8,
+            group='volumes', app_name='rbd', allow_ec_overwrites=True,
+            target_size_ratio=19.8 / 100, max_bytes=1000)
+
+    @patch.object(hooks, 'CephBlueStoreCompressionContext')
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_erasure_pool')
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_erasure_profile')
+    @patch('charmhelpers.contrib.storage.linux.ceph.CephBrokerRq'
+           '.add_op_create_replicated_pool')
+    def test_create_pool_backends(self, mock_create_pool,
+                                  mock_create_erasure_profile,
+                                  mock_create_erasure_pool,
+                                  mock_bluestore_compression):
+        compression = {key: None
+                       for key in contexts.BACKEND_COMPRESSION_OPTIONS}
+        no_compression = {key.replace('-', '_'): None
+                          for key in contexts.BACKEND_COMPRESSION_OPTIONS}
+        fast = dict(compression, **{
+            'name': 'fast', 'pool': 'cinder-fast', 'pool-type': 'replicated',
+            'replicas': 3, 'weight': 10.0, 'device-class': 'nvme',
+            'crush-rule': 'replicated_nvme', 'target-size-bytes': None,
+            'pg-autoscale-mode': None})
+        bulk = dict(compression, **{
+            'name': 'bulk', 'pool': 'cinder-bulk',
+            'pool-type': 'erasure-coded', 'replicas': 3, 'weight': 50.0,
+            'device-class': 'hdd', 'crush-rule': 'replicated_hdd',
+            'metadata-pool': 'cinder-bulk-metadata',
+            'ec-profile-name': 'cinder-bulk-profile',
+            'ec-profile-k': 4, 'ec-profile-m': 2,
+            'ec-profile-plugin': 'jerasure', 'ec-profile-technique': None,
+            'compression-mode': 'aggressive', 'target-size-bytes': 1000,
+            'pg-autoscale-mode': 'on'})
+        self.get_backends.return_value = [fast, bulk]
+        self.service_name.return_value = 'cinder'
+        self.test_config.set('ceph-pool-weight', 20)
+        mock_bluestore_compression().get_kwargs.return_value = {}
+        hooks.get_ceph_request()
+        # the pool of the default backend is kept for the existing volumes
+        mock_create_pool.assert_has_calls([
+            call(name='cinder', replica_count=3, weight=20, group='volumes',
+                 app_name='rbd', target_size_ratio=0.2),
+            call(name='cinder-fast', replica_count=3, weight=10.0,
+                 group='volumes', app_name='rbd',
+                 crush_profile='replicated_nvme', target_size_ratio=0.1,
+                 **no_compression),
+            call(name='cinder-bulk-metadata', replica_count=3, weight=0.5,
+                 group='volumes', app_name='rbd',
+                 crush_profile='replicated_hdd', target_size_ratio=0.005,
+                 target_size_bytes=10, pg_autoscale_mode='on'),
+        ])
+        mock_create_erasure_profile.assert_called_once_with(
+            name='cinder-bulk-profile', k=4, m=2, device_class='hdd',
+            erasure_type='jerasure', erasure_technique=None)
+        mock_create_erasure_pool.assert_called_once_with(
+            name='cinder-bulk', erasure_profile='cinder-bulk-profile',
+            weight=49.5, group='volumes', app_name='rbd',
+            allow_ec_overwrites=True, target_size_ratio=0.495,
+            target_size_bytes=990, pg_autoscale_mode='on',
+            **dict(no_compression, compression_mode='aggressive'))
+
+    def test_storage_backend_joined_backends(self):
+        self.CONFIGS.complete_contexts.return_value = ['ceph']
+        self.CephSubordinateContext().return_value = {'test': 1}
+        self.CephSubordinateContext().enabled_backends.return_value = [
+            'cinder-ceph', 'cinder-ceph-fast', 'cinder-ceph-bulk']
+        hooks.storage_backend('storage-backend:1')
+        self.relation_set.assert_called_once_with(
+            relation_id='storage-backend:1',
+            backend_name='cinder-ceph,cinder-ceph-fast,cinder-ceph-bulk',
+            subordinate_configuration=json.dumps({'test': 1}),
+            stateless=True,
+        )
+
+        self.relation_set.reset_mock()
+        self.CephSubordinateContext().side_effect = ValueError('invalid')
+        hooks.storage_backend('storage-backend:1')
+        self.relation_set.assert_not_called()
 
     @patch('charmhelpers.core.hookenv.config')
     def test_ceph_changed_no_keys(self, mock_config):
@@ -310,11 +515,10 @@ class TestCinderHooks(CharmTestCase):
 
     @patch('charmhelpers.core.hookenv.config')
     def test_storage_backend_joined_ceph(self, mock_config):
-        def func():
-            return {'test': 1}
         self.CONFIGS.complete_contexts.return_value = ['ceph']
         self.service_name.return_value = 'test'
-        self.CephSubordinateContext.return_value = func
+        self.CephSubordinateContext().return_value = {'test': 1}
+        self.CephSubordinateContext().enabled_backends.return_value = ['test']
         hooks.hooks.execute(['hooks/storage-backend-relation-joined'])
         self.relation_set.assert_called_with(
             relation_id=None,
@@ -417,6 +621,7 @@ class TestCinderHooks(CharmTestCase):
         mock_set_os_workload_status.assert_called_once_with(
             ANY, hooks.REQUIRED_INTERFACES)
         mock_bluestore_compression().validate.assert_called_once_with()
+        self.RBDClientTuningContext().validate.assert_called_once_with()
         self.assertFalse(self.status_set.called)
         # confirm operation when user have provided invalid configuration
         mock_bluestore_compression().validate.side_effect = ValueError(
@@ -424,3 +629,70 @@ class TestCinderHooks(CharmTestCase):
         hooks.assess_status()
         self.status_set.assert_called_once_with(
             'blocked', 'Invalid configuration: fake message')
+        self.kv().set.assert_any_call(
+            hooks.WORKLOAD_STATUS_KEY,
+            ('blocked', 'Invalid configuration: fake message'))
+
+    @patch.object(hooks, 'CephBlueStoreCompressionContext')
+    @patch.object(hooks, 'set_os_workload_status')
+    def test_assess_status_negative_target_size(
+            self, mock_set_os_workload_status, mock_bluestore_compression):
+        self.pool_target_size_bytes.side_effect = ValueError(
+            'ceph-pool-target-size-bytes must be a non-negative integer')
+        hooks.assess_status()
+        self.status_set.assert_called_once_with(
+            'blocked', 'Invalid configuration: ceph-pool-target-size-bytes '
+            'must be a non-negative integer')
+
+    @patch.object(hooks, 'CephBlueStoreCompressionContext')
+    @patch.object(hooks, 'set_os_workload_status')
+    def test_assess_status_rbd_config_unapplied(
+            self, mock_set_os_workload_status, mock_bluestore_compression):
+        self.rbd_config_unapplied.return_value = ['cinder-ceph']
+        hooks.assess_status()
+        self.status_set.assert_called_once_with(
+            'blocked', 'rbd-qos-* not applied by ceph-mon to cinder-ceph')
+
+    @patch.object(hooks, 'CephBlueStoreCompressionContext')
+    @patch.object(hooks, 'set_os_workload_status')
+    def test_assess_status_update_status_unchanged(
+            self, mock_set_os_workload_status, mock_bluestore_compression):
+        self.hook_name.return_value = 'update-status'
+        self.status_fingerprint.return_value = 'abc'
+        self.kv().get.return_value = 'abc'
+        hooks.assess_status()
+        self.assertFalse(mock_set_os_workload_status.called)
+        self.assertFalse(self.os_application_version_set.called)
+        self.assertFalse(self.kv().flush.called)
+
+    @patch.object(hooks, 'CephBlueStoreCompressionContext')
+    @patch.object(hooks, 'set_os_workload_status')
+    def test_assess_status_update_status_restarted(
+            self, mock_set_os_workload_status, mock_bluestore_compression):
+        # waiting for the restart set a maintenance status, which must not
+        # be kept although the inputs are unchanged
+        self.hook_name.return_value = 'update-status'
+        self.status_fingerprint.return_value = 'abc'
+        self.kv().get.return_value = 'abc'
+        mock_set_os_workload_status.return_value = ('active', 'Unit is ready')
+        hooks.assess_status(restarted=['cinder-volume'])
+        mock_set_os_workload_status.assert_called_once_with(
+            ANY, hooks.REQUIRED_INTERFACES)
+        self.kv().set.assert_any_call(hooks.WORKLOAD_STATUS_KEY,
+                                      ('active', 'Unit is ready'))
+
+    @patch.object(hooks, 'CephBlueStoreCompressionContext')
+    @patch.object(hooks, 'set_os_workload_status')
+    def test_assess_status_update_status_changed(
+            self, mock_set_os_workload_status, mock_bluestore_compression):
+        self.hook_name.return_value = 'update-status'
+        self.status_fingerprint.return_value = 'def'
+        self.kv().get.return_value = 'abc'
+        mock_set_os_workload_status.return_value = ('active', 'Unit is ready')
+        hooks.assess_status()
+        mock_set_os_workload_status.assert_called_once_with(
+            ANY, hooks.REQUIRED_INTERFACES)
+        self.kv().set.assert_any_call(hooks.STATUS_FINGERPRINT_KEY, 'def')
+        self.kv().set.assert_any_call(hooks.WORKLOAD_STATUS_KEY,
+                                      ('active', 'Unit is ready'))
+        self.kv().flush.assert_called_once_with()
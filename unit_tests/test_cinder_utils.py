@@ -12,10 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from unittest.mock import patch, call
+import collections
+import json
+from subprocess import CalledProcessError
+from unittest.mock import MagicMock, patch, call
 import os
 import cinder_utils as cinder_utils
 
+from charmhelpers.contrib.storage.linux import ceph
+
 from test_utils import (
     CharmTestCase,
 )
@@ -43,9 +48,11 @@ class TestCinderUtils(CharmTestCase):
         super(TestCinderUtils, self).setUp(cinder_utils, TO_PATCH)
         self.service_name.return_value = 'cinder-ceph'
 
+    @patch('cinder_contexts.get_backends')
     @patch('os.path.exists')
-    def test_register_configs_ceph(self, exists):
+    def test_register_configs_ceph(self, exists, get_backends):
         exists.return_value = True
+        get_backends.return_value = []
         self.get_os_codename_package.return_value = 'grizzly'
         self.relation_ids.return_value = ['ceph:0']
         configs = cinder_utils.register_configs()
@@ -65,6 +72,144 @@ class TestCinderUtils(CharmTestCase):
             cinder_utils.CEPH_CONF, cinder_utils.ceph_config_file()
         )
 
+    @patch.dict(cinder_utils.CONFIG_FILES)
+    @patch('cinder_contexts.config')
+    @patch('cinder_contexts.service_name')
+    @patch('cinder_contexts.get_backends')
+    @patch('os.path.exists')
+    def test_register_configs_ceph_backends(self, exists, get_backends,
+                                            service_name, config):
+        exists.return_value = True
+        config.side_effect = {'pool-type': 'replicated'}.get
+        service_name.return_value = 'cinder-ceph'
+        get_backends.return_value = [
+            {'name': 'fast', 'pool-type': 'replicated'},
+            {'name': 'bulk', 'pool-type': 'erasure-coded'}]
+        self.get_os_codename_package.return_value = 'queens'
+        self.relation_ids.return_value = ['ceph:0']
+        cinder_utils.register_configs()
+        bulk_conf = '/var/lib/charm/cinder-ceph/backends/bulk/ceph.conf'
+        self.assertIn(bulk_conf, cinder_utils.CONFIG_FILES)
+        self.assertNotIn('/var/lib/charm/cinder-ceph/backends/fast/ceph.conf',
+                         cinder_utils.CONFIG_FILES)
+        self.assertEqual(
+            cinder_utils.CONFIG_FILES[bulk_conf]['hook_contexts'][-1].backend,
+            'bulk')
+        self.mkdir.assert_any_call(os.path.dirname(bulk_conf))
+
+    @patch.object(cinder_utils, 'get_upstream_version')
+    @patch.object(cinder_utils, 'is_unit_upgrading_set')
+    @patch.object(cinder_utils, 'is_unit_paused_set')
+    @patch.object(cinder_utils, 'related_units')
+    @patch.object(cinder_utils, 'config')
+    def test_status_fingerprint(self, config, related_units, paused,
+                                upgrading, get_upstream_version):
+        config.return_value = {'rbd-pool-name': 'cinder'}
+        self.relation_ids.side_effect = lambda r: ['{}:1'.format(r)]
+        related_units.return_value = ['ceph-mon/1', 'ceph-mon/0']
+        paused.return_value = False
+        upgrading.return_value = False
+        get_upstream_version.return_value = '17.0.0'
+        fingerprint = cinder_utils.status_fingerprint()
+        self.assertEqual(fingerprint, cinder_utils.status_fingerprint())
+        related_units.return_value = ['ceph-mon/0', 'ceph-mon/1']
+        self.assertEqual(fingerprint, cinder_utils.status_fingerprint())
+        paused.return_value = True
+        self.assertNotEqual(fingerprint, cinder_utils.status_fingerprint())
+        paused.return_value = False
+        config.return_value = {'rbd-pool-name': 'other'}
+        self.assertNotEqual(fingerprint, cinder_utils.status_fingerprint())
+
+    @patch.object(cinder_utils, 'goal_state')
+    @patch.object(cinder_utils, 'local_unit')
+    @patch.object(cinder_utils, 'config')
+    def test_restart_delay(self, config, local_unit, goal_state):
+        config.side_effect = self.test_config.get
+        goal_state.return_value = {'units': {
+            'cinder-ceph/{}'.format(n): {} for n in range(9)}}
+        local_unit.return_value = 'cinder-ceph/7'
+        self.assertEqual(cinder_utils.restart_delay(), 0)
+        self.test_config.set('restart-max-concurrent', 3)
+        self.test_config.set('restart-min-gap', 20)
+        self.assertEqual(cinder_utils.restart_delay(), 40)
+        local_unit.return_value = 'cinder-ceph/2'
+        self.assertEqual(cinder_utils.restart_delay(), 0)
+        local_unit.return_value = 'cinder-ceph/3'
+        self.assertEqual(cinder_utils.restart_delay(), 20)
+        # not staggered without a unit count
+        goal_state.side_effect = NotImplementedError
+        self.assertEqual(cinder_utils.restart_delay(), 0)
+
+    @patch.object(cinder_utils, 'goal_state')
+    @patch.object(cinder_utils, 'local_unit')
+    @patch.object(cinder_utils, 'config')
+    def test_restart_delay_sparse_unit_numbers(self, config, local_unit,
+                                               goal_state):
+        config.side_effect = self.test_config.get
+        self.test_config.set('restart-min-gap', 30)
+        for max_concurrent, numbers in [(2, (0, 2, 4, 6)),
+                                        (2, (3, 57, 118, 120, 121)),
+                                        (3, (1, 5, 9, 13, 17, 21, 25))]:
+            self.test_config.set('restart-max-concurrent', max_concurrent)
+            # units left after scale-down and redeploys
+            goal_state.return_value = {'units': {
+                'cinder-ceph/{}'.format(n): {} for n in numbers}}
+            groups = collections.Counter()
+            for n in numbers:
+                local_unit.return_value = 'cinder-ceph/{}'.format(n)
+                groups[cinder_utils.restart_delay()] += 1
+            self.assertLessEqual(max(groups.values()), max_concurrent)
+            self.assertEqual(
+                sorted(groups),
+                [30 * g for g in range(
+                    -(-len(numbers) // max_concurrent))])
+        # not yet part of the goal state
+        local_unit.return_value = 'cinder-ceph/30'
+        self.assertEqual(cinder_utils.restart_delay(), 0)
+
+    @patch.object(cinder_utils.time, 'sleep')
+    @patch.object(cinder_utils.time, 'time')
+    @patch.object(cinder_utils, 'is_unit_paused_set')
+    @patch.object(cinder_utils, 'service_restart')
+    @patch.object(cinder_utils, 'restart_delay')
+    @patch.object(cinder_utils, 'kv')
+    def test_scheduled_restarts(self, kv, restart_delay, service_restart,
+                                paused, now, sleep):
+        data = {}
+        kv.return_value = MagicMock(get=data.get, set=data.__setitem__)
+        paused.return_value = False
+        now.return_value = 1000.0
+        restart_delay.return_value = 90
+        cinder_utils.schedule_restart('cinder-volume')
+        restart_delay.return_value = 0
+        cinder_utils.schedule_restart('cinder-volume')
+        self.assertEqual(data[cinder_utils.RESTART_QUEUE_KEY], {
+            'cinder-volume': {'requested': 1000.0, 'not-before': 1090.0}})
+        # not due within the hook
+        self.assertEqual(cinder_utils.run_scheduled_restarts(), [])
+        self.assertFalse(service_restart.called)
+        # due within the hook
+        now.return_value = 1060.0
+        self.assertEqual(cinder_utils.run_scheduled_restarts(),
+                         ['cinder-volume'])
+        sleep.assert_called_once_with(30.0)
+        service_restart.assert_called_once_with('cinder-volume')
+        self.assertEqual(data[cinder_utils.RESTART_QUEUE_KEY], {})
+        self.assertEqual(data[cinder_utils.RESTART_METRICS_KEY], [
+            {'service': 'cinder-volume', 'requested': 1000.0,
+             'restarted': 1060.0, 'latency': 60.0}])
+
+    @patch.object(cinder_utils, 'defer_restart')
+    @patch.object(cinder_utils, 'restart_delay')
+    @patch.object(cinder_utils, 'kv')
+    def test_schedule_restart_no_delay(self, kv, restart_delay,
+                                       defer_restart):
+        kv.return_value.get.return_value = None
+        restart_delay.return_value = 0
+        cinder_utils.schedule_restart('cinder-volume')
+        defer_restart.assert_called_once_with('cinder-volume')
+        self.assertFalse(kv.return_value.set.called)
+
     def test_set_ceph_kludge(self):
         pass
         """
@@ -78,3 +223,64 @@ class TestCinderUtils(CharmTestCase):
             with open('/etc/init/cinder-volume.override', 'w') as out:
                     out.write('env CEPH_ARGS="--id %s"\n' % service)
         """
+
+
+class TestCheckRBDConfig(CharmTestCase):
+
+    def setUp(self):
+        super(TestCheckRBDConfig, self).setUp(cinder_utils, ['service_name'])
+        self.service_name.return_value = 'cinder-ceph'
+        self.data = {}
+        # pool level rbd configuration of a cluster, as read and written
+        # by the rbd CLI
+        self.pool_config = collections.defaultdict(dict)
+        for obj, name, kwargs in [
+                (cinder_utils, 'kv', {'return_value': MagicMock(
+                    get=self.data.get, set=self.data.__setitem__)}),
+                (ceph, 'check_output',
+                 {'side_effect': self._rbd_config_list}),
+                (ceph, 'check_call', {'side_effect': self._rbd_config_set}),
+                (ceph, 'cmp_pkgrevno', {'return_value': 1})]:
+            patcher = patch.object(obj, name, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.request = ceph.CephBrokerRq()
+        self.request.add_op_create_replicated_pool(
+            'cinder-ceph', rbd_config={'rbd_qos_iops_limit': 500})
+        self.request.add_op_create_replicated_pool('cinder-ceph-bulk')
+
+    def _rbd_config_list(self, cmd):
+        pool = cmd[cmd.index('list') + 1]
+        return json.dumps([
+            {'name': name, 'value': value, 'source': 'pool'}
+            for name, value in self.pool_config[pool].items()]).encode()
+
+    def _rbd_config_set(self, cmd):
+        pool, name, value = cmd[-3:]
+        self.pool_config[pool][name] = value
+
+    def broker(self):
+        # the broker side handling of the ops, as ceph-mon receives them
+        for op in json.loads(self.request.request)['ops']:
+            ceph.ReplicatedPool('admin', op=op).set_rbd_config()
+
+    def test_applied(self):
+        self.broker()
+        self.assertEqual(self.pool_config,
+                         {'cinder-ceph': {'rbd_qos_iops_limit': '500'}})
+        self.assertEqual(cinder_utils.check_rbd_config(self.request), [])
+        self.assertEqual(cinder_utils.rbd_config_unapplied(), [])
+
+    def test_unapplied(self):
+        # a ceph-mon broker which ignores rbd-config
+        self.assertEqual(cinder_utils.check_rbd_config(self.request),
+                         ['cinder-ceph'])
+        self.assertEqual(cinder_utils.rbd_config_unapplied(), ['cinder-ceph'])
+        self.broker()
+        cinder_utils.check_rbd_config(self.request)
+        self.assertEqual(cinder_utils.rbd_config_unapplied(), [])
+
+    def test_unreadable(self):
+        ceph.check_output.side_effect = CalledProcessError(1, 'rbd')
+        self.assertEqual(cinder_utils.check_rbd_config(self.request),
+                         ['cinder-ceph'])
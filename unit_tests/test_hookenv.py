@@ -0,0 +1,291 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from charmhelpers.core import hookenv, unitdata
+
+
+class TestBufferedRelationSet(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {
+            'JUJU_UNIT_NAME': 'cinder-ceph/0',
+            'JUJU_RELATION_ID': 'ceph:1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('JUJU_VERSION', None)
+        hookenv.cache.clear()
+        hookenv._relation_set_accepts_file.clear()
+        self.addCleanup(setattr, hookenv, '_relation_settings_buffer', None)
+        self.addCleanup(hookenv._atexit.clear)
+        self.written = []
+        check_call = mock.patch('subprocess.check_call',
+                                side_effect=self._check_call)
+        check_call.start()
+        self.addCleanup(check_call.stop)
+        check_output = mock.patch('subprocess.check_output',
+                                  side_effect=self._check_output)
+        self.check_output = check_output.start()
+        self.addCleanup(check_output.stop)
+
+    def _check_call(self, cmd):
+        with open(cmd[-1]) as f:
+            self.written.append((cmd[2], hookenv.yaml.safe_load(f)))
+
+    def _check_output(self, cmd, **kwargs):
+        if cmd[0] == 'relation-set':
+            return 'usage: relation-set [--file <path>]'
+        return json.dumps({'a': '1', 'b': '2'}).encode()
+
+    def test_buffered(self):
+        hookenv.buffer_relation_settings()
+        hookenv.relation_set(relation_settings={'broker_req': 'r'})
+        hookenv.relation_set(relation_id='ceph:1', b=None,
+                             **{'unit-name': 'u'})
+        hookenv.relation_set(relation_id='ceph-access:2', key=1)
+        self.assertEqual(self.written, [])
+        self.assertEqual(hookenv.relation_get(unit='cinder-ceph/0'),
+                         {'a': '1', 'broker_req': 'r', 'unit-name': 'u'})
+        self.assertEqual(hookenv.relation_get('broker_req', rid='ceph:1',
+                                              unit='cinder-ceph/0'), 'r')
+        hookenv._run_atexit()
+        self.assertEqual(self.written, [
+            ('ceph:1', {'broker_req': 'r', 'unit-name': 'u', 'b': None}),
+            ('ceph-access:2', {'key': '1'})])
+        # written immediately once flushed
+        hookenv.relation_set(relation_id='ceph:1', c='3')
+        self.assertEqual(self.written[-1], ('ceph:1', {'c': '3'}))
+        probes = [c for c in self.check_output.call_args_list
+                  if c[0][0] == ['relation-set', '--help']]
+        self.assertEqual(len(probes), 1)
+
+    def test_accepts_file_known_version(self):
+        os.environ['JUJU_VERSION'] = '2.9.18'
+        db = unitdata.Storage(':memory:')
+        with mock.patch.object(unitdata, '_KV', db), \
+                mock.patch.object(db, 'flush') as flush:
+            self.assertTrue(hookenv.relation_set_accepts_file())
+            self.assertEqual(db.get(hookenv.RELATION_SET_FILE_KEY),
+                             {'2.9.18': True})
+            # a later hook of the same Juju version does not probe
+            hookenv._relation_set_accepts_file.clear()
+            self.assertTrue(hookenv.relation_set_accepts_file())
+        self.assertFalse(flush.called)
+        probes = [c for c in self.check_output.call_args_list
+                  if c[0][0] == ['relation-set', '--help']]
+        self.assertEqual(len(probes), 1)
+
+
+class TestHookProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.dict(os.environ, {
+            hookenv.HOOK_PROFILE_ENV: self.tmpdir,
+            'JUJU_UNIT_NAME': 'cinder-ceph/0'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop(hookenv.HOOK_PROFILE_BUDGET_ENV, None)
+        patcher = mock.patch.object(hookenv, 'log')
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(hookenv.disable_hook_profile)
+
+    def test_profiled_popen(self):
+        hookenv.enable_hook_profile()
+        self.assertIs(subprocess.Popen, hookenv._ProfiledPopen)
+        subprocess.check_call(['true'])
+        self.assertEqual(
+            subprocess.check_output([sys.executable, '-c', 'print("ok")']),
+            b'ok\n')
+        self.assertEqual(subprocess.call(['false']), 1)
+        self.assertRaises(OSError, subprocess.call,
+                          [os.path.join(self.tmpdir, 'missing')])
+        records = hookenv._hook_profile.records
+        self.assertEqual(
+            [(r['command'], r['exit-code'], r['output-bytes'])
+             for r in records],
+            [('true', 0, 0), (os.path.basename(sys.executable), 0, 3),
+             ('false', 1, 0), ('missing', -errno.ENOENT, 0)])
+        self.assertTrue(all(r['duration'] is not None for r in records))
+        profile = hookenv.disable_hook_profile()
+        self.assertIs(subprocess.Popen, hookenv._unprofiled_popen)
+        self.assertEqual(len(profile.records), 4)
+
+    def test_command_class(self):
+        self.assertEqual(hookenv._command_class(
+            ['/usr/bin/ceph', '--id', 'cinder-ceph', 'osd', 'pool', 'ls']),
+            'ceph osd')
+        self.assertEqual(hookenv._command_class('relation-get --format=json'),
+                         'relation-get')
+        self.assertEqual(hookenv._command_class([]), '')
+
+    def test_write_hook_profile(self):
+        hookenv.enable_hook_profile(budget=1)
+        subprocess.check_call(['true'])
+        subprocess.check_call(['true'])
+        filename = hookenv.write_hook_profile('update-status')
+        with open(filename) as f:
+            data = json.load(f)
+        self.assertEqual(data['command-count'], 2)
+        self.assertEqual(data['summary'][0]['command'], 'true')
+        self.assertEqual(data['summary'][0]['count'], 2)
+        self.log.assert_called_with(
+            'Hook update-status executed 2 commands, over the budget of 1',
+            level=hookenv.WARNING)
+        self.assertIsNone(hookenv.write_hook_profile('update-status'))
+
+    def test_budget_env(self):
+        os.environ[hookenv.HOOK_PROFILE_BUDGET_ENV] = '50'
+        hookenv.enable_hook_profile()
+        self.assertEqual(hookenv._hook_profile.budget, 50)
+
+    def test_budget_env_invalid(self):
+        os.environ[hookenv.HOOK_PROFILE_BUDGET_ENV] = '50 commands'
+        hookenv.enable_hook_profile()
+        self.assertIsNone(hookenv._hook_profile.budget)
+        self.assertIs(subprocess.Popen, hookenv._ProfiledPopen)
+        self.log.assert_called_once_with(
+            "Ignoring invalid CHARM_HOOK_PROFILE_BUDGET value: "
+            "'50 commands'", level=hookenv.WARNING)
+
+
+class TestHookCache(unittest.TestCase):
+
+    def setUp(self):
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.calls = []
+
+        @hookenv.cached
+        def relation_get(attribute=None, unit=None, rid=None):
+            self.calls.append((attribute, unit, rid))
+            return len(self.calls)
+
+        self.relation_get = relation_get
+
+    def test_indexes(self):
+        cache = hookenv.HookCache()
+        cache.store('a', 1, 'relation_get', tokens=['ceph:1', 'cinder/0'],
+                    relation=('ceph:1', 'cinder/0'))
+        cache.store('b', 2, 'relation_get', tokens=['cinder/0'],
+                    relation=(None, 'cinder/0'))
+        cache.store('c', 3, 'relation_ids', tokens=['ceph'])
+        cache.store('d', 4, 'relation_get', tokens=['ceph:2', 'cinder/0'],
+                    relation=('ceph:2', 'cinder/0'))
+        cache.flush_relation('ceph:1', 'cinder/0')
+        self.assertEqual(sorted(cache), ['c', 'd'])
+        cache.flush_token('ceph')
+        self.assertEqual(sorted(cache), ['d'])
+        cache.flush_function('relation_get')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache._by_func, cache._by_token,
+                          cache._by_relation), ({}, {}, {}))
+        # all relations of the unit
+        cache.store('a', 1, 'relation_get', tokens=['ceph:1', 'cinder/0'],
+                    relation=('ceph:1', 'cinder/0'))
+        cache.store('b', 2, 'config', tokens=['key'])
+        cache.flush_relation(None, 'cinder/0')
+        self.assertEqual(list(cache), ['b'])
+
+    def test_lru(self):
+        cache = hookenv.HookCache(max_size=2)
+        cache.store('a', 1, 'f', tokens=['x'])
+        cache.store('b', 2, 'f', tokens=['y'])
+        self.assertEqual(cache.lookup('a'), 1)
+        cache.store('c', 3, 'f', tokens=['z'])
+        self.assertEqual(list(cache), ['a', 'c'])
+        self.assertRaises(KeyError, cache.lookup, 'b')
+        self.assertNotIn('y', cache._by_token)
+        self.assertEqual(cache.stats(), {
+            'size': 2, 'max-size': 2, 'hits': 1, 'misses': 1,
+            'evictions': 1})
+
+    def test_cached(self):
+        self.assertEqual(self.relation_get('a', 'cinder/0', 'ceph:1'), 1)
+        self.assertEqual(self.relation_get('a', 'cinder/0', 'ceph:1'), 1)
+        self.assertEqual(self.relation_get('a', unit='cinder/0'), 2)
+        self.assertEqual(len(self.calls), 2)
+        hookenv.cache.flush_relation('ceph:1', 'cinder/0')
+        self.assertEqual(len(hookenv.cache), 0)
+
+    def test_flush(self):
+        self.relation_get('a', 'cinder/0', 'ceph:1')
+        self.relation_get('b', 'cinder/0', 'ceph-access:2')
+        self.relation_get('c', 'nova/0', 'ceph-access:3')
+        # substring of an argument
+        hookenv.flush('ceph:')
+        self.assertEqual(len(hookenv.cache), 2)
+        hookenv.flush('nova')
+        self.assertEqual(len(hookenv.cache), 1)
+        hookenv.flush('relation_get')
+        self.assertEqual(len(hookenv.cache), 0)
+
+    def test_flush_exact(self):
+        self.relation_get('a', 'cinder/0', 'ceph:1')
+        self.relation_get('b', 'cinder/0', 'ceph-access:2')
+        hookenv.flush_exact('ceph')
+        hookenv.flush_exact('cinder')
+        self.assertEqual(len(hookenv.cache), 2)
+        hookenv.flush_exact('ceph:1')
+        self.assertEqual(len(hookenv.cache), 1)
+        hookenv.flush_exact('relation_get')
+        self.assertEqual(len(hookenv.cache), 0)
+
+
+class TestHooksExecute(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.dict(os.environ, {
+            'UNIT_STATE_DB': os.path.join(self.tmpdir, 'state.db')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(unitdata, '_KV', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(hookenv._atexit.clear)
+        self.hooks = hookenv.Hooks()
+
+        @self.hooks.hook('config-changed')
+        def config_changed():
+            unitdata.kv().set('key', 'value')
+
+        @self.hooks.hook('upgrade-charm')
+        def upgrade_charm():
+            unitdata.kv().set('key', 'value')
+            raise ValueError('failed')
+
+    def stored(self):
+        return unitdata.Storage().get('key')
+
+    def test_commit(self):
+        self.hooks.execute(['hooks/config-changed'])
+        self.assertEqual(self.stored(), 'value')
+
+    def test_failed_hook_not_committed(self):
+        self.assertRaises(ValueError, self.hooks.execute,
+                          ['hooks/upgrade-charm'])
+        self.assertIsNone(self.stored())
@@ -0,0 +1,234 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from charmhelpers.core import host, unitdata
+
+
+class TestFileHash(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    @mock.patch.object(host, 'HASH_CHUNK_SIZE', 7)
+    def test_file_hash(self):
+        path = os.path.join(self.tmpdir, 'blob')
+        content = os.urandom(100)
+        with open(path, 'wb') as f:
+            f.write(content)
+        self.assertEqual(host.file_hash(path, 'sha256'),
+                         hashlib.sha256(content).hexdigest())
+        self.assertIsNone(host.file_hash(path + '.missing'))
+        host.check_hash(path, hashlib.md5(content).hexdigest())
+        self.assertRaises(host.ChecksumError, host.check_hash, path, 'x')
+
+    def test_file_hashes(self):
+        paths = []
+        for i in range(4):
+            paths.append(os.path.join(self.tmpdir, str(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(str(i).encode())
+        paths.append(os.path.join(self.tmpdir, 'missing'))
+        expect = {path: host.file_hash(path) for path in paths}
+        self.assertEqual(host.file_hashes(paths), expect)
+        self.assertEqual(host.file_hashes(paths, max_workers=3), expect)
+
+
+class TestFileChangeTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.dict(
+            os.environ,
+            {'UNIT_STATE_DB': os.path.join(self.tmpdir, 'state.db')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        unitdata._KV = None
+        self.addCleanup(setattr, unitdata, '_KV', None)
+        host._file_writes.clear()
+        self.conf = os.path.join(self.tmpdir, 'a.conf')
+        self.write(self.conf, b'one')
+        # stamps of files written in the current clock tick are not trusted
+        os.utime(self.conf, (1, 1))
+
+    def write(self, path, content):
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    @mock.patch.object(host, '_hash_file', wraps=host._hash_file)
+    def test_unchanged_not_read_again(self, _hash_file):
+        host.FileChangeTracker([self.conf]).changed()
+        _hash_file.reset_mock()
+        tracker = host.FileChangeTracker([self.conf])
+        self.assertEqual(tracker.changed(), [])
+        self.assertFalse(_hash_file.called)
+
+    def test_changed(self):
+        tracker = host.FileChangeTracker([self.conf])
+        self.write(self.conf, b'two')
+        self.assertEqual(tracker.changed(), [self.conf])
+
+    def test_rewritten_same_content(self):
+        tracker = host.FileChangeTracker([self.conf])
+        self.write(self.conf, b'one')
+        self.assertEqual(tracker.changed(), [])
+
+    def test_glob(self):
+        pattern = os.path.join(self.tmpdir, '*.conf')
+        tracker = host.FileChangeTracker([pattern])
+        self.write(os.path.join(self.tmpdir, 'b.conf'), b'')
+        self.assertEqual(tracker.changed(), [pattern])
+        tracker = host.FileChangeTracker([pattern])
+        os.unlink(self.conf)
+        self.assertEqual(tracker.changed(), [pattern])
+
+    def test_removed_digests_pruned(self):
+        other = os.path.join(self.tmpdir, 'other.conf')
+        self.write(other, b'')
+        host.FileChangeTracker([self.conf, other]).changed()
+        self.assertEqual(sorted(unitdata.kv().get(host.FILE_DIGESTS_KEY)),
+                         [self.conf, other])
+        os.unlink(other)
+        # removed files are dropped, whether the tracker watches them or not
+        tracker = host.FileChangeTracker([self.conf])
+        self.assertEqual(tracker.changed(), [])
+        self.assertEqual(list(unitdata.kv().get(host.FILE_DIGESTS_KEY)),
+                         [self.conf])
+        tracker = host.FileChangeTracker([self.conf])
+        os.unlink(self.conf)
+        self.assertEqual(tracker.changed(), [self.conf])
+        self.assertEqual(unitdata.kv().get(host.FILE_DIGESTS_KEY), {})
+
+    def test_nested_trackers(self):
+        other = os.path.join(self.tmpdir, 'other.conf')
+        self.write(other, b'')
+        outer = host.FileChangeTracker([self.conf])
+        inner = host.FileChangeTracker([other])
+        with mock.patch.object(unitdata.kv(), 'flush') as flush:
+            self.assertEqual(inner.changed(), [])
+            self.assertEqual(outer.changed(), [])
+        # left to the end of the hook
+        self.assertFalse(flush.called)
+        self.assertEqual(sorted(unitdata.kv().get(host.FILE_DIGESTS_KEY)),
+                         [self.conf, other])
+
+    @mock.patch.object(host, '_hash_file', wraps=host._hash_file)
+    def test_noted_write_not_read(self, _hash_file):
+        tracker = host.FileChangeTracker([self.conf])
+        _hash_file.reset_mock()
+        self.write(self.conf, b'two')
+        host.note_file_write(self.conf, b'two')
+        self.assertEqual(tracker.changed(), [self.conf])
+        self.assertFalse(_hash_file.called)
+
+    @mock.patch.object(host, 'service')
+    def test_restart_on_change_helper(self, service):
+        def write():
+            self.write(self.conf, b'two')
+        host.restart_on_change_helper(write, {self.conf: ['svc']})
+        service.assert_called_once_with('restart', 'svc')
+        service.reset_mock()
+        host.restart_on_change_helper(write, {self.conf: ['svc']})
+        self.assertFalse(service.called)
+
+
+class TestDeferredRestarts(unittest.TestCase):
+
+    def setUp(self):
+        host._deferred_restarts.clear()
+        self.addCleanup(host._deferred_restarts.clear)
+
+    @mock.patch.object(host, 'log')
+    @mock.patch.object(host, 'atexit')
+    @mock.patch.object(host, 'service')
+    def test_coalesced(self, service, atexit, log):
+        restart_function = mock.MagicMock()
+        host.defer_restart('cinder-volume')
+        host.defer_restart('apache2')
+        host.defer_restart('cinder-volume', stopstart=True)
+        host.defer_restart('haproxy', restart_function=restart_function)
+        atexit.assert_called_once_with(host.run_deferred_restarts)
+        self.assertFalse(service.called)
+        self.assertEqual(host.run_deferred_restarts(),
+                         ['cinder-volume', 'apache2', 'haproxy'])
+        service.assert_has_calls([mock.call('stop', 'cinder-volume'),
+                                  mock.call('start', 'cinder-volume'),
+                                  mock.call('restart', 'apache2')])
+        self.assertEqual(service.call_count, 3)
+        restart_function.assert_called_once_with('haproxy')
+        log.assert_called_with(
+            'Restarted cinder-volume, apache2, haproxy; '
+            '1 redundant restart(s) avoided', level=host.INFO)
+        self.assertEqual(host.run_deferred_restarts(), [])
+
+
+SYSTEMCTL_SHOW = """\
+ActiveState=active
+
+ActiveState=inactive
+
+ActiveState=reloading
+
+ActiveState=failed
+"""
+
+
+class TestServicesRunning(unittest.TestCase):
+
+    def setUp(self):
+        for name, kwargs in [
+                ('init_is_systemd', {'side_effect': lambda service_name:
+                                     service_name != 'upstart-job'}),
+                ('service_running', {'return_value': True})]:
+            patcher = mock.patch.object(host, name, **kwargs)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('subprocess.check_output')
+        self.check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_services_running(self):
+        self.check_output.return_value = SYSTEMCTL_SHOW
+        self.assertEqual(host.services_running(
+            ['cinder-volume', 'haproxy', 'apache2', 'upstart-job',
+             'memcached']), {
+            'cinder-volume': True, 'haproxy': False, 'apache2': True,
+            'upstart-job': True, 'memcached': False})
+        self.check_output.assert_called_once_with(
+            ['systemctl', 'show', '--property=ActiveState', 'cinder-volume',
+             'haproxy', 'apache2', 'memcached'], universal_newlines=True)
+        self.service_running.assert_called_once_with('upstart-job')
+
+    def test_services_running_unexpected_output(self):
+        # one block short, each service is checked on its own
+        self.check_output.return_value = 'ActiveState=active\n'
+        self.assertEqual(host.services_running(['cinder-volume', 'haproxy']),
+                         {'cinder-volume': True, 'haproxy': True})
+        self.assertEqual(self.service_running.call_count, 2)
+
+    def test_services_running_error(self):
+        self.check_output.side_effect = host.subprocess.CalledProcessError(
+            1, 'systemctl')
+        self.service_running.return_value = False
+        self.assertEqual(host.services_running(['cinder-volume']),
+                         {'cinder-volume': False})
+        self.assertFalse(host.services_running([]))
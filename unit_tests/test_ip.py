@@ -0,0 +1,102 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from charmhelpers.contrib.network import ip
+
+PROC_NET_TCP = """\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 20480 1 0000000000000000 100 0 0 10 0
+   1: 0100007F:2383 00000000:0000 0A 00000000:00000000 00:00000000 00000000   113        0 23170 1 0000000000000000 100 0 0 10 0
+   2: 0500000A:1F90 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 24011 1 0000000000000000 100 0 0 10 0
+   3: 0500000A:1F90 0600000A:D2F0 01 00000000:00000000 02:000A7B2C 00000000     0        0 24108 2 0000000000000000 20 4 30 10 -1
+   4: 0500000A:C350 0600000A:1A0A 06 00000000:00000000 03:00000F3C 00000000     0        0 0 3 0000000000000000
+"""  # noqa: E501
+
+PROC_NET_TCP6 = """\
+  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:1A0A 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 21810 1 0000000000000000 100 0 0 10 0
+   1: 00000000000000000000000001000000:2382 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000   113        0 23171 1 0000000000000000 100 0 0 10 0
+   2: 0000000000000000FFFF00000500000A:22B8 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 24500 1 0000000000000000 100 0 0 10 0
+   3: 0000000000000000FFFF00000500000A:0050 0000000000000000FFFF00000600000A:C1D2 01 00000000:00000000 00:00000000 00000000     0        0 24501 1 0000000000000000 20 4 30 10 -1
+"""  # noqa: E501
+
+
+@unittest.skipIf(sys.byteorder != 'little',
+                 'fixtures hold addresses in little endian byte order')
+class TestTCPListeners(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.paths = []
+        for name, content in [('tcp', PROC_NET_TCP),
+                              ('tcp6', PROC_NET_TCP6)]:
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            self.paths.append(path)
+        patcher = mock.patch.object(ip, 'PROC_NET_TCP', self.paths)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_decode_address(self):
+        self.assertEqual(ip._decode_proc_net_address('0100007F:1F90'),
+                         ('127.0.0.1', 8080))
+        self.assertEqual(ip._decode_proc_net_address(
+            '00000000000000000000000001000000:0016'), ('::1', 22))
+        self.assertEqual(ip._decode_proc_net_address(
+            '0000000000000000FFFF00000500000A:22B8'),
+            ('::ffff:10.0.0.5', 8888))
+        self.assertEqual(ip._decode_proc_net_address(
+            'B80D0120000000000000000001000000:01BB'), ('2001:db8::1', 443))
+
+    def test_tcp_listeners(self):
+        # established and time-wait sockets are not listeners
+        self.assertEqual(ip.tcp_listeners(), {
+            ('0.0.0.0', 22), ('127.0.0.1', 9091), ('10.0.0.5', 8080),
+            ('::', 6666), ('::1', 9090), ('::ffff:10.0.0.5', 8888)})
+
+    def test_tcp_listeners_ipv4_only(self):
+        os.unlink(self.paths[1])
+        self.assertEqual(ip.tcp_listeners(), {
+            ('0.0.0.0', 22), ('127.0.0.1', 9091), ('10.0.0.5', 8080)})
+
+    @mock.patch.object(ip, 'port_has_listener')
+    def test_tcp_listeners_unreadable(self, port_has_listener):
+        for path in self.paths:
+            os.unlink(path)
+        self.assertIsNone(ip.tcp_listeners())
+        port_has_listener.side_effect = lambda address, port: port == 22
+        self.assertEqual(ip.ports_have_listeners('10.0.0.5', [22, 8080]),
+                         [True, False])
+
+    @mock.patch.object(ip, 'port_has_listener')
+    def test_ports_have_listeners(self, port_has_listener):
+        ports = [22, 6666, 8080, 8888, 9090, 9091, 80, 50000]
+        self.assertEqual(ip.ports_have_listeners('10.0.0.5', ports),
+                         [True, True, True, True, False, False, False,
+                          False])
+        self.assertEqual(ip.ports_have_listeners('0.0.0.0', ports),
+                         [True, True, False, False, True, True, False,
+                          False])
+        self.assertEqual(ip.ports_have_listeners('10.0.0.6', ['22', 8080]),
+                         [True, False])
+        self.assertFalse(port_has_listener.called)
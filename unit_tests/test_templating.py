@@ -0,0 +1,143 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.core import hookenv, unitdata
+
+
+class Context(object):
+
+    interfaces = []
+
+    def __init__(self, **ctxt):
+        self.ctxt = ctxt
+
+    def __call__(self):
+        return self.ctxt
+
+
+class TestOSConfigRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.templates = os.path.join(self.tmpdir, 'templates')
+        self.charm_dir = os.path.join(self.tmpdir, 'charm')
+        os.makedirs(os.path.join(self.templates, 'ussuri'))
+        os.mkdir(self.charm_dir)
+        with open(os.path.join(self.templates, 'ceph.conf'), 'w') as f:
+            f.write('[global]\nauth = {{ auth }}\n')
+        with open(os.path.join(self.templates, 'ussuri',
+                               'cinder.conf'), 'w') as f:
+            f.write('[DEFAULT]\nhost = {{ host }}\n')
+        self.ceph_conf = os.path.join(self.tmpdir, 'ceph.conf')
+        self.cinder_conf = os.path.join(self.tmpdir, 'cinder.conf')
+        self.db = unitdata.Storage(':memory:')
+        for name, kwargs in [('kv', {'return_value': self.db}),
+                             ('charm_dir', {'return_value': self.charm_dir}),
+                             ('log', {}),
+                             ('note_file_write', {})]:
+            patcher = mock.patch.object(templating, name, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(hookenv.cache.clear)
+        hookenv.cache.clear()
+        self.ceph_ctxt = Context(auth='cephx')
+        self.cinder_ctxt = Context(host='cinder')
+        self.configs = self.renderer()
+
+    def renderer(self):
+        configs = templating.OSConfigRenderer(self.templates, 'ussuri')
+        configs.register(self.ceph_conf, [self.ceph_ctxt])
+        configs.register(self.cinder_conf, [self.cinder_ctxt])
+        return configs
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_write_all(self):
+        self.assertEqual(sorted(self.configs.write_all()),
+                         [self.ceph_conf, self.cinder_conf])
+        self.assertEqual(self.read(self.ceph_conf),
+                         '[global]\nauth = cephx')
+        self.assertEqual(self.read(self.cinder_conf),
+                         '[DEFAULT]\nhost = cinder')
+        # unchanged
+        self.assertEqual(self.configs.write_all(), [])
+        self.cinder_ctxt.ctxt['host'] = 'cinder-ceph'
+        self.assertEqual(self.renderer().write_all(), [self.cinder_conf])
+        self.assertEqual(self.read(self.cinder_conf),
+                         '[DEFAULT]\nhost = cinder-ceph')
+
+    def test_write_context_repr(self):
+        # only the rendered content matters, not how the context serializes
+        class Auth(object):
+            value = 'none'
+
+            def __repr__(self):
+                return 'Auth()'
+
+            def __str__(self):
+                return self.value
+
+        self.ceph_ctxt.ctxt['auth'] = Auth()
+        self.assertTrue(self.configs.write(self.ceph_conf))
+        self.assertFalse(self.configs.write(self.ceph_conf))
+        Auth.value = 'cephx'
+        self.assertTrue(self.configs.write(self.ceph_conf))
+        self.assertEqual(self.read(self.ceph_conf), '[global]\nauth = cephx')
+
+    def test_write_file_changed(self):
+        self.configs.write_all()
+        with open(self.ceph_conf, 'w') as f:
+            f.write('edited')
+        self.assertEqual(self.configs.write_all(), [self.ceph_conf])
+        self.assertEqual(self.read(self.ceph_conf),
+                         '[global]\nauth = cephx')
+
+    def test_write_failed_hook(self):
+        with mock.patch.object(self.db, 'flush') as flush:
+            self.configs.write_all()
+            flush.assert_not_called()
+        # the hook fails, its digests are rolled back
+        self.db.flush(False)
+        self.assertIsNone(self.db.get(templating.RENDERED_KEY))
+        self.assertEqual(self.configs.write_all(), [])
+        self.assertEqual(len(self.db.get(templating.RENDERED_KEY)), 2)
+
+    def test_write_not_registered(self):
+        self.assertRaises(templating.OSConfigException, self.configs.write,
+                          os.path.join(self.tmpdir, 'nova.conf'))
+
+    def test_bytecode_cache(self):
+        self.configs.write_all()
+        cache_dir = os.path.join(self.charm_dir, templating.TEMPLATE_CACHE_DIR,
+                                 'ussuri')
+        self.assertTrue(os.path.isdir(cache_dir))
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_bytecode_cache_unwritable(self):
+        with open(os.path.join(self.charm_dir,
+                               templating.TEMPLATE_CACHE_DIR), 'w'):
+            pass
+        self.assertIsNone(templating.get_bytecode_cache('ussuri'))
+        self.assertEqual(self.configs.write_all(),
+                         [self.ceph_conf, self.cinder_conf])
@@ -0,0 +1,206 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from charmhelpers.fetch import ubuntu_apt_pkg
+
+# version pieces biased towards the cases the ordering is about: tildes,
+# leading zeros, letters against non-letters and digit/non-digit switches.
+PIECES = ['0', '00', '1', '01', '2', '9', '10', '~', '~~', 'a', 'b', 'z',
+          'A', 'Z', '.', '+', 'rc', 'ubuntu', 'build']
+
+
+def random_version(rng):
+    version = str(rng.randint(0, 20))
+    version += ''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 5)))
+    if rng.random() < 0.2:
+        version = '{}:{}'.format(rng.randint(0, 2), version)
+    if rng.random() < 0.6:
+        version += '-' + ''.join(
+            rng.choice(PIECES) for _ in range(rng.randint(1, 4)))
+    return version
+
+
+class TestVersionCompare(unittest.TestCase):
+
+    def test_version_compare(self):
+        for a, b, expect in [
+                ('1.0', '1.0', 0),
+                ('1.0', '1.00', 0),
+                ('1.0', '1.0-0', 0),
+                ('0:1.0', '1.0', 0),
+                ('1.0', '1.1', -1),
+                ('1.10', '1.9', 1),
+                ('1:0.1', '2.0', 1),
+                ('1.0~rc1', '1.0', -1),
+                ('1.0~rc1', '1.0~rc1~1', 1),
+                ('1.0', '1.0+1', -1),
+                ('1.0a', '1.0+', -1),
+                ('1.0-1', '1.0-1ubuntu1', -1),
+                ('2:16.2.0-0ubuntu1', '2:16.2.0-0ubuntu1~cloud0', 1),
+                ('14.2.0', '12.2.13-0ubuntu0.18.04.4', 1),
+                ('1.2-3-4', '1.2-3-5', -1)]:
+            self.assertEqual(ubuntu_apt_pkg.version_compare(a, b), expect,
+                             '{} {}'.format(a, b))
+            self.assertEqual(ubuntu_apt_pkg.version_compare(b, a), -expect,
+                             '{} {}'.format(b, a))
+
+    def test_version_compare_invalid(self):
+        self.assertRaises(ValueError, ubuntu_apt_pkg.version_compare,
+                          'x:1.0', '1.0')
+        self.assertRaises(ValueError, ubuntu_apt_pkg.version_compare,
+                          '-1', '1.0')
+
+    @unittest.skipUnless(shutil.which('dpkg'), 'dpkg not available')
+    def test_version_compare_dpkg(self):
+        rng = random.Random(1524)
+        for _ in range(150):
+            a, b = random_version(rng), random_version(rng)
+            self.assertEqual(
+                ubuntu_apt_pkg.version_compare(a, b),
+                ubuntu_apt_pkg._dpkg_version_compare(a, b),
+                '{} {}'.format(a, b))
+
+
+STATUS = b"""\
+Package: ceph-common
+Status: deinstall ok config-files
+Version: 15.2.0-0ubuntu1
+Architecture: amd64
+
+Package: cinder-common
+Status: install ok installed
+Priority: optional
+Architecture: all
+Version: 2:16.2.0-0ubuntu1
+Description: OpenStack storage service - common files
+ Cinder is the OpenStack block storage service.
+ .
+ This package contains the common files.
+
+Package: ceph-common
+Status: install ok installed
+Architecture: amd64
+Version: 15.2.13-0ubuntu0.20.04.1
+"""
+
+APT_CACHE_SHOW = """\
+Package: librbd1
+Architecture: amd64
+Version: 15.2.1-0ubuntu1
+Description: RADOS block device client library
+
+"""
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.status = os.path.join(self.tmpdir, 'status')
+        self.write(self.status, STATUS)
+        patcher = mock.patch.object(ubuntu_apt_pkg, 'DPKG_STATUS',
+                                    self.status)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ubuntu_apt_pkg._control_files.clear()
+        self.addCleanup(ubuntu_apt_pkg._control_files.clear)
+        patcher = mock.patch('subprocess.check_output')
+        self.check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, content, mtime_ns=10 ** 18):
+        if not isinstance(content, bytes):
+            content = content.encode('UTF-8')
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_installed(self):
+        cache = ubuntu_apt_pkg.Cache()
+        pkg = cache['cinder-common']
+        self.assertEqual(pkg.name, 'cinder-common')
+        self.assertEqual(pkg.current_ver.ver_str, '2:16.2.0-0ubuntu1')
+        self.assertEqual(pkg.architecture, 'all')
+        self.assertEqual(pkg.description.splitlines(), [
+            'OpenStack storage service - common files',
+            'Cinder is the OpenStack block storage service.', '.',
+            'This package contains the common files.'])
+        # the installed stanza, not the removed one before it
+        self.assertEqual(cache['ceph-common'].current_ver.ver_str,
+                         '15.2.13-0ubuntu0.20.04.1')
+        self.assertFalse(self.check_output.called)
+
+    def test_not_installed(self):
+        def check_output(cmd, **kwargs):
+            if cmd[0] == 'dpkg-query':
+                raise subprocess.CalledProcessError(
+                    1, cmd, output='dpkg-query: no packages found\n')
+            if cmd[-1] != 'librbd1':
+                raise subprocess.CalledProcessError(100, cmd, output='')
+            return APT_CACHE_SHOW
+
+        self.check_output.side_effect = check_output
+        cache = ubuntu_apt_pkg.Cache()
+        # the apt candidate, whatever versions the apt lists have
+        pkg = cache['librbd1']
+        self.assertIsNone(pkg.current_ver)
+        self.assertIsNone(pkg.architecture)
+        self.assertEqual(pkg.version, '15.2.1-0ubuntu1')
+        self.check_output.assert_any_call(
+            ['apt-cache', 'show', '--no-all-versions', 'librbd1'],
+            stderr=mock.ANY, universal_newlines=True)
+        self.assertNotIn('glance-common', cache)
+
+    def test_reread_on_change(self):
+        cache = ubuntu_apt_pkg.Cache()
+        self.assertEqual(cache['cinder-common'].current_ver.ver_str,
+                         '2:16.2.0-0ubuntu1')
+        control_file = ubuntu_apt_pkg._control_files[self.status]
+        cache['cinder-common']
+        self.assertIs(ubuntu_apt_pkg._control_files[self.status],
+                      control_file)
+        self.write(self.status,
+                   STATUS.replace(b'2:16.2.0-0ubuntu1', b'2:16.2.1-0ubuntu1'),
+                   mtime_ns=10 ** 18 + 1)
+        self.assertEqual(cache['cinder-common'].current_ver.ver_str,
+                         '2:16.2.1-0ubuntu1')
+
+
+class TestConfig(unittest.TestCase):
+
+    def tearDown(self):
+        importlib.reload(ubuntu_apt_pkg)
+
+    @mock.patch('subprocess.check_output')
+    def test_config_lazy(self, check_output):
+        check_output.return_value = (
+            'APT::Architecture "amd64";\n'
+            'CommandLine::AsString "apt-config dump";\n')
+        importlib.reload(ubuntu_apt_pkg)
+        self.assertFalse(check_output.called)
+        self.assertEqual(ubuntu_apt_pkg.config['APT::Architecture'], 'amd64')
+        self.assertEqual(ubuntu_apt_pkg.config.get('APT::Architecture'),
+                         'amd64')
+        check_output.assert_called_once_with(
+            ['apt-config', 'dump'], stderr=mock.ANY, universal_newlines=True)
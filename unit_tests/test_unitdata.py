@@ -0,0 +1,133 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from charmhelpers.contrib.openstack import utils as openstack_utils
+from charmhelpers.core import unitdata
+from charmhelpers.fetch import ubuntu
+
+
+class TestFactCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.status = os.path.join(self.tmpdir, 'status')
+        self.write(b'one')
+        self.db = unitdata.Storage(':memory:')
+        patcher = mock.patch.object(unitdata, 'kv', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, content, mtime_ns=10 ** 18):
+        with open(self.status, 'wb') as f:
+            f.write(content)
+        os.utime(self.status, ns=(mtime_ns, mtime_ns))
+
+    def test_file_stamp(self):
+        st = os.stat(self.status)
+        self.assertEqual(unitdata.file_stamp(self.status),
+                         [10 ** 18, 3, st.st_ino])
+        # nanoseconds are kept
+        self.write(b'one', mtime_ns=10 ** 18 + 1)
+        self.assertEqual(unitdata.file_stamp(self.status)[0], 10 ** 18 + 1)
+        self.assertIsNone(unitdata.file_stamp(self.status + '.missing'))
+
+    def test_fact(self):
+        producer = mock.Mock(return_value='1.0')
+        depends = [self.status]
+        with mock.patch.object(self.db, 'flush') as flush:
+            self.assertEqual(self.db.fact('version', producer, depends),
+                             '1.0')
+            producer.return_value = '2.0'
+            self.assertEqual(self.db.fact('version', producer, depends),
+                             '1.0')
+        producer.assert_called_once_with()
+        # committed at the end of the hook
+        self.assertFalse(flush.called)
+        # invalidated by a change of the stamp
+        self.write(b'one', mtime_ns=10 ** 18 + 1)
+        self.assertEqual(self.db.fact('version', producer, depends), '2.0')
+        self.assertEqual(producer.call_count, 2)
+
+    def test_fact_none_not_stored(self):
+        producer = mock.Mock(return_value=None)
+        self.assertIsNone(self.db.fact('version', producer, [self.status]))
+        self.assertIsNone(self.db.fact('version', producer, [self.status]))
+        self.assertEqual(producer.call_count, 2)
+
+    @mock.patch.object(ubuntu, 'apt_cache')
+    def test_get_installed_version(self, apt_cache):
+        apt_cache.return_value = {'cinder-common': mock.Mock(
+            current_ver=mock.Mock(ver_str='2:16.2.0-0ubuntu1'))}
+        with mock.patch.object(unitdata, 'file_stamp',
+                               return_value=[1, 2, 3]) as file_stamp:
+            for _ in range(2):
+                self.assertEqual(ubuntu.get_installed_version('cinder-common'),
+                                 '2:16.2.0-0ubuntu1')
+            self.assertEqual(apt_cache.call_count, 1)
+            file_stamp.assert_called_with(unitdata.DPKG_STATUS)
+            # dpkg status changed, e.g. by an upgrade
+            file_stamp.return_value = [4, 2, 3]
+            apt_cache.return_value = {}
+            # not installed is cached as well
+            for _ in range(2):
+                self.assertIsNone(
+                    ubuntu.get_installed_version('cinder-common'))
+            self.assertEqual(apt_cache.call_count, 2)
+
+    @mock.patch.object(ubuntu, 'log')
+    @mock.patch.object(ubuntu, 'apt_cache')
+    def test_filter_installed_packages(self, apt_cache, log):
+        cache = {
+            'cinder-common': mock.Mock(current_ver=mock.Mock(
+                ver_str='2:16.2.0-0ubuntu1')),
+            'ceph-common': mock.Mock(current_ver=None)}
+        apt_cache.return_value = mock.Mock(
+            __getitem__=mock.Mock(side_effect=cache.__getitem__))
+        packages = ['cinder-common', 'ceph-common', 'unknown']
+        with mock.patch.object(unitdata, 'file_stamp',
+                               return_value=[1, 2, 3]):
+            for _ in range(2):
+                self.assertEqual(ubuntu.filter_installed_packages(packages),
+                                 ['ceph-common', 'unknown'])
+        # one lookup per package, in the first call only
+        self.assertEqual(apt_cache.return_value.__getitem__.call_count, 3)
+        log.assert_called_once_with(
+            'Package unknown has no installation candidate.',
+            level='WARNING')
+
+    @mock.patch.object(openstack_utils, '_get_os_codename_apt_package')
+    @mock.patch.object(openstack_utils, 'snap_install_requested')
+    def test_get_os_codename_package(self, snap_install_requested,
+                                     get_codename):
+        snap_install_requested.return_value = False
+        get_codename.return_value = 'ussuri'
+        with mock.patch.object(unitdata, 'file_stamp',
+                               return_value=[1, 2, 3]) as file_stamp:
+            for _ in range(2):
+                self.assertEqual(
+                    openstack_utils.get_os_codename_package('cinder-common'),
+                    'ussuri')
+            get_codename.assert_called_once_with('cinder-common', True)
+            file_stamp.return_value = [4, 2, 3]
+            get_codename.return_value = 'victoria'
+            self.assertEqual(
+                openstack_utils.get_os_codename_package('cinder-common'),
+                'victoria')